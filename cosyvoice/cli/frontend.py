@@ -15,8 +15,10 @@
 
 import os
 import re
+import copy
 import json
 import random
+import threading
 from typing import Callable, List, Tuple, Union, Optional
 
 import contractions
@@ -36,6 +38,7 @@ from cosyvoice.utils.frontend_utils import (
     emoji_norm, markdown_norm, normalize_punctuation, special_replace,
     ensure_proper_ending
 )
+from cosyvoice.utils.replace_table import ReplacementTable, ReplacementRules
 
 try:
     import ttsfrd
@@ -47,6 +50,49 @@ except ImportError:
     use_ttsfrd = False
 
 
+HYPHEN_BETWEEN_DIGITS_PATTERN = re.compile(r'(?<=\d)\s*-\s*(?=\d)')
+LO_BEFORE_PUNCTUATION_PATTERN = re.compile(r'咯([' + re.escape(PUNCTUATION_CHARS) + r'])')
+
+# Custom replacements applied before the normalizer (e.g. ancient poetry), reloaded when the file changes
+CUSTOM_REPLACE_RULES = ReplacementRules('./configs/custom_replace.jsonl')
+
+# Replacements applied after the normalizer, all in one pass
+POST_REPLACE_TABLE = ReplacementTable(
+    {
+        # Punctuation normalization
+        " - ": "，", "——": "，",
+        # Special Symbol Mapping
+        '†': '，', '²': '平方', '³': '立方', '/': '每', '~': '到', '～': '到',
+        # Number circling mapping
+        '①': '一', '②': '二', '③': '三', '④': '四', '⑤': '五',
+        '⑥': '六', '⑦': '七', '⑧': '八', '⑨': '九', '⑩': '十',
+        # Greek alphabet mapping
+        'α': '阿尔法', 'β': '贝塔', 'γ': '伽玛', 'Γ': '伽玛',
+        'δ': '德尔塔', 'Δ': '德尔塔', '△': '德尔塔', 'ε': '艾普西龙',
+        'ζ': '捷塔', 'η': '依塔', 'θ': '西塔', 'Θ': '西塔',
+        'ι': '艾欧塔', 'κ': '喀帕', 'λ': '拉姆达', 'Λ': '拉姆达',
+        'μ': '缪', 'ν': '拗', 'ξ': '克西', 'Ξ': '克西',
+        'ο': '欧米克伦', 'π': '派', 'Π': '派', 'ρ': '肉',
+        'ς': '西格玛', 'Σ': '西格玛', 'σ': '西格玛', 'τ': '套',
+        'υ': '宇普西龙', 'φ': '服艾', 'Φ': '服艾', 'χ': '器',
+        'ψ': '普赛', 'Ψ': '普赛', 'ω': '欧米伽', 'Ω': '欧米伽',
+        '□': '方框',
+        # Math symbol mapping
+        '>': '大于', '<': '小于', '∈': '属于', '∉': '不属于',
+        '∪': '并', '∩': '交', '⊥': '垂直', '∥': '平行',
+        '≠': '不等于', '∵': '因为', '∴': '所以', '∅': '空集',
+        '⊂': '真包含于', '⊃': '包含', '⊆': '包含于', '⊇': '真包含',
+        '⊄': '不属于', '⊅': '非超集', '⊈': '不属于', '⊉': '非超集',
+    },
+    runs={
+        ',:：;；、': '，',
+        '.…': '。',
+        '_·': '',
+        '\'"‘’“”|': '',
+    },
+)
+
+
 class SpeechTokenizer:
     """
     Tokenizer for extracting discrete speech tokens from audio.
@@ -122,13 +168,14 @@ class TextFrontEnd:
     Supports mixed Chinese and English input.
     """
     def __init__(self, use_phoneme: bool = False):
+        """
+        G2P resources (phonemizer, able list, replace dict) are loaded on the first
+        `g2p_infer` call, so one instance serves requests with and without phonemes.
+        """
         # Define constants
         self.PUNCTUATION_CHARS = PUNCTUATION_CHARS
         self.use_ttsfrd = use_ttsfrd
 
-        if use_phoneme:
-            self.text_tokenizer = G2P_zh()
-
         # Initialize TTS Frontend Engine
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
@@ -149,27 +196,43 @@ class TextFrontEnd:
             self.en_tn_model = EnNormalizer()
 
         self.use_phoneme = use_phoneme
-        if self.use_phoneme:
-            self.able_list = []
+        self.text_tokenizer = None
+        self.able_list = []
+        self.replace_dict = {}
+        self._g2p_loaded = False
+        self._g2p_lock = threading.Lock()
+
+        self.inflect_parser = inflect.engine()
+
+    def _load_g2p(self):
+        """Loads the G2P phonemizer, able list and replace dict once."""
+        if self._g2p_loaded:
+            return
+        with self._g2p_lock:
+            if self._g2p_loaded:
+                return
             script_path = os.path.abspath(__file__)
             # Navigate to configs directory
             use_phoneme_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(script_path))), "configs")
             able_path = os.path.join(use_phoneme_dir, "G2P_able_1word.json")
 
             with open(able_path, 'r', encoding='utf-8') as f:
-                self.able_list = json.load(f)
+                able_list = json.load(f)
 
             replace_dict_path = os.path.join(use_phoneme_dir, "G2P_replace_dict.jsonl")
-            self.replace_dict = {}
+            replace_dict = {}
             with open(replace_dict_path, 'r', encoding='utf-8') as f:
                 for line in f:
                     line = line.strip()
                     if not line:
                         continue
                     d = json.loads(line)
-                    self.replace_dict.update(d)
+                    replace_dict.update(d)
 
-        self.inflect_parser = inflect.engine()
+            self.text_tokenizer = G2P_zh()
+            self.able_list = able_list
+            self.replace_dict = replace_dict
+            self._g2p_loaded = True
 
     def text_normalize(self, text: str) -> Optional[str]:
         """
@@ -234,75 +297,20 @@ class TextFrontEnd:
         # Scientific notation
         sentence = tn_scientific_notation(sentence)
         # Remove hyphen if both sides are not numbers.
-        sentence = re.sub(r'(?<=\d)\s*-\s*(?=\d)', '减', sentence)
+        sentence = HYPHEN_BETWEEN_DIGITS_PATTERN.sub('减', sentence)
         sentence = sentence.replace('-', '')
         # Replace '咯' with '喽' when followed by punctuation
-        sentence = re.sub(r'咯([' + re.escape(PUNCTUATION_CHARS) + r'])', r'喽\1', sentence)
-        # Character variant replacement
+        sentence = LO_BEFORE_PUNCTUATION_PATTERN.sub(r'喽\1', sentence)
         # Custom replacements (e.g. ancient poetry)
-        custom_replace_path = './configs/custom_replace.jsonl'
-        if os.path.exists(custom_replace_path):
-            with open(custom_replace_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = json.loads(line)
-                    sentence = sentence.replace(line['origin'], line['new'])
+        sentence = CUSTOM_REPLACE_RULES(sentence)
         return sentence
 
     def post_replace(self, sentence: str) -> str:
         """Replacements applied AFTER normalizer."""
         # Bracket removal
         sentence = remove_bracket(sentence)
-        # Punctuation normalization
-        sentence = sentence.replace(" - ", "，")
-        sentence = sentence.replace("——", "，")
-        sentence = re.sub(r'[,:：;；、]+', '，', sentence)
-        sentence = re.sub(r'[.…]+', '。', sentence)
-        sentence = re.sub(r'[_·]+', '', sentence)
-        sentence = re.sub(r"""['"‘’“”|]+""", '', sentence)
-
-        # Special Symbol Mapping
-        sentence = sentence.replace('†', '，')
-        sentence = sentence.replace('²', '平方')
-        sentence = sentence.replace('³', '立方')
-        sentence = sentence.replace('/', '每')
-        sentence = sentence.replace('~', '到')
-        sentence = sentence.replace('～', '到')
-
-        # Number circling mapping
-        replacements = {
-            '①': '一', '②': '二', '③': '三', '④': '四', '⑤': '五',
-            '⑥': '六', '⑦': '七', '⑧': '八', '⑨': '九', '⑩': '十'
-        }
-        for k, v in replacements.items():
-            sentence = sentence.replace(k, v)
-
-        # Greek alphabet mapping
-        greek_map = {
-            'α': '阿尔法', 'β': '贝塔', 'γ': '伽玛', 'Γ': '伽玛',
-            'δ': '德尔塔', 'Δ': '德尔塔', '△': '德尔塔', 'ε': '艾普西龙',
-            'ζ': '捷塔', 'η': '依塔', 'θ': '西塔', 'Θ': '西塔',
-            'ι': '艾欧塔', 'κ': '喀帕', 'λ': '拉姆达', 'Λ': '拉姆达',
-            'μ': '缪', 'ν': '拗', 'ξ': '克西', 'Ξ': '克西',
-            'ο': '欧米克伦', 'π': '派', 'Π': '派', 'ρ': '肉',
-            'ς': '西格玛', 'Σ': '西格玛', 'σ': '西格玛', 'τ': '套',
-            'υ': '宇普西龙', 'φ': '服艾', 'Φ': '服艾', 'χ': '器',
-            'ψ': '普赛', 'Ψ': '普赛', 'ω': '欧米伽', 'Ω': '欧米伽',
-            '□': '方框'
-        }
-        for k, v in greek_map.items():
-            sentence = sentence.replace(k, v)
-
-        # Math symbol mapping
-        math_map = {
-            '>': '大于', '<': '小于', '∈': '属于', '∉': '不属于',
-            '∪': '并', '∩': '交', '⊥': '垂直', '∥': '平行',
-            '≠': '不等于', '∵': '因为', '∴': '所以', '∅': '空集',
-            '⊂': '真包含于', '⊃': '包含', '⊆': '包含于', '⊇': '真包含',
-            '⊄': '不属于', '⊅': '非超集', '⊈': '不属于', '⊉': '非超集'
-        }
-        for k, v in math_map.items():
-            sentence = sentence.replace(k, v)
-
+        # Punctuation normalization and symbol / circled number / Greek / math mapping
+        sentence = POST_REPLACE_TABLE(sentence)
         return sentence
 
     def _normalize_english_text(self, text: str) -> str:
@@ -495,6 +503,7 @@ class TextFrontEnd:
         3. For Chinese blocks: Perform G2P (ensuring polyphone accuracy), align, and selectively replace.
         4. For Non-Chinese blocks: Keep as is.
         """
+        self._load_g2p()
         # 1. Dictionary replacement
         pre_segments = self._tokenize_by_replace_dict(text)
         final_output = []
@@ -617,6 +626,15 @@ class TTSFrontEnd:
         if os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
 
+    def with_feat_extractor(self, feat_extractor: Callable) -> "TTSFrontEnd":
+        """
+        A frontend for another sample rate: shares the tokenizer, speech tokenizer and
+        speaker-embedding session, only the speech feature extractor differs.
+        """
+        frontend = copy.copy(self)
+        frontend.feat_extractor = feat_extractor
+        return frontend
+
     def _extract_text_token(self, text: str) -> torch.Tensor:
         text_token = self.tokenize_fn(text)
         text_token = torch.tensor([text_token], dtype=torch.int32).to(self.device)
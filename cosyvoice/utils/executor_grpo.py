@@ -37,7 +37,7 @@ class Executor:
         self.mode = mode
 
     def train_one_epoc(self, model, optimizer, scheduler, train_data_loader, cv_data_loader, writer, info_dict,
-                       group_join, ref_model, reward_func):
+                       group_join, ref_model, reward_func, flow=None):
         ''' Train one epoch
         '''
 
@@ -107,7 +107,8 @@ class Executor:
                             num_answer_per_question=NUM_ANSWERS_PER_QUESTION,
                             reward_function=reward_func,
                             device=device,
-                            info_dict=info_dict
+                            info_dict=info_dict,
+                            flow=flow
                         )                  
                         normalized_episodes, has_grad = normalize_rewards_per_group(episodes, info_dict['reward_weight'])
                         if has_grad:
@@ -0,0 +1,142 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Single-pass string replacement tables for the text frontend.
+
+`ReplacementTable` compiles a {key: replacement} map (plus character classes
+whose runs collapse into one replacement) into one alternation regex and a lookup
+dict, so a sentence is scanned once instead of once per rule. At every position
+the longest key wins, and replaced text is never scanned again.
+
+`ReplacementRules` loads a jsonl rule file ({"origin": ..., "new": ...} per line)
+once and reloads it when its mtime changes. Rules are applied one after another
+in file order, so a rule can rewrite the output of an earlier one; the compiled
+single pass is used only when no rule can interact with another (no origin inside
+or overlapping another origin or a replacement), where both give the same result.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+class ReplacementTable:
+    def __init__(self, table: Dict[str, str], runs: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            table: Literal keys and their replacements.
+            runs: Character classes (a string of characters) mapped to the replacement
+                of a whole run of them, e.g. {",;": "，"} turns ",;," into one "，".
+        """
+        runs = runs or {}
+        self.table = dict(table)
+        self.run_chars: Dict[str, str] = {}
+        for chars, replacement in runs.items():
+            for char in chars:
+                self.run_chars[char] = replacement
+        keys = [key for key in self.table if key]
+        if any(key[0] in self.run_chars for key in keys):
+            raise ValueError("Replacement keys must not start with a run character.")
+
+        # Longer keys first; single characters go into one class, which the regex engine tests at once
+        alternatives = [re.escape(key) for key in sorted(keys, key=len, reverse=True) if len(key) > 1]
+        single_chars = "".join(re.escape(key) for key in keys if len(key) == 1)
+        if single_chars:
+            alternatives.append("[" + single_chars + "]")
+        alternatives += ["[" + "".join(re.escape(char) for char in chars) + "]+" for chars in runs if chars]
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+    def _replace(self, match: "re.Match") -> str:
+        text = match.group(0)
+        replacement = self.table.get(text)
+        if replacement is None:
+            replacement = self.run_chars[text[0]]
+        return replacement
+
+    def __call__(self, text: str) -> str:
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+
+def _overlaps(left: str, right: str) -> bool:
+    """Whether a proper suffix of `left` is a prefix of `right`."""
+    return any(left.endswith(right[:k]) for k in range(1, min(len(left), len(right))))
+
+
+def _rules_interact(rules: List[Tuple[str, str]]) -> bool:
+    origins = [origin for origin, _ in rules]
+    for i, origin in enumerate(origins):
+        if not origin:
+            return True
+        for j, other in enumerate(origins):
+            if i != j and (other in origin or _overlaps(origin, other)):
+                return True
+        for _, new in rules:
+            # A replacement containing an origin, or forming one with its neighbours
+            if origin in new or _overlaps(new, origin) or _overlaps(origin, new):
+                return True
+            if len(origin) > 1 and (not new or new in origin):
+                return True
+    return False
+
+
+class ReplacementRules:
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime: Optional[float] = None
+        # (rules, compiled table or None), swapped as one on reload
+        self.state: Tuple[List[Tuple[str, str]], Optional[ReplacementTable]] = ([], None)
+        self.lock = threading.Lock()
+
+    def _reload(self, mtime: Optional[float]):
+        rules = []
+        if mtime is not None:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    rule = json.loads(line)
+                    rules.append((rule['origin'], rule['new']))
+        table = None
+        if not _rules_interact(rules):
+            table = ReplacementTable(dict(rules))
+        elif rules:
+            logging.info(f"Rules in {self.path} interact, applying them one by one.")
+        self.state = (rules, table)
+        self.mtime = mtime
+
+    def check(self):
+        """Reloads the rule file if it changed (or appeared / disappeared) since the last load."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self._reload(mtime)
+
+    def __call__(self, text: str) -> str:
+        self.check()
+        rules, table = self.state
+        if table is not None:
+            return table(text)
+        for origin, new in rules:
+            text = text.replace(origin, new)
+        return text
@@ -0,0 +1,154 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Adaptive step count for flow sampling.
+
+`Flow.do_sample` normally runs exactly `n_timesteps` ODE steps. With a controller
+attached (`Flow.step_controller`) it can
+
+- plan fewer steps up front so that one sampling call fits a latency budget, using
+  a running estimate of the cost per (frame x DiT evaluation) measured on earlier
+  calls. Solver and guidance schedule are chosen per request, so a step costs
+  `nfe_per_step` evaluations per CFG branch it runs (see
+  `flow.guidance.guided_function_evals`); the plan counts them for the requested
+  solver and schedule, and every record is normalised the same way, and
+- stop early once the trajectory is straight: when the mean velocity of a step
+  (x update / dt) differs from the previous step's by less than `tolerance`
+  (relative L2), the remaining interval up to t=1 is covered by one final step.
+
+Every sampling call is recorded; `get_stats` returns aggregate counters and
+`collect` gathers the records of one request (per thread) for logging.
+
+Streaming paths (step cache or incremental session) need the same steps on
+every chunk and always run the full schedule.
+"""
+
+import collections
+import contextlib
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import torch
+
+from flow.guidance import guided_function_evals
+
+
+def stretch_schedule(weights: Sequence[float], n_timesteps: int) -> List[float]:
+    """Per-step CFG `weights` of the requested schedule spread over `n_timesteps` steps."""
+    return [weights[i * len(weights) // n_timesteps] for i in range(n_timesteps)]
+
+
+class AdaptiveStepController:
+    def __init__(self,
+                 tolerance: float = 0.0,
+                 min_steps: int = 3,
+                 latency_budget: Optional[float] = None,
+                 history: int = 256):
+        """
+        Args:
+            tolerance: Relative velocity change below which sampling stops early (0: never).
+            min_steps: Steps always run before stopping early or when planning for a budget.
+            latency_budget: Target seconds per sampling call (None: no budget).
+            history: Number of recent call records kept for `get_stats`.
+        """
+        self.tolerance = tolerance
+        self.min_steps = min_steps
+        self.latency_budget = latency_budget
+        # Running estimate of seconds per (frame x DiT evaluation); None until the first record
+        self.sec_per_frame_eval: Optional[float] = None
+        self.recent = collections.deque(maxlen=history)
+        self.stats: Dict[str, int] = {
+            "calls": 0,
+            "planned_steps": 0,
+            "used_steps": 0,
+            "early_stops": 0,
+            "budget_limited": 0,
+        }
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def plan_steps(self, cfg_weights: Sequence[float], num_frames: int, nfe_per_step: int = 1) -> int:
+        """
+        Step count for a call over `num_frames` frames (batch included): the most
+        steps, up to the requested `len(cfg_weights)`, whose DiT evaluations under the
+        stretched schedule fit the latency budget.
+        """
+        n_timesteps = len(cfg_weights)
+        if self.latency_budget is None or self.sec_per_frame_eval is None:
+            return n_timesteps
+        affordable = self.latency_budget / (self.sec_per_frame_eval * max(num_frames, 1))
+        steps = n_timesteps
+        while steps > self.min_steps and \
+                guided_function_evals(stretch_schedule(cfg_weights, steps), nfe_per_step) > affordable:
+            steps -= 1
+        return min(steps, n_timesteps)
+
+    def converged(self, step: int, update: torch.Tensor, prev_update: Optional[torch.Tensor]) -> bool:
+        """Whether the mean velocity of step `step` (1-based) matches the previous step's."""
+        if self.tolerance <= 0 or prev_update is None or step < self.min_steps:
+            return False
+        change = (update - prev_update).flatten(1).norm(dim=1) / update.flatten(1).norm(dim=1).clamp(min=1e-8)
+        # Every item of the batch has to be converged
+        return change.max().item() < self.tolerance
+
+    def record(self, requested_steps: int, planned_steps: int, used_steps: int, num_frames: int,
+               elapsed: float, function_evals: Optional[int] = None) -> Dict:
+        """
+        Records one sampling call. `function_evals` is the number of DiT evaluations it
+        ran (default: one per used step).
+        """
+        function_evals = function_evals if function_evals is not None else used_steps
+        record = {
+            "requested_steps": requested_steps,
+            "planned_steps": planned_steps,
+            "used_steps": used_steps,
+            "function_evals": function_evals,
+            "frames": num_frames,
+            "elapsed": round(elapsed, 4),
+        }
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["planned_steps"] += planned_steps
+            self.stats["used_steps"] += used_steps
+            self.stats["early_stops"] += used_steps < planned_steps
+            self.stats["budget_limited"] += planned_steps < requested_steps
+            cost = elapsed / max(num_frames * function_evals, 1)
+            if self.sec_per_frame_eval is None:
+                self.sec_per_frame_eval = cost
+            else:
+                self.sec_per_frame_eval = 0.9 * self.sec_per_frame_eval + 0.1 * cost
+            self.recent.append(record)
+        collector = getattr(self._local, "records", None)
+        if collector is not None:
+            collector.append(record)
+        return record
+
+    @contextlib.contextmanager
+    def collect(self):
+        """Collects the records of the sampling calls made by this thread inside the block."""
+        previous = getattr(self._local, "records", None)
+        records: List[Dict] = []
+        self._local.records = records
+        try:
+            yield records
+        finally:
+            self._local.records = previous
+
+    def get_stats(self) -> Dict[str, float]:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["mean_used_steps"] = round(stats["used_steps"] / stats["calls"], 2) if stats["calls"] else 0.0
+            stats["sec_per_frame_eval"] = self.sec_per_frame_eval
+            stats["recent"] = list(self.recent)[-16:]
+        return stats
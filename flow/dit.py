@@ -30,7 +30,8 @@ from flow.modules import (
     AdaLayerNormZero_Final,
     precompute_freqs_cis,
     get_pos_embed_indices,
-    DiTBlockCausalV2
+    DiTBlockCausalV2,
+    BlockCausalMask
 )
 
 
@@ -54,7 +55,7 @@ class TextEmbedding(nn.Module):
         else:
             self.extra_modeling = False
 
-    def forward(self, text_bt, aim_seq_len):
+    def forward(self, text_bt, aim_seq_len, padding_mask_bt=None):
         # Debug check for vocab size
         if text_bt.max() > self.text_embed.num_embeddings:
              raise ValueError(f"Token ID {text_bt.max()} exceeds vocabulary size {self.text_embed.num_embeddings}")
@@ -82,7 +83,8 @@ class TextEmbedding(nn.Module):
             
             text_pos_embed = self.freqs_cis[pos_idx]
             hidden_btd = hidden_btd + text_pos_embed
-            hidden_btd = self.text_blocks(hidden_btd)
+            for block in self.text_blocks:
+                hidden_btd = block(hidden_btd, padding_mask_bt)
 
         return hidden_btd
 
@@ -98,7 +100,7 @@ class EmbeddingConcater(nn.Module):
         self.conv_pos_embed = ConvPositionEmbedding(dim=out_dim)
 
     def forward(self, x: torch.Tensor, cond: torch.Tensor, text_embed: torch.Tensor,
-                drop_audio_cond=False):
+                drop_audio_cond=False, padding_mask_bt=None):
         
         if drop_audio_cond:
             cond = torch.zeros_like(cond)
@@ -106,9 +108,37 @@ class EmbeddingConcater(nn.Module):
         # Concatenate along the feature dimension
         x = self.proj(torch.cat((x, cond, text_embed), dim=-1))
         # Add convolutional position embedding
-        x = self.conv_pos_embed(x) + x
+        x = self.conv_pos_embed(x, padding_mask_bt) + x
         return x
 
+    def project_condition(self, cond: torch.Tensor, text_embed: torch.Tensor):
+        """Part of `proj` that depends on the condition and text embedding only (bias included)."""
+        cond_dim = cond.shape[-1] + text_embed.shape[-1]
+        return F.linear(torch.cat((cond, text_embed), dim=-1), self.proj.weight[:, -cond_dim:], self.proj.bias)
+
+    def forward_projected(self, x: torch.Tensor, cond_proj: torch.Tensor, padding_mask_bt=None):
+        """`forward` with the condition/text part precomputed by `project_condition`."""
+        x = F.linear(x, self.proj.weight[:, :x.shape[-1]]) + cond_proj
+        x = self.conv_pos_embed(x, padding_mask_bt) + x
+        return x
+
+
+class DiTContext:
+    """
+    Inputs of DiT.forward that do not change over the ODE steps of one sampling call:
+    text embedding, condition/text part of the input projection, rotary embedding
+    and attention mask. Built once by `DiT.prepare_context` and shared by every step.
+    With `query_start` > 0 (incremental streaming) rope and mask cover the active rows only.
+    """
+
+    def __init__(self, padding_mask_bt, text_embed, cond_proj, rope, attn_mask, query_start=0):
+        self.padding_mask_bt = padding_mask_bt
+        self.text_embed = text_embed
+        self.cond_proj = cond_proj
+        self.rope = rope
+        self.attn_mask = attn_mask
+        self.query_start = query_start
+
 
 class DiT(nn.Module):
     def __init__(
@@ -149,6 +179,8 @@ class DiT(nn.Module):
 
         self.spkr_emb_adaLN = spkr_emb_adaLN
         self.attention_mask_type = attention_mask_type
+        # Block-causal attention: per-block key ranges (True) or one dense (B, 1, T, T) mask
+        self.block_sparse_attn = True
 
         # Determine speaker embedding dimension
         if spkr_emb_adaLN:
@@ -173,6 +205,49 @@ class DiT(nn.Module):
         self.norm_out = AdaLayerNormZero_Final(trans_dim, additional_dim=spkr_dim)
         self.proj_out = nn.Linear(trans_dim, mel_dim)
 
+    def prepare_context(self, condition_btd, text, padding_mask_bt, is_causal=False, block_pattern=None,
+                        query_start=0):
+        """
+        Computes the step-invariant part of `forward` for the given condition and tokens.
+        """
+        seq_len = condition_btd.shape[1]
+
+        # Text/Speech Token Embedding
+        # Padded frames (right padding of shorter items in a batch) are masked out of every
+        # operation that mixes frames, so each item's output matches an unpadded forward.
+        padding_mask_bt = padding_mask_bt.bool()
+        text_embed = self.text_emb_layer(text, seq_len, padding_mask_bt)
+        cond_proj = self.emb_concator.project_condition(condition_btd, text_embed)
+
+        # Rotary Embeddings
+        freqs, xpos_scale = self.rotary_embed.forward_from_seq_len(seq_len)
+        if query_start > 0:
+            freqs = freqs[:, query_start:]
+            if isinstance(xpos_scale, torch.Tensor):
+                xpos_scale = xpos_scale[:, query_start:]
+        rope = (freqs, xpos_scale)
+
+        # Attention Mask
+        if is_causal:
+            # Default block pattern if None
+            if block_pattern is None:
+                block_pattern = [25, 50, 200]
+
+            attn_mask = self.create_attn_mask(condition_btd.shape[0], seq_len,
+                                              padding_mask_bt.unsqueeze(1),
+                                              padding_mask_bt.device,
+                                              n_heads=self.num_heads,
+                                              block_pattern=block_pattern,
+                                              query_start=query_start)
+        elif padding_mask_bt.all():
+            # Nothing padded (batch-1 and offline calls): no mask keeps SDPA on its fused kernels
+            attn_mask = None
+        else:
+            # Key padding mask of a padded batch (inference_batch), broadcast over heads and queries
+            attn_mask = padding_mask_bt[:, None, None, :]
+
+        return DiTContext(padding_mask_bt, text_embed, cond_proj, rope, attn_mask, query_start)
+
     def forward(
             self,
             middle_point_btd,
@@ -183,78 +258,116 @@ class DiT(nn.Module):
             is_causal=False,
             spkr_emb_bd=None,
             block_pattern=None,
+            stream=None,
+            context=None,
     ):
         """
         Forward pass of the DiT model.
+        `context` (from `prepare_context` with the same condition, text, mask and causality)
+        skips the step-invariant computations; without it they are done here.
+        With `stream` (a flow.streaming.DiTStreamState), only the frames after the
+        stream's frozen prefix are computed; see `forward_incremental`.
         """
-        bs, seq_len = middle_point_btd.shape[0], middle_point_btd.shape[1]
-        
-        # 1. Time Embedding
-        time_emb_bd = self.time_embed(time_step_1d)
-        
-        # 2. Speaker Embedding (if Adaptive LayerNorm is used)
-        if self.spkr_emb_adaLN:
-            assert spkr_emb_bd is not None
-            time_emb_bd = torch.cat([time_emb_bd, spkr_emb_bd], dim=-1)
+        if context is None:
+            context = self.prepare_context(condition_btd, text, padding_mask_bt, is_causal, block_pattern,
+                                           query_start=stream.frozen_len if stream is not None else 0)
+        if stream is not None:
+            return self.forward_incremental(middle_point_btd, time_step_1d, spkr_emb_bd, context, stream)
 
-        # 3. Text/Speech Token Embedding
-        text_embed = self.text_emb_layer(text, seq_len)
+        # 1. Time Embedding (+ Speaker Embedding if Adaptive LayerNorm is used)
+        time_emb_bd = self.embed_time(time_step_1d, spkr_emb_bd)
 
-        # 4. Input Concatenation & Projection
-        middle_point_btd = self.emb_concator(middle_point_btd, condition_btd, text_embed, drop_audio_cond=False)
+        # 2. Input Projection (condition/text part precomputed) & Conv Position Embedding
+        padding_mask_bt = context.padding_mask_bt
+        middle_point_btd = self.emb_concator.forward_projected(middle_point_btd, context.cond_proj, padding_mask_bt)
 
-        # 5. Rotary Embeddings
-        rope = self.rotary_embed.forward_from_seq_len(seq_len)
-
-        # 6. Long Skip Connection (Save residual)
+        # 3. Long Skip Connection (Save residual)
         if self.long_skip_connection is not None:
             residual = middle_point_btd
 
-        # 7. Create Attention Mask
-        if is_causal:
-            # Default block pattern if None
-            if block_pattern is None:
-                block_pattern = [25, 50, 200]
-                
-            attn_mask = self.create_attn_mask(bs, seq_len,
-                                              padding_mask_bt.unsqueeze(1),
-                                              padding_mask_bt.device,
-                                              n_heads=self.num_heads, 
-                                              block_pattern=block_pattern)
-        else:
-            attn_mask = None
-
-        # 8. Transformer Blocks
+        # 4. Transformer Blocks
         for block in self.transformer_blocks:
             middle_point_btd = block(middle_point_btd, time_emb_bd,
                                      padding_mask=padding_mask_bt.unsqueeze(1),
-                                     rope=rope,
-                                     attn_mask=attn_mask)
+                                     rope=context.rope,
+                                     attn_mask=context.attn_mask)
 
-        # 9. Long Skip Connection (Apply)
+        # 5. Long Skip Connection (Apply)
         if self.long_skip_connection is not None:
             middle_point_btd = self.long_skip_connection(torch.cat((middle_point_btd, residual), dim=-1))
 
-        # 10. Final Norm & Output Projection
+        # 6. Final Norm & Output Projection
         middle_point_btd = self.norm_out(middle_point_btd, time_emb_bd)
         output = self.proj_out(middle_point_btd)
 
         return output
 
-    def create_attn_mask(self, bs, seq_len, padding_mask_b1t, device, n_heads, block_pattern):
+    def embed_time(self, time_step_1d, spkr_emb_bd=None):
+        time_emb_bd = self.time_embed(time_step_1d)
+        if self.spkr_emb_adaLN:
+            assert spkr_emb_bd is not None
+            time_emb_bd = torch.cat([time_emb_bd, spkr_emb_bd], dim=-1)
+        return time_emb_bd
+
+    def forward_incremental(self, middle_point_btd, time_step_1d, spkr_emb_bd, context, stream):
         """
-        Creates a custom attention mask, likely for block-causal attention.
+        Block-causal forward over the active frames [stream.frozen_len, T) only.
+
+        `middle_point_btd` holds the active frames; `context` covers the whole sequence
+        and was prepared with query_start=stream.frozen_len. Frozen frames enter attention
+        through the keys/values cached for this call, and the conv position embedding
+        through their cached inputs.
+        """
+        call = stream.next_call(self.depth)
+        start = stream.frozen_len
+        assert context.query_start == start, "DiTContext was prepared for another frozen length."
+
+        time_emb_bd = self.embed_time(time_step_1d, spkr_emb_bd)
+        padding_mask_bt = context.padding_mask_bt
+
+        # Left context for the conv position embedding: inputs of the last frozen frames
+        left_btd = call.left_context(middle_point_btd)
+        call.record_input(middle_point_btd)
+        window_start = start - left_btd.shape[1]
+        middle_point_btd = self.emb_concator.forward_projected(torch.cat([left_btd, middle_point_btd], dim=1),
+                                                               context.cond_proj[:, window_start:],
+                                                               padding_mask_bt[:, window_start:])
+        middle_point_btd = middle_point_btd[:, start - window_start:]
+
+        if self.long_skip_connection is not None:
+            residual = middle_point_btd
+
+        # Mask rows of the active queries span all keys (frozen + active)
+        active_padding_mask = padding_mask_bt[:, start:].unsqueeze(1)
+        for block, kv_cache in zip(self.transformer_blocks, call.layers):
+            middle_point_btd = block(middle_point_btd, time_emb_bd,
+                                     padding_mask=active_padding_mask,
+                                     rope=context.rope,
+                                     attn_mask=context.attn_mask,
+                                     kv_cache=kv_cache)
+
+        if self.long_skip_connection is not None:
+            middle_point_btd = self.long_skip_connection(torch.cat((middle_point_btd, residual), dim=-1))
+
+        middle_point_btd = self.norm_out(middle_point_btd, time_emb_bd)
+        return self.proj_out(middle_point_btd)
+
+    def create_attn_mask(self, bs, seq_len, padding_mask_b1t, device, n_heads, block_pattern, query_start=0):
+        """
+        Creates the block-causal attention mask: a BlockCausalMask when `block_sparse_attn`
+        is set, otherwise a dense boolean mask (B, 1, T, T) broadcast over heads.
+        Only the rows of queries from `query_start` on are built (incremental streaming).
         """
         block_list = [self.token_size_to_mel_size(i) for i in block_pattern]
-        mask_tt = block_mask_util.create_with_cache(block_list, seq_len).bool().to(device)
-        block_mask_btt = mask_tt[None].repeat(bs, 1, 1)
-        
+        key_padding_mask_bt = padding_mask_b1t[:, 0].bool()
+        if self.block_sparse_attn:
+            row_limits = block_mask_util.create_row_limits(block_list, seq_len, row_start=query_start, device=device)
+            chunks = block_mask_util.query_chunks(block_list, seq_len, row_start=query_start)
+            return BlockCausalMask(row_limits, key_padding_mask_bt, chunks)
+
+        mask_tt = block_mask_util.create_with_cache(block_list, seq_len, row_start=query_start, device=device)
         # Combine with padding mask
-        block_mask_btt = block_mask_btt * padding_mask_b1t.bool()
-        
-        # Expand for heads
-        attn_mask_bhtt = block_mask_btt.unsqueeze(1).repeat(1, n_heads, 1, 1)
-        return attn_mask_bhtt
+        return (mask_tt[None] & key_padding_mask_bt[:, None, :]).unsqueeze(1)
 
     def token_size_to_mel_size(self, i):
         # Convert token steps to mel-spectrogram frames.
@@ -16,10 +16,15 @@ Flow Matching Wrapper for Streaming Inference.
 Manages the DiT model initialization and the ODE sampling process.
 """
 
+import time
+
 import torch
 from torch.nn import functional as F
 from cosyvoice.utils.mask import make_pad_mask
 from flow.dit import DiT
+from flow.adaptive import stretch_schedule
+from flow.guidance import guidance_weights, guided_function_evals
+from flow.solvers import get_solver
 
 
 class Flow(torch.nn.Module):
@@ -61,6 +66,11 @@ class Flow(torch.nn.Module):
         self.t_scheduler = t_scheduler
         self.training_cfg_rate = 0.2
         self.inference_cfg_rate = 0.7
+        # Run the conditional and unconditional CFG branches as one batched DiT call per step;
+        # set to False to use two sequential calls (lower peak memory)
+        self.fused_cfg = True
+        # Optional flow.adaptive.AdaptiveStepController (latency budget / early stop, offline only)
+        self.step_controller = None
         self.sigma_min = 1e-06
 
         # Initialize Speaker Embedding Layer (Project to match DiT condition dim)
@@ -96,12 +106,55 @@ class Flow(torch.nn.Module):
                              last_step_cache=None,
                              wavlm_emb_bt=None,
                              is_causal=False,
-                             block_pattern=None
+                             block_pattern=None,
+                             solver="euler",
+                             guidance=None
                              ):
         """
-        Streaming inference method that supports KV-caching via last_step_cache.
+        Streaming inference method that supports step caching via last_step_cache
+        (flow.streaming.FlowStepCache, updated in place and returned); offline callers
+        pass None and no per-step states are kept.
+        `solver` names an ODE solver from flow.solvers.SOLVERS; each of the
+        `n_timesteps` steps costs `nfe_per_step` DiT evaluations.
+        `guidance` is a CFG schedule string (flow/guidance.py); None guides every step.
         """
         assert token.shape[0] == 1, "Batch size must be 1 for streaming inference."
+        token, mel_cond_btd, padding_mask_bt, prompt_feat_len = self._prepare_utterance(token, prompt_token, prompt_feat)
+
+        condition_btd, spkr_embedding_normed = self._build_condition(mel_cond_btd, embedding, wavlm_emb_bt)
+
+        # Run Sampling
+        result_btd, step_cache = self.do_sample(
+            token,
+            mel_cond_btd,
+            condition_btd, 
+            padding_mask_bt, 
+            spkr_embedding_normed, 
+            is_causal,
+            block_pattern, 
+            n_timesteps, 
+            last_step_cache,
+            solver,
+            guidance=guidance
+        )
+
+        # Remove the prompt part from the result
+        if prompt_feat is not None:
+            result_btd = result_btd[:, prompt_feat_len:, :]
+
+        # Permute to (Batch, Dimension, Time) for output convention
+        result_bdt = result_btd.permute(0, 2, 1)
+
+        return result_bdt, step_cache
+
+    def _prepare_utterance(self, token, prompt_token, prompt_feat):
+        """
+        Prepends the prompt tokens and builds the mel condition (prompt mel, zeros after)
+        and padding mask of a single utterance.
+
+        Returns:
+            Tuple of (token, mel_cond_btd, padding_mask_bt, prompt_feat_len).
+        """
         device = token.device
         token_len = token.shape[1]
 
@@ -127,6 +180,13 @@ class Flow(torch.nn.Module):
             copy_len = min(prompt_feat.shape[1], mel_cond_btd.shape[1])
             mel_cond_btd[:, :copy_len, :] = prompt_feat[:, -copy_len:, :]
 
+        return token, mel_cond_btd, padding_mask_bt, prompt_feat_len
+
+    def _build_condition(self, mel_cond_btd, embedding, wavlm_emb_bt=None):
+        """
+        Builds the DiT condition (masked mel + projected speaker embedding) and the
+        normalized speaker embedding used for adaLN.
+        """
         # Process Speaker Embedding
         spkr_embedding_normed = F.normalize(embedding, dim=1)
 
@@ -141,30 +201,72 @@ class Flow(torch.nn.Module):
 
         # Handle WavLM Embedding
         if self.use_wavlm_emb and wavlm_emb_bt is not None:
-            emb2 = F.normalize(wavlm_emb_bt.to(device), dim=1)
+            emb2 = F.normalize(wavlm_emb_bt.to(mel_cond_btd.device), dim=1)
             spkr_embedding_normed = torch.cat([spkr_embedding_normed, emb2], dim=1)
 
-        # Run Sampling
-        result_btd, current_step2cache = self.do_sample(
-            token,
-            mel_cond_btd,
-            condition_btd, 
-            padding_mask_bt, 
-            spkr_embedding_normed, 
-            is_causal,
-            block_pattern, 
-            n_timesteps, 
-            last_step_cache
-        )
+        return condition_btd, spkr_embedding_normed
 
-        # Remove the prompt part from the result
-        if prompt_feat is not None:
-            result_btd = result_btd[:, prompt_feat_len:, :]
+    @torch.inference_mode()
+    def inference_batch(self,
+                        tokens,
+                        prompt_tokens,
+                        prompt_feats,
+                        embeddings,
+                        n_timesteps=10,
+                        solver="euler",
+                        guidance=None
+                        ):
+        """
+        Offline inference for several utterances of different lengths in one DiT batch.
+        Items are right padded to the longest one and masked, so each item's mel matches
+        a separate `inference_with_cache` call given the same initial noise.
 
-        # Permute to (Batch, Dimension, Time) for output convention
-        result_bdt = result_btd.permute(0, 2, 1)
+        Args:
+            tokens: Per-item speech tokens, each (1, T_i).
+            prompt_tokens: Per-item prompt speech tokens, each (1, P_i).
+            prompt_feats: Per-item prompt mel features, each (1, F_i, mel_dim).
+            embeddings: Per-item speaker embeddings, each (1, 192).
 
-        return result_bdt, current_step2cache
+        Returns:
+            List[torch.Tensor]: Per-item mels without the prompt part, each (1, mel_dim, T_i).
+        """
+        device = tokens[0].device
+        aligned_tokens, feat_lens, prompt_feat_lens = [], [], []
+        for token, prompt_token in zip(tokens, prompt_tokens):
+            token = torch.cat([prompt_token.to(device), token], dim=1)
+            feat_len = int(token.shape[1] / self.input_frame_rate * self.mel_framerate)
+            # Align tokens to frames here (as DiT's "interpolate_token" would) so padding stays at the end
+            aligned_tokens.append(F.interpolate(token[:, None].float(), size=feat_len, mode='nearest')[:, 0].long())
+            feat_lens.append(feat_len)
+        max_len = max(feat_lens)
+
+        token_bt = torch.cat([F.pad(token, (0, max_len - token.shape[1])) for token in aligned_tokens], dim=0)
+        padding_mask_bt = (~make_pad_mask(torch.LongTensor(feat_lens), max_len)).to(device)
+        mel_cond_btd = torch.zeros([len(tokens), max_len, self.mel_dim], device=device)
+        for i, prompt_feat in enumerate(prompt_feats):
+            copy_len = min(prompt_feat.shape[1], feat_lens[i])
+            mel_cond_btd[i, :copy_len] = prompt_feat[0, -copy_len:].to(device)
+            prompt_feat_lens.append(prompt_feat.shape[1])
+
+        condition_btd, spkr_embedding_normed = self._build_condition(
+            mel_cond_btd, torch.cat([embedding.to(device) for embedding in embeddings], dim=0)
+        )
+
+        result_btd, _ = self.do_sample(
+            token_bt,
+            mel_cond_btd,
+            condition_btd,
+            padding_mask_bt,
+            spkr_embedding_normed,
+            False,
+            None,
+            n_timesteps,
+            None,
+            solver,
+            guidance=guidance
+        )
+
+        return [result_btd[i:i + 1, prompt_feat_lens[i]:feat_lens[i]].permute(0, 2, 1) for i in range(len(tokens))]
 
     def do_sample(self, 
                   speech_token_bt,
@@ -175,90 +277,158 @@ class Flow(torch.nn.Module):
                   is_causal,
                   block_pattern, 
                   n_timesteps, 
-                  last_step_cache):
+                  last_step_cache,
+                  solver="euler",
+                  stream=None,
+                  guidance=None):
         """
-        Executes the sampling process using a manual Euler method loop to support
-        step-by-step caching for streaming.
+        Integrates the flow ODE over the time schedule with a registered solver
+        (see flow/solvers.py), one step at a time to support step-by-step caching for streaming.
+        `guidance` is a CFG schedule (see flow/guidance.py); None guides every step with
+        `inference_cfg_rate`.
+        With `stream` (flow.streaming.DiTStreamState) only the frames after its frozen
+        prefix are sampled and returned; all other inputs cover the whole sequence.
+        Outside streaming, `step_controller` may plan fewer steps or stop early.
         """
-        current_step2cache = {}
+        ode_solver = get_solver(solver)
+        controller = self.step_controller if stream is None and last_step_cache is None else None
+        if controller is not None:
+            start_time = time.time()
         
         # Initial noise
-        x = torch.randn_like(mel_cond_btd)
+        if stream is not None:
+            x = torch.randn_like(mel_cond_btd[:, stream.frozen_len:])
+        else:
+            x = torch.randn_like(mel_cond_btd)
         device = speech_token_bt.device
 
+        # Per-step CFG weights of the requested schedule
+        cfg_weights = guidance_weights(guidance, n_timesteps, self.inference_cfg_rate)
+        requested_steps = n_timesteps
+        if controller is not None:
+            n_timesteps = controller.plan_steps(cfg_weights, x.shape[0] * x.shape[1], ode_solver.nfe_per_step)
+            # Stretch the schedule over the planned steps
+            cfg_weights = stretch_schedule(cfg_weights, n_timesteps)
+
         # Time scheduler setup
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=device)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         # Note: If other schedulers are needed, add elif blocks here.
 
-        t_current = t_span[0]
-        dt = t_span[1] - t_span[0]
+        # Steps with CFG weight 0 run the conditional branch only
+        cfg_weight = cfg_weights[0]
 
-        sol = []
-        
-        # Iterative Denoising (Euler method)
-        for step in range(1, len(t_span)):
-            # Apply cache if available (Overwriting the beginning of the sequence)
-            if last_step_cache is not None:
-                x_cache = last_step_cache[step]['x']
-                override_len = last_step_cache.get('override_len', x_cache.shape[-1])
-                
-                # Safety check for dimensions
-                safe_len = min(x.shape[1], override_len)
-                x[:, :safe_len, :] = x_cache[:, :safe_len, :]
-
-            # Cache current input for the next streaming chunk
-            current_step2cache[step] = {
-                "x": x.clone().detach(),
-            }
-
-            # 1. Forward pass (Conditional)
-            dphi_dt = self.estimator(
-                middle_point_btd=x,
-                condition_btd=condition_btd,
-                text=speech_token_bt,
-                time_step_1d=t_current[None],
-                padding_mask_bt=padding_mask_bt,
-                spkr_emb_bd=spkr_embedding_normed,
-                is_causal=is_causal,
-                block_pattern=block_pattern
-            )
-
-            # 2. Classifier-Free Guidance (CFG)
-            if self.inference_cfg_rate > 0:
-                # Prepare unconditional input
-                if self.speech_token_cfg:
-                    text_for_no_condition = torch.zeros_like(speech_token_bt)
-                else:
-                    text_for_no_condition = speech_token_bt
-
-                # Forward pass (Unconditional)
+        # Unconditional CFG branch: no audio/speaker condition (and no speech tokens if speech_token_cfg)
+        use_cfg = any(w != 0 for w in cfg_weights)
+        if use_cfg:
+            uncond_condition_btd = torch.zeros_like(condition_btd)
+            uncond_text_bt = torch.zeros_like(speech_token_bt) if self.speech_token_cfg else speech_token_bt
+            uncond_spkr_emb = torch.zeros_like(spkr_embedding_normed)
+        fused = use_cfg and self.fused_cfg
+        if fused:
+            # Both branches stacked along batch: rows [0, B) conditional, [B, 2B) unconditional
+            batch = x.shape[0]
+            fused_condition_btd = torch.cat([condition_btd, uncond_condition_btd], dim=0)
+            fused_text_bt = torch.cat([speech_token_bt, uncond_text_bt], dim=0)
+            fused_padding_mask_bt = torch.cat([padding_mask_bt, padding_mask_bt], dim=0)
+            fused_spkr_emb = torch.cat([spkr_embedding_normed, uncond_spkr_emb], dim=0)
+
+        # Step-invariant DiT inputs (text embedding, condition projection, rope, mask), once per branch
+        query_start = stream.frozen_len if stream is not None else 0
+        if fused:
+            fused_context = self.estimator.prepare_context(fused_condition_btd, fused_text_bt, fused_padding_mask_bt,
+                                                           is_causal, block_pattern, query_start)
+        if not fused or 0 in cfg_weights:
+            cond_context = self.estimator.prepare_context(condition_btd, speech_token_bt, padding_mask_bt,
+                                                          is_causal, block_pattern, query_start)
+        if use_cfg and not fused:
+            uncond_context = self.estimator.prepare_context(uncond_condition_btd, uncond_text_bt, padding_mask_bt,
+                                                            is_causal, block_pattern, query_start)
+
+        def velocity(x, t):
+            if fused and cfg_weight != 0:
+                # Conditional and unconditional branches in a single forward pass
+                dphi_dt, cfg_dphi_dt = self.estimator(
+                    middle_point_btd=torch.cat([x, x], dim=0),
+                    condition_btd=fused_condition_btd,
+                    text=fused_text_bt,
+                    time_step_1d=t.expand(2 * batch),
+                    padding_mask_bt=fused_padding_mask_bt,
+                    spkr_emb_bd=fused_spkr_emb,
+                    is_causal=is_causal,
+                    block_pattern=block_pattern,
+                    stream=stream,
+                    context=fused_context
+                ).chunk(2, dim=0)
+            else:
+                # 1. Forward pass (Conditional)
+                dphi_dt = self.estimator(
+                    middle_point_btd=x,
+                    condition_btd=condition_btd,
+                    text=speech_token_bt,
+                    time_step_1d=t.expand(x.shape[0]),
+                    padding_mask_bt=padding_mask_bt,
+                    spkr_emb_bd=spkr_embedding_normed,
+                    is_causal=is_causal,
+                    block_pattern=block_pattern,
+                    stream=stream,
+                    context=cond_context
+                )
+                if cfg_weight == 0:
+                    return dphi_dt
+
+                # 2. Forward pass (Unconditional)
                 cfg_dphi_dt = self.estimator(
                     middle_point_btd=x,
-                    condition_btd=torch.zeros_like(condition_btd),
-                    text=text_for_no_condition,
-                    time_step_1d=t_current[None],
+                    condition_btd=uncond_condition_btd,
+                    text=uncond_text_bt,
+                    time_step_1d=t.expand(x.shape[0]),
                     padding_mask_bt=padding_mask_bt,
-                    spkr_emb_bd=torch.zeros_like(spkr_embedding_normed),
+                    spkr_emb_bd=uncond_spkr_emb,
                     is_causal=is_causal,
-                    block_pattern=block_pattern
+                    block_pattern=block_pattern,
+                    stream=stream,
+                    context=uncond_context
                 )
-                
-                # Combine conditional and unconditional outputs
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - 
-                           self.inference_cfg_rate * cfg_dphi_dt)
-
-            # Euler Step
-            x = x + dt * dphi_dt
-            
-            # Update time
-            t_current = t_current + dt
-            sol.append(x)
-            
-            # Update dt for the next step
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t_current
-
-        result_btd = sol[-1]
-        return result_btd, current_step2cache
\ No newline at end of file
+
+            # Classifier-Free Guidance (CFG): combine conditional and unconditional outputs
+            return ((1.0 + cfg_weight) * dphi_dt -
+                    cfg_weight * cfg_dphi_dt)
+
+        if last_step_cache is not None:
+            last_step_cache.begin(n_timesteps, x)
+
+        # Iterative Denoising
+        used_steps, prev_update = n_timesteps, None
+        for step in range(1, len(t_span)):
+            # Apply cache if available (overwriting the beginning of the sequence),
+            # then keep the current input for the next streaming chunk
+            if last_step_cache is not None:
+                last_step_cache.restore(step, x)
+                last_step_cache.store(step, x)
+
+            cfg_weight = cfg_weights[step - 1]
+            dt = t_span[step] - t_span[step - 1]
+            x_prev = x
+            x = ode_solver.step(velocity, x, t_span[step - 1], dt)
+
+            # Straight trajectory: cover the rest of the schedule with one final step
+            if controller is not None and step < n_timesteps:
+                update = (x - x_prev) / dt
+                if controller.converged(step, update, prev_update):
+                    cfg_weight = cfg_weights[step]
+                    x = ode_solver.step(velocity, x, t_span[step], 1 - t_span[step])
+                    used_steps = step + 1
+                    break
+                prev_update = update
+
+        if controller is not None:
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            # Cost is tracked per DiT evaluation, whatever the solver and guidance schedule
+            controller.record(requested_steps, n_timesteps, used_steps, x.shape[0] * x.shape[1],
+                              time.time() - start_time,
+                              guided_function_evals(cfg_weights[:used_steps], ode_solver.nfe_per_step))
+
+        return x, last_step_cache
\ No newline at end of file
@@ -0,0 +1,59 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Classifier-free guidance schedules for flow sampling.
+
+A schedule assigns a CFG weight to every ODE step. Steps with weight 0 skip the
+unconditional DiT branch entirely, so guiding only part of the trajectory saves
+evaluations. Schedules are given as strings (CLI / API friendly):
+
+    None, "" or "all"   every step uses the model's default rate (inference_cfg_rate)
+    "none"              no guidance at all
+    "2-7"               steps 2..7 (1-based, inclusive) use the default rate, others 0
+    "2-7:0.5"           steps 2..7 use weight 0.5, others 0
+    "0,0.7,0.7,0.5"     one weight per step (the count must equal the number of steps)
+"""
+
+from typing import List, Optional, Sequence
+
+
+def guidance_weights(spec: Optional[str], n_timesteps: int, default_rate: float) -> List[float]:
+    """Per-step CFG weights of schedule `spec` for `n_timesteps` steps."""
+    spec = (spec or "").strip().lower()
+    if spec in ("", "all"):
+        return [float(default_rate)] * n_timesteps
+    if spec == "none":
+        return [0.0] * n_timesteps
+
+    try:
+        if "," in spec:
+            weights = [float(w) for w in spec.split(",")]
+            if len(weights) != n_timesteps:
+                raise ValueError(f"{len(weights)} weights given for {n_timesteps} steps")
+            return weights
+
+        window, _, weight = spec.partition(":")
+        weight = float(weight) if weight else float(default_rate)
+        first, _, last = window.partition("-")
+        first, last = int(first), int(last or first)
+        if not 1 <= first <= last:
+            raise ValueError("window must satisfy 1 <= first <= last")
+    except ValueError as e:
+        raise ValueError(f"Invalid guidance schedule {spec!r}: {e}") from None
+    return [weight if first <= step <= last else 0.0 for step in range(1, n_timesteps + 1)]
+
+
+def guided_function_evals(weights: Sequence[float], nfe_per_step: int = 1) -> int:
+    """DiT evaluations (both CFG branches counted) of a sampling call with per-step `weights`."""
+    return sum((2 if w != 0 else 1) * nfe_per_step for w in weights)
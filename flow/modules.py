@@ -61,16 +61,20 @@ class ConvPositionEmbedding(nn.Module):
             x: Input tensor of shape (batch, seq_len, dim)
             mask: Boolean mask of shape (batch, seq_len)
         """
-        if mask is not None:
-            mask = mask[..., None]
-            x = x.masked_fill(~mask, 0.)
-
         x = rearrange(x, 'b n d -> b d n')
-        x = self.conv1d(x)
+        if mask is None:
+            x = self.conv1d(x)
+        else:
+            # Zero padded frames before every conv so they never leak into valid frames
+            mask_b1n = mask[:, None, :]
+            for layer in self.conv1d:
+                if isinstance(layer, nn.Conv1d):
+                    x = x.masked_fill(~mask_b1n, 0.)
+                x = layer(x)
         out = rearrange(x, 'b d n -> b n d')
 
         if mask is not None:
-            out = out.masked_fill(~mask, 0.)
+            out = out.masked_fill(~mask[..., None], 0.)
 
         return out
 
@@ -136,8 +140,10 @@ class GRN(nn.Module):
         self.gamma = nn.Parameter(torch.zeros(1, 1, dim))
         self.beta = nn.Parameter(torch.zeros(1, 1, dim))
 
-    def forward(self, x):
-        Gx = torch.norm(x, p=2, dim=1, keepdim=True)
+    def forward(self, x, mask=None):
+        # Padded frames (mask False) are excluded from the norm over time
+        x_valid = x if mask is None else x.masked_fill(~mask[..., None], 0.)
+        Gx = torch.norm(x_valid, p=2, dim=1, keepdim=True)
         Nx = Gx / (Gx.mean(dim=-1, keepdim=True) + 1e-6)
         return self.gamma * (x * Nx) + self.beta + x
 
@@ -157,15 +163,17 @@ class ConvNeXtV2Block(nn.Module):
         self.grn = GRN(intermediate_dim)
         self.pwconv2 = nn.Linear(intermediate_dim, dim)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         residual = x
+        if mask is not None:
+            x = x.masked_fill(~mask[..., None], 0.)
         x = x.transpose(1, 2)  # (b, n, d) -> (b, d, n)
         x = self.dwconv(x)
         x = x.transpose(1, 2)  # (b, d, n) -> (b, n, d)
         x = self.norm(x)
         x = self.pwconv1(x)
         x = self.act(x)
-        x = self.grn(x)
+        x = self.grn(x, mask)
         x = self.pwconv2(x)
         return residual + x
 
@@ -231,6 +239,41 @@ class FeedForward(nn.Module):
 # Attention Mechanisms
 # -----------------------------------------------------------------------------
 
+class BlockCausalMask:
+    """
+    Block-causal attention mask kept in compact form instead of a dense (B, H, T, T) tensor.
+
+    Query row i attends to keys [0, row_limits[i]) that are not padding. `chunks` groups
+    the queries by block as (q_start, q_end, k_end), so each block only touches the
+    key prefix it can see (see utils/block_mask_util.query_chunks).
+    """
+
+    def __init__(self, row_limits: torch.Tensor, key_padding_mask_bt: torch.Tensor, chunks):
+        self.row_limits = row_limits
+        self.key_padding_mask_bt = key_padding_mask_bt
+        self.chunks = chunks
+
+    def chunk_mask(self, q_start, q_end, k_end):
+        """Broadcastable boolean mask (B, 1, q_end - q_start, k_end) of one query chunk."""
+        keys = torch.arange(k_end, device=self.row_limits.device)
+        mask_qk = keys[None, :] < self.row_limits[q_start:q_end, None]
+        return mask_qk[None, None] & self.key_padding_mask_bt[:, None, None, :k_end]
+
+
+def block_sparse_attention(query, key, value, mask: BlockCausalMask):
+    """
+    Scaled dot-product attention evaluated block by block over the allowed key prefixes,
+    so memory scales with block size x key length instead of T x T per head.
+    """
+    out = query.new_empty(query.shape[:-1] + (value.shape[-1],))
+    for q_start, q_end, k_end in mask.chunks:
+        out[:, :, q_start:q_end] = F.scaled_dot_product_attention(
+            query[:, :, q_start:q_end], key[:, :, :k_end], value[:, :, :k_end],
+            attn_mask=mask.chunk_mask(q_start, q_end, k_end), dropout_p=0.0, is_causal=False
+        )
+    return out
+
+
 class AttnProcessorCausalV2:
     def __init__(self):
         pass
@@ -242,6 +285,7 @@ class AttnProcessorCausalV2:
             padding_mask: Optional[torch.Tensor] = None,
             rope=None,
             attn_mask=None,
+            kv_cache=None,
     ) -> torch.Tensor:
         
         batch_size = x.shape[0]
@@ -267,9 +311,16 @@ class AttnProcessorCausalV2:
         key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
         value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
+        # Incremental streaming: prepend the cached keys/values of frozen frames
+        if kv_cache is not None:
+            key, value = kv_cache.update(key, value)
+
         # Scaled Dot Product Attention
         # is_causal=False because masking is handled explicitly via attn_mask
-        x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=0.0, is_causal=False)
+        if isinstance(attn_mask, BlockCausalMask):
+            x = block_sparse_attention(query, key, value, attn_mask)
+        else:
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=0.0, is_causal=False)
         
         # Reshape back: (batch, heads, seq, dim) -> (batch, seq, inner_dim)
         x = x.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
@@ -338,6 +389,7 @@ class AttentionV2(nn.Module):
             rope=None,
             c_rope=None,
             attn_mask=None,
+            kv_cache=None,
     ) -> torch.Tensor:
         if c is not None:
             # Note: The current flow logic mainly uses self-attention without 'c' here,
@@ -345,7 +397,8 @@ class AttentionV2(nn.Module):
             return self.processor(self, x, c=c, padding_mask=padding_mask, rope=rope, c_rope=c_rope,
                                   attn_mask=attn_mask)
         else:
-            return self.processor(self, x, padding_mask=padding_mask, rope=rope, attn_mask=attn_mask)
+            return self.processor(self, x, padding_mask=padding_mask, rope=rope, attn_mask=attn_mask,
+                                  kv_cache=kv_cache)
 
 
 # -----------------------------------------------------------------------------
@@ -368,7 +421,7 @@ class DiTBlockCausalV2(nn.Module):
         self.ff_norm = nn.LayerNorm(dim, elementwise_affine=False, eps=1e-6)
         self.ff = FeedForward(dim=dim, mult=ff_mult, dropout=dropout, approximate="tanh")
 
-    def forward(self, x, t, padding_mask=None, rope=None, attn_mask=None):
+    def forward(self, x, t, padding_mask=None, rope=None, attn_mask=None, kv_cache=None):
         """
         Args:
             x: Noised input tensor
@@ -376,12 +429,14 @@ class DiTBlockCausalV2(nn.Module):
             padding_mask: Mask for padding
             rope: Rotary positional embeddings
             attn_mask: Attention mask (e.g., for causality or blocking)
+            kv_cache: Cached keys/values of earlier frames (incremental streaming)
         """
         # 1. Pre-norm & Modulation for Attention
         norm, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.attn_norm(x, emb=t)
 
         # 2. Attention
-        attn_output = self.attn(x=norm, padding_mask=padding_mask, rope=rope, attn_mask=attn_mask)
+        attn_output = self.attn(x=norm, padding_mask=padding_mask, rope=rope, attn_mask=attn_mask,
+                                kv_cache=kv_cache)
 
         # 3. Residual Connection (modulated)
         x = x + gate_msa.unsqueeze(1) * attn_output
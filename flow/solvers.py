@@ -0,0 +1,132 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+ODE solvers for flow-matching sampling.
+
+A solver advances x along dx/dt = velocity(x, t) over one interval of the time
+schedule per `step` call. `velocity` is one (CFG-combined) DiT evaluation, so a
+solver's cost per step is its `nfe_per_step`; higher-order solvers reach the
+quality of 10 Euler steps with fewer steps and fewer evaluations in total.
+
+Solvers may keep state between steps (multistep methods), so a new instance is
+created for every sampling call via `get_solver`.
+"""
+
+from typing import Callable, Dict, Type
+
+import torch
+
+Velocity = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+
+SOLVERS: Dict[str, Type["ODESolver"]] = {}
+
+
+def register_solver(name: str):
+    """Class decorator adding a solver to `SOLVERS` under `name`."""
+    def wrap(cls):
+        cls.name = name
+        SOLVERS[name] = cls
+        return cls
+    return wrap
+
+
+def get_solver(name: str) -> "ODESolver":
+    """Fresh instance of a registered solver."""
+    if name not in SOLVERS:
+        raise ValueError(f"Unknown ODE solver: {name}. Supported: {tuple(SOLVERS)}")
+    return SOLVERS[name]()
+
+
+def num_function_evals(name: str, n_timesteps: int) -> int:
+    """Number of DiT evaluations (per CFG branch) for `n_timesteps` steps of solver `name`."""
+    if name not in SOLVERS:
+        raise ValueError(f"Unknown ODE solver: {name}. Supported: {tuple(SOLVERS)}")
+    return SOLVERS[name].nfe_per_step * n_timesteps
+
+
+class ODESolver:
+    name = None
+    nfe_per_step = 1
+
+    def step(self, velocity: Velocity, x: torch.Tensor, t: torch.Tensor, dt: torch.Tensor) -> torch.Tensor:
+        """Advance x from time t to t + dt."""
+        raise NotImplementedError
+
+
+@register_solver("euler")
+class EulerSolver(ODESolver):
+    """First order; one evaluation per step."""
+    nfe_per_step = 1
+
+    def step(self, velocity, x, t, dt):
+        return x + dt * velocity(x, t)
+
+
+@register_solver("heun")
+class HeunSolver(ODESolver):
+    """Second order (explicit trapezoid): Euler predictor, averaged slope corrector."""
+    nfe_per_step = 2
+
+    def step(self, velocity, x, t, dt):
+        k1 = velocity(x, t)
+        k2 = velocity(x + dt * k1, t + dt)
+        return x + 0.5 * dt * (k1 + k2)
+
+
+@register_solver("midpoint")
+class MidpointSolver(ODESolver):
+    """Second order: slope at the Euler-predicted midpoint of the interval."""
+    nfe_per_step = 2
+
+    def step(self, velocity, x, t, dt):
+        k1 = velocity(x, t)
+        return x + dt * velocity(x + 0.5 * dt * k1, t + 0.5 * dt)
+
+
+@register_solver("rk4")
+class RK4Solver(ODESolver):
+    """Classic fourth-order Runge-Kutta."""
+    nfe_per_step = 4
+
+    def step(self, velocity, x, t, dt):
+        half = 0.5 * dt
+        k1 = velocity(x, t)
+        k2 = velocity(x + half * k1, t + half)
+        k3 = velocity(x + half * k2, t + half)
+        k4 = velocity(x + dt * k3, t + dt)
+        return x + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+@register_solver("dpm_multistep")
+class DPMMultistepSolver(ODESolver):
+    """
+    Second-order multistep in the style of DPM-Solver++(2M): reuses the previous
+    step's velocity for a linear correction, so it costs one evaluation per step.
+    For the linear flow-matching path this is the variable-step Adams-Bashforth-2
+    update; the first step falls back to Euler.
+    """
+    nfe_per_step = 1
+
+    def __init__(self):
+        self.prev_velocity = None
+        self.prev_dt = None
+
+    def step(self, velocity, x, t, dt):
+        v = velocity(x, t)
+        if self.prev_velocity is None:
+            update = v
+        else:
+            update = v + (dt / (2 * self.prev_dt)) * (v - self.prev_velocity)
+        self.prev_velocity, self.prev_dt = v, dt
+        return x + dt * update
@@ -0,0 +1,267 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Incremental streaming for the block-causal DiT.
+
+`inference_with_cache` re-runs the DiT over the whole utterance for every chunk
+and only pins the ODE state of already emitted frames (FlowStepCache), so per-chunk cost grows
+with the utterance. Here emitted frames are frozen instead: for every DiT call of
+the sampling loop (ODE step x solver stage x CFG branch) the attention keys/values
+of frozen frames are kept per layer, and a chunk only computes the new frames.
+
+Frozen frames keep the hidden states they had when they were computed, i.e. the
+frames that were in the future at that time are not seen again (the old path
+recomputed them with the frozen ODE state). The token embedding is still computed
+over the full sequence because its GRN normalizes over time, but only once per chunk
+(see DiT.prepare_context).
+"""
+
+from typing import List, Optional
+
+import torch
+
+
+class _LayerKV:
+    """Keys/values (B, H, T, D) of frozen frames for one attention layer."""
+
+    def __init__(self):
+        self.key = None
+        self.value = None
+        self.pending_key = None
+        self.pending_value = None
+
+    def update(self, key, value):
+        """Remembers the active frames' keys/values and returns them with the frozen ones prepended."""
+        self.pending_key, self.pending_value = key, value
+        if self.key is None:
+            return key, value
+        return torch.cat([self.key, key], dim=2), torch.cat([self.value, value], dim=2)
+
+    def commit(self, num_frames):
+        """Freezes the first `num_frames` active frames of the last update."""
+        if num_frames <= 0:
+            return
+        key = self.pending_key[:, :, :num_frames]
+        value = self.pending_value[:, :, :num_frames]
+        if self.key is None:
+            self.key, self.value = key, value
+        else:
+            self.key = torch.cat([self.key, key], dim=2)
+            self.value = torch.cat([self.value, value], dim=2)
+
+    def nbytes(self):
+        if self.key is None:
+            return 0
+        return self.key.numel() * self.key.element_size() * 2
+
+
+class _CallCache:
+    """State of one DiT call position of the sampling loop."""
+
+    def __init__(self, num_layers):
+        self.layers = [_LayerKV() for _ in range(num_layers)]
+        # DiT inputs of the last frozen frames, left context of the conv position embedding
+        self.x_tail = None
+        self.pending_x = None
+
+    def left_context(self, x):
+        if self.x_tail is None:
+            return x[:, :0]
+        return self.x_tail
+
+    def record_input(self, x):
+        self.pending_x = x
+
+    def commit(self, num_frames, context_frames):
+        for layer in self.layers:
+            layer.commit(num_frames)
+        if num_frames <= 0:
+            return
+        x = self.pending_x[:, :num_frames]
+        if self.x_tail is not None:
+            x = torch.cat([self.x_tail, x], dim=1)
+        self.x_tail = x[:, -context_frames:]
+
+    def nbytes(self):
+        tail = 0 if self.x_tail is None else self.x_tail.numel() * self.x_tail.element_size()
+        return sum(layer.nbytes() for layer in self.layers) + tail
+
+
+class DiTStreamState:
+    """
+    Per-utterance cache of `DiT.forward_incremental`. Every chunk must issue the same
+    sequence of DiT calls (same solver, steps, CFG mode and guidance schedule), matched by position.
+    """
+
+    # Receptive field of ConvPositionEmbedding: two convs of kernel 31
+    context_frames = 30
+
+    def __init__(self):
+        self.frozen_len = 0
+        self.calls: List[_CallCache] = []
+        self.call_index = 0
+
+    def begin_chunk(self):
+        self.call_index = 0
+
+    def next_call(self, num_layers) -> _CallCache:
+        if self.call_index == len(self.calls):
+            if self.frozen_len > 0:
+                raise RuntimeError("Incremental flow streaming requires the same DiT call sequence for every chunk.")
+            self.calls.append(_CallCache(num_layers))
+        call = self.calls[self.call_index]
+        self.call_index += 1
+        return call
+
+    def commit(self, num_frames):
+        """Freezes the first `num_frames` frames computed by the last chunk."""
+        for call in self.calls:
+            call.commit(num_frames, self.context_frames)
+        self.frozen_len += max(num_frames, 0)
+
+    def nbytes(self):
+        return sum(call.nbytes() for call in self.calls)
+
+
+class FlowStepCache:
+    """
+    Per-step ODE states of the previous chunk for the re-computing streaming path
+    (`Flow.inference_with_cache` with `last_step_cache`).
+
+    Before every ODE step the first `length` frames of `x` are overwritten with the
+    state the previous chunk had at that step, and the current state is stored for
+    the next chunk. States live in one buffer (steps, B, frames, D) that is reused
+    across chunks and only grows (with headroom) when the utterance outgrows it; pass
+    `max_frames` when the final length is known to allocate it once.
+    Offline rendering passes no cache and stores nothing.
+    """
+
+    def __init__(self, max_frames: Optional[int] = None):
+        self.max_frames = max_frames
+        self.buffer: Optional[torch.Tensor] = None
+        # Frames of the stored states restored by the next chunk
+        self.length = 0
+        self.restore_len = 0
+
+    def begin(self, n_timesteps, x):
+        """Starts a chunk: makes room for `n_timesteps` states shaped like `x`, keeping the stored frames."""
+        self.restore_len = self.length
+        buffer = self.buffer
+        if buffer is not None:
+            if (buffer.shape[0], buffer.shape[1], buffer.shape[3]) != (n_timesteps, x.shape[0], x.shape[2]):
+                raise RuntimeError("The flow step cache requires the same steps and shape for every chunk.")
+            if x.shape[1] <= buffer.shape[2]:
+                return
+        capacity = max(x.shape[1], self.max_frames or 0, 2 * buffer.shape[2] if buffer is not None else 0)
+        self.buffer = x.new_empty(n_timesteps, x.shape[0], capacity, x.shape[2])
+        if buffer is not None and self.length > 0:
+            self.buffer[:, :, :self.length] = buffer[:, :, :self.length]
+
+    def restore(self, step, x):
+        """Overwrites the frames fixed by the previous chunk with its state at `step` (1-based)."""
+        num_frames = min(x.shape[1], self.restore_len)
+        if num_frames > 0:
+            x[:, :num_frames] = self.buffer[step - 1, :, :num_frames]
+
+    def store(self, step, x):
+        self.buffer[step - 1, :, :x.shape[1]] = x
+        self.length = x.shape[1]
+
+    def trim(self, override_len):
+        """Keeps only the first `override_len` frames (prompt included) for the next chunk."""
+        self.length = max(0, min(self.length, override_len))
+
+    def nbytes(self):
+        if self.buffer is None:
+            return 0
+        return self.buffer.numel() * self.buffer.element_size()
+
+
+class FlowStreamingSession:
+    """
+    Incremental block-causal flow inference for one utterance.
+
+    Each `step` receives all speech tokens so far and first freezes the mel frames
+    up to `commit_len` (counted with the prompt, as `override_len` of the cached path)
+    from the previous step; only the remaining frames are computed. The returned mel
+    covers the whole utterance without the prompt, like `Flow.inference_with_cache`.
+    """
+
+    def __init__(self,
+                 flow,
+                 prompt_token,
+                 prompt_feat,
+                 embedding,
+                 block_pattern,
+                 n_timesteps=10,
+                 solver="euler",
+                 guidance=None):
+        self.flow = flow
+        self.prompt_token = prompt_token
+        self.prompt_feat = prompt_feat
+        self.embedding = embedding
+        self.block_pattern = block_pattern
+        self.n_timesteps = n_timesteps
+        self.solver = solver
+        self.guidance = guidance
+        self.state = DiTStreamState()
+        self.frozen_mel: Optional[torch.Tensor] = None
+        self.last_mel: Optional[torch.Tensor] = None
+
+    @torch.inference_mode()
+    def step(self, token, commit_len=0):
+        """
+        Args:
+            token: All speech tokens so far, (1, T).
+            commit_len: Frames (prompt included) of the previous result to freeze.
+
+        Returns:
+            torch.Tensor: Mel without the prompt part, (1, mel_dim, T_mel).
+        """
+        flow, state = self.flow, self.state
+        if self.last_mel is not None:
+            commit_len = max(state.frozen_len, min(commit_len, state.frozen_len + self.last_mel.shape[1]))
+            newly_frozen = commit_len - state.frozen_len
+            state.commit(newly_frozen)
+            frozen = self.last_mel[:, :newly_frozen]
+            self.frozen_mel = frozen if self.frozen_mel is None else torch.cat([self.frozen_mel, frozen], dim=1)
+        state.begin_chunk()
+
+        token, mel_cond_btd, padding_mask_bt, prompt_feat_len = flow._prepare_utterance(
+            token, self.prompt_token, self.prompt_feat
+        )
+        if mel_cond_btd.shape[1] <= state.frozen_len:
+            raise ValueError("Incremental flow streaming received no new frames.")
+        condition_btd, spkr_embedding_normed = flow._build_condition(mel_cond_btd, self.embedding)
+
+        self.last_mel, _ = flow.do_sample(
+            token,
+            mel_cond_btd,
+            condition_btd,
+            padding_mask_bt,
+            spkr_embedding_normed,
+            True,
+            self.block_pattern,
+            self.n_timesteps,
+            None,
+            self.solver,
+            stream=state,
+            guidance=self.guidance
+        )
+        mel_btd = self.last_mel if self.frozen_mel is None else torch.cat([self.frozen_mel, self.last_mel], dim=1)
+        return mel_btd[:, prompt_feat_len:].permute(0, 2, 1)
+
+    def cache_nbytes(self):
+        """Memory held by the frozen keys/values and conv context."""
+        return self.state.nbytes()
@@ -25,6 +25,8 @@ from utils import file_utils, seed_util
 from utils import tts_model_util, yaml_util
 from transformers import AutoTokenizer, LlamaForCausalLM
 from llm.glmtts import GLMTTS
+from llm.quantization import quantize_llama
+from flow.solvers import SOLVERS
 from utils.audio import mel_spectrogram
 from functools import partial
 # --- Global Constants ---
@@ -78,7 +80,10 @@ def _assert_shape_and_get_len(token):
     token_len = torch.tensor([token.shape[1]], dtype=torch.int32).to(token.device)
     return token_len
 
-def load_frontends(speech_tokenizer, sample_rate=24000, use_phoneme=False, frontend_dir="frontend"):
+def make_feat_extractor(sample_rate=24000):
+    """
+    Prompt mel extractor matching the vocoder of `sample_rate` (50 Hz frames, 80 bins).
+    """
     if sample_rate == 32000:
         feat_extractor = partial(mel_spectrogram, sampling_rate=sample_rate, hop_size=640, n_fft=2560, num_mels=80, win_size=2560, fmin=0, fmax=8000, center=False)
         print("Configured for 32kHz frontend.")
@@ -87,6 +92,11 @@ def load_frontends(speech_tokenizer, sample_rate=24000, use_phoneme=False, front
         print("Configured for 24kHz frontend.")
     else:
         raise ValueError(f"Unsupported sampling_rate: {sample_rate}")
+    return feat_extractor
+
+
+def load_frontends(speech_tokenizer, sample_rate=24000, use_phoneme=False, frontend_dir="frontend"):
+    feat_extractor = make_feat_extractor(sample_rate)
 
     glm_tokenizer = AutoTokenizer.from_pretrained(
         os.path.join('ckpt', 'vq32k-phoneme-tokenizer'), trust_remote_code=True
@@ -117,6 +127,7 @@ def local_llm_forward(
 ):
     """
     Single LLM forward pass.
+    `llm` may be a GLMTTS model or a llm.engine.DecodeEngine wrapping one.
     """
     prompt_text_token_len = _assert_shape_and_get_len(prompt_text_token)
     tts_text_token_len = _assert_shape_and_get_len(tts_text_token)
@@ -137,17 +148,51 @@ def local_llm_forward(
     return tts_speech_token[0].tolist()
 
 
-def local_flow_forward(flow, token_list, prompt_speech_tokens, speech_feat, embedding):
+def local_flow_forward(flow, token_list, prompt_speech_tokens, speech_feat, embedding,
+                       n_timesteps=10, solver="euler", guidance=None, vocode=True):
     """
-    Single Flow forward pass.
+    Single Flow forward pass. With `vocode=False` only the mel is returned (wav is None).
     """
     wav, full_mel = flow.token2wav_with_cache(
         token_list,
+        n_timesteps=n_timesteps,
         prompt_token=prompt_speech_tokens,
         prompt_feat=speech_feat,
         embedding=embedding,
+        solver=solver,
+        guidance=guidance,
+        vocode=vocode,
+    )
+    return (wav.detach().cpu() if wav is not None else None), full_mel
+
+
+def local_vocode_batch(flow, mels, max_batch_size=8):
+    """
+    Vocodes the mels of several segments together (padded batches, see utils/vocoder_batch.py).
+    """
+    wavs = flow.vocode_batch(mels, max_batch_size=max_batch_size)
+    return [wav.detach().cpu() for wav in wavs]
+
+
+def local_flow_batch_forward(flow, token_lists, prompt_speech_tokens, speech_feat, embedding,
+                             n_timesteps=10, solver="euler", max_batch_size=8, guidance=None,
+                             vocoder_batch_size=None):
+    """
+    Flow forward for several segments sharing one prompt, rendered in batches.
+    """
+    count = len(token_lists)
+    wavs, full_mels = flow.token2wav_batch(
+        token_lists,
+        prompt_token=[prompt_speech_tokens] * count,
+        prompt_feat=[speech_feat] * count,
+        embedding=[embedding] * count,
+        n_timesteps=n_timesteps,
+        solver=solver,
+        max_batch_size=max_batch_size,
+        guidance=guidance,
+        vocoder_batch_size=vocoder_batch_size,
     )
-    return wav.detach().cpu(), full_mel
+    return [wav.detach().cpu() for wav in wavs], full_mels
 
 
 # --- Helper Function: Get Prompt from Cache ---
@@ -222,10 +267,19 @@ def generate_long(
     local_llm_forward=local_llm_forward,
     local_flow_forward=local_flow_forward,
     use_phoneme=False,
+    local_flow_batch_forward=None,
+    local_vocode_batch=None,
 ):
+    """
+    Synthesizes `text_info` segment by segment. With `local_flow_batch_forward`, the flow
+    stage of all segments runs batched after the last LLM call instead of per segment.
+    Otherwise, with `local_vocode_batch`, the flow still runs per segment but the mels are
+    vocoded together at the end.
+    """
     outputs = []
     full_mels = []
     output_token_list = []
+    segment_tokens = []
     uttid = text_info[0]
     syn_text = text_info[1]
     text_tn_dict = {
@@ -275,15 +329,22 @@ def generate_long(
         )
 
         output_token_list.extend(token_list_res)
+        segment_tokens.append(token_list_res)
 
         # Flow Inference
-        output, full_mel = local_flow_forward(
-            flow=flow,
-            token_list=token_list_res,
-            prompt_speech_tokens=flow_prompt_token,
-            speech_feat=speech_feat,
-            embedding=embedding
-        )
+        if local_flow_batch_forward is None:
+            flow_kwargs = {"vocode": False} if local_vocode_batch is not None else {}
+            output, full_mel = local_flow_forward(
+                flow=flow,
+                token_list=token_list_res,
+                prompt_speech_tokens=flow_prompt_token,
+                speech_feat=speech_feat,
+                embedding=embedding,
+                **flow_kwargs
+            )
+            outputs.append(output)
+            if full_mel is not None:
+                full_mels.append(full_mel)
 
         # Update Cache
         if cache is not None:
@@ -291,9 +352,17 @@ def generate_long(
             cache_text_token.append(tts_text_token)
             cache_speech_token.append(token_list_res)
 
-        outputs.append(output)
-        if full_mel is not None:
-            full_mels.append(full_mel)
+    # Batched Flow Inference (segments only depend on their own tokens and the shared prompt)
+    if local_flow_batch_forward is not None and segment_tokens:
+        outputs, full_mels = local_flow_batch_forward(
+            flow=flow,
+            token_lists=segment_tokens,
+            prompt_speech_tokens=flow_prompt_token,
+            speech_feat=speech_feat,
+            embedding=embedding
+        )
+    elif local_vocode_batch is not None and full_mels:
+        outputs = local_vocode_batch(flow=flow, mels=full_mels)
 
     tts_speech = torch.concat(outputs, dim=1)
     tts_mel = torch.concat(full_mels, dim=-1) if full_mels else None
@@ -302,7 +371,8 @@ def generate_long(
 
 
 def jsonl_generate(
-    data_name, folder_path, sample_rate=24000, seed=0, use_cache=True, use_phoneme=False
+    data_name, folder_path, sample_rate=24000, seed=0, use_cache=True, use_phoneme=False,
+    flow_solver="euler", flow_steps=10, flow_batch_size=1, flow_guidance=None, vocoder_batch_size=1
 ):
     # Dataset path resolution
     jsonl_path = os.path.join("examples", data_name + ".jsonl")
@@ -357,6 +427,16 @@ def jsonl_generate(
                     speech_feat=speech_feat,
                     device=DEVICE,
                     use_phoneme=use_phoneme,
+                    local_flow_forward=partial(local_flow_forward, n_timesteps=flow_steps, solver=flow_solver,
+                                               guidance=flow_guidance),
+                    local_flow_batch_forward=partial(
+                        local_flow_batch_forward, n_timesteps=flow_steps, solver=flow_solver,
+                        max_batch_size=flow_batch_size, guidance=flow_guidance,
+                        vocoder_batch_size=vocoder_batch_size if vocoder_batch_size > 1 else None
+                    ) if flow_batch_size > 1 else None,
+                    local_vocode_batch=partial(
+                        local_vocode_batch, max_batch_size=vocoder_batch_size
+                    ) if vocoder_batch_size > 1 else None,
                 )
                 f_out.write(
                     json.dumps(text_tn_dict, ensure_ascii=False, indent=2) + "\n"
@@ -381,17 +461,20 @@ def jsonl_generate(
                 # Optional: raise e # Uncomment to stop on first error
 
 
-def load_models(use_phoneme=False, sample_rate=24000):
-    # Load Speech Tokenizer
-    speech_tokenizer_path = os.path.join("ckpt", "speech_tokenizer")
-    _model, _feature_extractor = yaml_util.load_speech_tokenizer(
-        speech_tokenizer_path
-    )
-    speech_tokenizer = SpeechTokenizer(_model, _feature_extractor)
+AUDIO_HEAD_MODES = ("on", "off", "full")
 
-    # Load Frontends
-    frontend, text_frontend = load_frontends(speech_tokenizer, sample_rate=sample_rate, use_phoneme=use_phoneme)
 
+def load_llm(frontend, llm_quantization=None, kv_cache_quantization=None, audio_head="on"):
+    """
+    Load the GLMTTS LLM from ckpt/llm.
+    `llm_quantization` ("int8" on CPU, "int4") quantizes the decoder layers after loading;
+    `kv_cache_quantization` ("int8") sets the storage format of its paged KV caches.
+    `audio_head` selects the decode head (see GLMTTS.enable_audio_head): "on" projects and
+    normalises over the audio tokens plus eoa only, "full" does the same but cuts the RAS
+    nucleus on full-vocabulary probabilities, "off" decodes over the full vocabulary.
+    """
+    if audio_head not in AUDIO_HEAD_MODES:
+        raise ValueError(f"Unknown audio_head mode: {audio_head}. Supported: {AUDIO_HEAD_MODES}")
     llama_path = os.path.join("ckpt", "llm")
 
     llm = GLMTTS(
@@ -400,11 +483,39 @@ def load_models(use_phoneme=False, sample_rate=24000):
     llm.llama = LlamaForCausalLM.from_pretrained(
         llama_path, dtype=torch.float32
     ).to(DEVICE)
+    if llm_quantization:
+        quantize_llama(llm.llama, llm_quantization)
+        logging.info(f"LLM decoder layers quantized ({llm_quantization}).")
 
     llm.llama_embedding = llm.llama.model.embed_tokens
+    llm.kv_cache_quantization = kv_cache_quantization
 
     special_token_ids = get_special_token_ids(frontend.tokenize_fn)
     llm.set_runtime_vars(special_token_ids=special_token_ids)
+    if audio_head != "off":
+        # Decode over the audio tokens only; inference never accepts text tokens
+        llm.enable_audio_head(full_normalizer=audio_head == "full")
+    return llm
+
+
+def load_shared_models(use_phoneme=False, sample_rate=24000, llm_quantization=None, kv_cache_quantization=None,
+                       audio_head="on"):
+    """
+    Loads everything except the vocoder: frontends (for `sample_rate`), speech tokenizer,
+    LLM and the flow model. The flow model is the same for every output sample rate.
+    """
+    # Load Speech Tokenizer
+    speech_tokenizer_path = os.path.join("ckpt", "speech_tokenizer")
+    _model, _feature_extractor = yaml_util.load_speech_tokenizer(
+        speech_tokenizer_path
+    )
+    speech_tokenizer = SpeechTokenizer(_model, _feature_extractor)
+
+    # Load Frontends
+    frontend, text_frontend = load_frontends(speech_tokenizer, sample_rate=sample_rate, use_phoneme=use_phoneme)
+
+    llm = load_llm(frontend, llm_quantization=llm_quantization, kv_cache_quantization=kv_cache_quantization,
+                   audio_head=audio_head)
 
     flow_ckpt = os.path.join("ckpt", "flow", "flow.pt")
     flow_config = os.path.join("ckpt", "flow", "config.yaml")
@@ -412,7 +523,21 @@ def load_models(use_phoneme=False, sample_rate=24000):
         flow_ckpt, flow_config, DEVICE
     )
 
-    token2wav = tts_model_util.Token2Wav(flow, sample_rate=sample_rate, device=DEVICE)
+    return frontend, text_frontend, speech_tokenizer, llm, flow
+
+
+def load_models(use_phoneme=False, sample_rate=24000, llm_quantization=None, kv_cache_quantization=None,
+                vocoder_serving=False, audio_head="on"):
+    frontend, text_frontend, speech_tokenizer, llm, flow = load_shared_models(
+        use_phoneme=use_phoneme,
+        sample_rate=sample_rate,
+        llm_quantization=llm_quantization,
+        kv_cache_quantization=kv_cache_quantization,
+        audio_head=audio_head,
+    )
+
+    token2wav = tts_model_util.Token2Wav(flow, sample_rate=sample_rate, device=DEVICE,
+                                         serving_vocoder=vocoder_serving)
 
     return frontend, text_frontend, speech_tokenizer, llm, token2wav
 
@@ -426,13 +551,36 @@ if __name__ == "__main__":
     parser.add_argument("--use_cache", action="store_true", default=True)
     parser.add_argument("--use_phoneme", action="store_true", default=False)
     parser.add_argument("--sample_rate", type=int, default=24000)
+    parser.add_argument("--llm_quantization", choices=["int8", "int4"], default=None,
+                        help="Quantize the LLM decoder layers (int8: CPU only)")
+    parser.add_argument("--kv_cache_quantization", choices=["int8"], default=None,
+                        help="Store the LLM KV cache as int8 with per-head scales")
+    parser.add_argument("--audio_head", choices=list(AUDIO_HEAD_MODES), default="on",
+                        help="Decode head: on (audio tokens only), full (same, RAS nucleus on full-vocabulary "
+                             "probabilities), off (full vocabulary, as before the sliced head)")
+    parser.add_argument("--flow_solver", choices=list(SOLVERS), default="euler",
+                        help="ODE solver for flow sampling")
+    parser.add_argument("--flow_steps", type=int, default=10,
+                        help="Flow ODE steps (DiT evaluations = steps x solver NFE per step)")
+    parser.add_argument("--flow_batch_size", type=int, default=1,
+                        help="Render up to this many text segments per flow batch (1: one by one)")
+    parser.add_argument("--flow_guidance", type=str, default=None,
+                        help="CFG schedule, e.g. '2-7' or '0,0.7,0.7,...' (default: every step, see flow/guidance.py)")
+    parser.add_argument("--vocoder_serving", action="store_true", default=False,
+                        help="Use the folded/frozen vocoder build (see tools/build_serving_vocoder.py)")
+    parser.add_argument("--vocoder_batch_size", type=int, default=1,
+                        help="Vocode the text segments of an item together in padded batches of this size (1: one by one)")
 
     args = parser.parse_args()
 
     # Load Models
     frontend, text_frontend, speech_tokenizer, llm, flow = load_models(
         use_phoneme=args.use_phoneme,
-        sample_rate=args.sample_rate
+        sample_rate=args.sample_rate,
+        llm_quantization=args.llm_quantization,
+        kv_cache_quantization=args.kv_cache_quantization,
+        vocoder_serving=args.vocoder_serving,
+        audio_head=args.audio_head,
     )
 
     # Create Output Directory
@@ -444,5 +592,7 @@ if __name__ == "__main__":
 
     # Run Inference
     jsonl_generate(
-        args.data, folder_path, sample_rate=args.sample_rate, use_cache=args.use_cache, use_phoneme=args.use_phoneme
+        args.data, folder_path, sample_rate=args.sample_rate, use_cache=args.use_cache, use_phoneme=args.use_phoneme,
+        flow_solver=args.flow_solver, flow_steps=args.flow_steps, flow_batch_size=args.flow_batch_size,
+        flow_guidance=args.flow_guidance, vocoder_batch_size=args.vocoder_batch_size
     )
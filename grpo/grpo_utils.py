@@ -42,7 +42,7 @@ def batch_inference(
     ):
     """
     Enhanced batch inference that generates n samples at once.
-    Uses batch inference with dynamic left-padding and attention masking for all cases.
+    All sequences decode together over a paged KV cache; `left_pad_id` is kept for compatibility.
     """
     bsz = len(batch['uttid'])
     generated_token_ids = []
@@ -88,95 +88,55 @@ def batch_inference(
             all_prefix_tokens.append(prefix_token)
             all_uttids.append(uttid)
     
-    # Batch process with dynamic left-padding (moved outside the loops)
+    # Batch process over a paged KV cache: each sequence keeps its own block table,
+    # so no padding is needed and finished sequences simply leave the batch
     batch_size = len(all_input_tokens)
-    
-    # Find max length in the batch
-    max_len = max(len(tokens) for tokens in all_input_tokens)
-    # import pdb; pdb.set_trace()
-    # Create padded input tensor (pad to max_len only, no fixed padding)
-    padded_input_tokens = torch.full(
-        (batch_size, max_len), 
-        left_pad_id, 
-        dtype=torch.long, 
-        device=device
-    )
-    
-    # Fill in the actual tokens (left-padded to max_len)
-    for i, tokens in enumerate(all_input_tokens):
-        pad_length = max_len - len(tokens)
-        if pad_length > 0:
-            # Left pad with left_pad_id, then fill actual tokens
-            padded_input_tokens[i, pad_length:] = tokens
-        else:
-            # No padding needed
-            padded_input_tokens[i, :] = tokens
-    # import pdb; pdb.set_trace()
-    # Create attention mask: 0 for padding, 1 for real tokens
-    attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long, device=device)
-    for i, tokens in enumerate(all_input_tokens):
-        pad_length = max_len - len(tokens)
-        attention_mask[i, pad_length:] = 1  # Real tokens get attention
-    
-    # Get embeddings
-    # lm_input = self.llama_embedding(llm_input_token_pad)
-    inputs_embeds = model.llama_embedding(padded_input_tokens)
+    block_size = 16
+    num_blocks = sum(math.ceil((len(tokens) + max_gen_len) / block_size) for tokens in all_input_tokens)
+    kv_cache = model.create_kv_cache(num_blocks=num_blocks, block_size=block_size)
+    runner = model.create_runner(kv_cache)
+
+    inputs_embeds = [model.llama_embedding(tokens.to(torch.long)) for tokens in all_input_tokens]
     
     # Batch generation with early stopping per sample
     generated_sequences = [[] for _ in range(batch_size)]
-    finished = [False] * batch_size
-    past_key_values = None
-    current_attention_mask = attention_mask.clone()
+    active = list(range(batch_size))
+    sampler = model.sampler
+    window = sampler.new_window(batch_size, device)
+    use_ras = sample_method == "ras"
+    # Top-k sampling here never stops on EOS (matches the previous ignore_eos=True behaviour)
+    ban_eos = torch.full((batch_size,), not use_ras, dtype=torch.bool, device=device)
     
     for step in range(max_gen_len):
-        if all(finished):
+        if not active:
             break
             
         # Forward pass
-        model_input = {
-            "inputs_embeds": inputs_embeds,
-            "attention_mask": current_attention_mask,
-            "output_hidden_states": True,
-            "return_dict": True,
-            "use_cache": True,
-            "past_key_values": past_key_values
-        }
+        hidden = runner.forward(active, inputs_embeds)
+        logp = runner.compute_logits(hidden).log_softmax(dim=-1)  # [num_active, vocab_size]
         
-        outputs = model.llama(**model_input)
-        past_key_values = outputs['past_key_values']
-        logits = outputs['logits'][:, -1]  # [batch_size, vocab_size]
+        # Sample next tokens for all active sequences at once
+        local = sampler.sample(logp, window, ban_eos[:len(active)], use_ras, sampling)
+        window = sampler.update_window(window, local)
+        tokens = runner.to_vocab(local)
         
-        # Sample next tokens for each sequence
-        next_tokens = []
-        for i in range(batch_size):
-            if finished[i]:
-                next_tokens.append(model.pad)  # Use pad token for finished sequences
-                continue
-                
-            logp = logits[i].log_softmax(dim=-1)
-            
-            if sample_method == "ras":
-                next_token = model.sampling_ids_ras(logp, generated_sequences[i], sampling).item()
-                # next_token = model.sampling_ids_ras(logp, generated_sequences[i], sampling, topp, temperature).item()
-            else:
-                # Default to topk sampling
-                next_token = model.sampling_ids(logp, sampling, 1).item()
-            
+        still_active = []
+        keep_rows = []
+        for row, (i, next_token) in enumerate(zip(active, tokens.tolist())):
             if next_token == model.eoa:
-                finished[i] = True
-                next_tokens.append(model.pad)  # Use pad token
+                kv_cache.free(i)
             else:
                 generated_sequences[i].append(next_token)
-                next_tokens.append(next_token)
+                still_active.append(i)
+                keep_rows.append(row)
         
         # Prepare next iteration inputs
-        next_token_tensor = torch.tensor(next_tokens, device=device).unsqueeze(1)
-        next_token_embeds = model.llama_embedding(next_token_tensor)
-        inputs_embeds = next_token_embeds
-        
-        # Extend attention mask
-        new_attention = torch.ones((batch_size, 1), dtype=torch.long, device=device)
-        current_attention_mask = torch.cat([current_attention_mask, new_attention], dim=1)
+        active = still_active
+        if active:
+            keep_rows = torch.tensor(keep_rows, device=device)
+            tokens = tokens[keep_rows]
+            window = window[keep_rows]
+            inputs_embeds = list(model.llama_embedding(tokens[:, None]).unbind(0))
     
     # Convert generated sequences to tensors and collect results
     for i in range(batch_size):
@@ -199,7 +159,8 @@ def rollout(
     num_answer_per_question: int,
     reward_function: Callable,
     device: torch.device,
-    info_dict: dict
+    info_dict: dict,
+    flow=None
 ) -> List[Episode]:
     '''
         batch = {
@@ -220,6 +181,25 @@ def rollout(
                                                                                       temperature=generation_conf['temperature'],
                                                                                       spk=info_dict.get('spk', None),
                                                                                       )
+    # With a Token2Wav, render all responses in padded flow batches up front; otherwise
+    # the reward function runs the flow for each response itself. Empty responses and
+    # a failed batch are left to the reward function, which scores failures with 0
+    response_audios = [None] * bsz
+    if flow is not None:
+        rendered = [idx for idx in range(bsz) if len(generated_token_ids_list[idx]) > 0]
+        questions = [idx // num_answer_per_question for idx in rendered]
+        try:
+            wavs, _ = flow.token2wav_batch(
+                [(generated_token_ids_list[idx] - model.ats).tolist() for idx in rendered],
+                prompt_token=[batch['prompt_speech_token'][i].unsqueeze(0) for i in questions],
+                prompt_feat=[batch['speech_feat'][i] for i in questions],
+                embedding=[batch['embedding'][i].unsqueeze(0) for i in questions],
+            ) if rendered else ([], None)
+            for idx, wav in zip(rendered, wavs):
+                response_audios[idx] = wav.detach().cpu()
+        except Exception as e:
+            print("batched rendering failed, rendering per response:", e)
+
     # prepare the output episodes
     episodes = []
     for i in range(bsz // num_answer_per_question):
@@ -248,6 +228,7 @@ def rollout(
                 target_audio=batch['prompt_speech'][i] if 'prompt_speech' in batch else None,
                 ref_text=batch['text'][i],
                 emotion=batch['emotion'][i],
+                response_audio=response_audios[idx],
             )
 
             episode = Episode(
@@ -84,11 +84,13 @@ def reward_function_server(
     ref_text: str,
     emotion: torch.Tensor,
     flow,
-    server_url="http://172.18.104.111:808"
+    server_url="http://172.18.104.111:808",
+    response_audio: Optional[torch.Tensor] = None
 ) -> Dict[str, Any]:
-    # 1. 生成 audio 文件并保存
+    # 1. 生成 audio 文件并保存（rollout 已批量渲染时直接使用 response_audio）
     try:
-        response_audio, full_mel = local_flow_forward(flow, response_token, prompt_speech_token, speech_feat, embedding)
+        if response_audio is None:
+            response_audio, full_mel = local_flow_forward(flow, response_token, prompt_speech_token, speech_feat, embedding)
         uid = uuid.uuid4()
         save_path = f'{CURRENT_DIR}/temp_samples/{uttid}_{uid}.wav'
         torchaudio.save(save_path, response_audio, sample_rate)
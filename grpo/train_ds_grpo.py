@@ -327,6 +327,6 @@ if __name__ == '__main__':
         dist.barrier()
         group_join = dist.new_group(backend="gloo", timeout=datetime.timedelta(seconds=args.timeout))
         executor.train_one_epoc(model, optimizer, scheduler, train_data_loader, None, writer, info_dict,
-                                group_join, ref_model=ref_model, reward_func=reward_func)
+                                group_join, ref_model=ref_model, reward_func=reward_func, flow=flow)
         dist.destroy_process_group(group_join)
 
@@ -0,0 +1,488 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Continuous-batching decode engine for GLMTTS.
+
+Requests are admitted into the in-flight batch at token boundaries and retired
+as soon as they emit EOA, so concurrent speech-token generations share a single
+forward pass per decoding step instead of each running the model at batch size 1.
+KV memory comes from a shared PagedKVCache: admission is gated on free blocks,
+and when the pool runs dry the most recently admitted sequence is preempted
+(its blocks are freed and it is recomputed once memory is available again).
+
+With `prefill_chunk_size` set, prompts are prefilled in chunks of at most that
+many tokens per step, packed into the same forward pass as the decode tokens of
+the running sequences. A long prompt (e.g. a `generate_long` input carrying its
+history) then no longer stalls every in-flight decode for a whole prefill.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import torch
+
+from llm.glmtts import GLMTTS
+from llm.kv_cache import PagedKVCache
+from llm.prefix_cache import PrefixCache
+
+
+class EngineOverloadedError(RuntimeError):
+    """Raised by `DecodeEngine.submit` when a request cannot be queued."""
+
+
+@dataclass
+class SamplingParams:
+    """Per-sequence sampling settings, mirroring the arguments of GLMTTS.inference."""
+
+    sample_method: str = "ras"
+    sampling: int = 25
+    beam_size: int = 1
+    max_token_text_ratio: float = 20
+    min_token_text_ratio: float = 2
+
+
+@dataclass
+class Sequence:
+    """State of one request inside the engine."""
+
+    seq_id: int
+    input_ids: torch.Tensor  # (1, L), built by GLMTTS.build_input_ids
+    min_len: int
+    max_len: int
+    params: SamplingParams
+    future: Future
+    out_tokens: List[int] = field(default_factory=list)
+    # Token sampled at the previous step that has not been fed to the model yet
+    pending_token: Optional[int] = None
+    # Rolling repetition window used by the RAS sampler, (1, win_size)
+    window: Optional[torch.Tensor] = None
+    arrival_time: float = field(default_factory=time.time)
+    num_preemptions: int = 0
+    # Leading tokens taken from the prefix cache at the last admission
+    num_cached: int = 0
+    # Tokens to compute before decoding starts (chunked prefill only)
+    prefill_tokens: List[int] = field(default_factory=list)
+
+    @property
+    def num_generated(self) -> int:
+        return len(self.out_tokens)
+
+    def prefill_ids(self) -> List[int]:
+        """Tokens to (re)compute on admission: the prompt plus anything generated before preemption."""
+        ids = self.input_ids[0].tolist() + self.out_tokens
+        if self.pending_token is not None:
+            ids.append(self.pending_token)
+        return ids
+
+
+class DecodeEngine:
+    """
+    Scheduler-driven decode engine.
+
+    Each call to `step` first admits waiting requests that fit into the free KV
+    blocks (prefilling them together in one ragged forward pass), then runs one
+    batched decode step for every running sequence. With chunked prefill, admitted
+    requests instead prefill up to `prefill_chunk_size` tokens per step (oldest
+    first) alongside that decode step. Finished sequences are removed from the
+    batch immediately, returning their blocks to the pool.
+
+    The engine exposes `inference` with the same signature as `GLMTTS.inference`,
+    so it can be passed anywhere an `llm` is expected (e.g. `generate_long`).
+    """
+
+    def __init__(
+        self,
+        llm: GLMTTS,
+        max_batch_size: int = 8,
+        kv_cache: Optional[PagedKVCache] = None,
+        kv_cache_memory_mb: float = 1024,
+        kv_block_size: int = 16,
+        max_waiting: Optional[int] = None,
+        enable_prefix_cache: bool = False,
+        prefix_cache_memory_mb: Optional[float] = None,
+        prefill_chunk_size: Optional[int] = None,
+    ):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.max_waiting = max_waiting
+        # Prefill token budget per step (None: prefill whole prompts on admission)
+        self.prefill_chunk_size = prefill_chunk_size
+
+        if kv_cache is None:
+            kv_cache = llm.create_kv_cache(memory_budget_mb=kv_cache_memory_mb, block_size=kv_block_size)
+        if enable_prefix_cache and kv_cache.prefix_cache is None:
+            max_blocks = kv_cache.blocks_for_memory(prefix_cache_memory_mb) if prefix_cache_memory_mb else None
+            PrefixCache(kv_cache, max_blocks=max_blocks)
+        self.kv_cache = kv_cache
+        self.runner = llm.create_runner(kv_cache)
+
+        self.waiting: Deque[Sequence] = deque()
+        self.running: List[Sequence] = []
+        # Admitted sequences whose prompt is still being prefilled in chunks
+        self.prefilling: List[Sequence] = []
+
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self.stats: Dict[str, float] = {
+            "finished": 0,
+            "generated_tokens": 0,
+            "steps": 0,
+            "preempted": 0,
+            "rejected": 0,
+            "busy_time": 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def start(self) -> "DecodeEngine":
+        """Start the background decoding thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="glmtts-decode-engine", daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self) -> None:
+        """Stop the background thread and fail all unfinished requests."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_all(RuntimeError("DecodeEngine has been shut down."))
+
+    def submit(
+        self,
+        text: torch.Tensor,
+        prompt_text: torch.Tensor,
+        prompt_speech_token: torch.Tensor,
+        spk: Optional[str] = None,
+        params: Optional[SamplingParams] = None,
+    ) -> Future:
+        """
+        Queue a request. The returned future resolves to the list of generated
+        token ids (absolute ids, i.e. still including the ATS offset).
+
+        Raises EngineOverloadedError if the waiting queue is full or the request
+        could never fit into the KV cache.
+        """
+        params = params or SamplingParams()
+        if params.sample_method not in ("ras", "topk"):
+            raise ValueError(f"Unknown sample_method: {params.sample_method}")
+
+        text_len = text.shape[1]
+        input_ids = self.llm.build_input_ids(
+            text, prompt_text, prompt_text.shape[1], prompt_speech_token, prompt_speech_token.shape[1], spk
+        )
+        seq = Sequence(
+            seq_id=self.kv_cache.new_seq_id(),
+            input_ids=input_ids,
+            min_len=int(text_len * params.min_token_text_ratio),
+            max_len=int(text_len * params.max_token_text_ratio),
+            params=params,
+            future=Future(),
+            window=self.llm.sampler.new_window(1, input_ids.device),
+        )
+        worst_case_blocks = self.kv_cache.blocks_for_tokens(input_ids.shape[1] + seq.max_len)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("DecodeEngine has been shut down.")
+            if worst_case_blocks > self.kv_cache.num_blocks:
+                self.stats["rejected"] += 1
+                raise EngineOverloadedError(
+                    f"Request needs up to {worst_case_blocks} KV blocks, cache only has {self.kv_cache.num_blocks}."
+                )
+            if self.max_waiting is not None and len(self.waiting) >= self.max_waiting:
+                self.stats["rejected"] += 1
+                raise EngineOverloadedError(f"Decode queue is full ({self.max_waiting} waiting requests).")
+            self.waiting.append(seq)
+            self._cond.notify_all()
+        return seq.future
+
+    def inference(
+        self,
+        text: torch.Tensor,
+        text_len: torch.Tensor,
+        prompt_text: torch.Tensor,
+        prompt_text_len: torch.Tensor,
+        prompt_speech_token: torch.Tensor,
+        prompt_speech_token_len: torch.Tensor,
+        beam_size: int = 1,
+        sampling: int = 25,
+        max_token_text_ratio: float = 20,
+        min_token_text_ratio: float = 2,
+        sample_method: str = "ras",
+        spk: str = "tongtong",
+    ) -> torch.Tensor:
+        """
+        Blocking drop-in replacement for GLMTTS.inference.
+        Returns generated audio tokens shifted by the ATS offset, shape (1, T).
+        """
+        params = SamplingParams(
+            sample_method=sample_method,
+            sampling=sampling,
+            beam_size=beam_size,
+            max_token_text_ratio=max_token_text_ratio,
+            min_token_text_ratio=min_token_text_ratio,
+        )
+        future = self.submit(text, prompt_text, prompt_speech_token, spk=spk, params=params)
+        out_tokens = future.result()
+        return torch.tensor([out_tokens], dtype=torch.int64, device=text.device) - self.llm.ats
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return scheduler statistics."""
+        with self._cond:
+            num_waiting = len(self.waiting)
+        busy_time = self.stats["busy_time"]
+        return {
+            "waiting": num_waiting,
+            "running": len(self.running),
+            "prefilling": len(self.prefilling),
+            "max_batch_size": self.max_batch_size,
+            "finished": self.stats["finished"],
+            "generated_tokens": self.stats["generated_tokens"],
+            "steps": self.stats["steps"],
+            "preempted": self.stats["preempted"],
+            "rejected": self.stats["rejected"],
+            "tokens_per_second": self.stats["generated_tokens"] / busy_time if busy_time > 0 else 0.0,
+            "kv_cache": self.kv_cache.usage(),
+            "prefix_cache": self.kv_cache.prefix_cache.get_stats() if self.kv_cache.prefix_cache is not None else None,
+        }
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped and not self.waiting and not self.running and not self.prefilling:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            try:
+                self.step()
+            except Exception as e:
+                logging.exception(f"[DecodeEngine] step failed: {e}")
+                self._fail_all(e)
+            if not self.running and not self.prefilling:
+                # Waiting requests do not fit yet (KV blocks held elsewhere); back off briefly
+                with self._cond:
+                    self._cond.wait(timeout=0.01)
+
+    @torch.inference_mode()
+    def step(self) -> None:
+        """Run one scheduling iteration: admit new requests, then one decode step."""
+        start = time.time()
+
+        self._admit()
+        chunks = self._reserve_decode_slots() if self.running or self.prefilling else []
+        if self.running or chunks:
+            self._decode(chunks)
+
+        self.stats["steps"] += 1
+        self.stats["busy_time"] += time.time() - start
+
+    def _admit(self) -> None:
+        kv = self.kv_cache
+        prefix_cache = kv.prefix_cache
+        # Keep one block per running sequence in reserve so that a fresh admission
+        # does not force a preemption on the very next decode step; partially
+        # prefilled sequences still hold a claim on the rest of their prompt
+        reserved = len(self.running) + sum(
+            kv.blocks_for_tokens(len(seq.prefill_tokens)) - len(kv.block_tables.get(seq.seq_id, ())) + 1
+            for seq in self.prefilling
+        )
+        admitted = []
+        while len(self.running) + len(self.prefilling) + len(admitted) < self.max_batch_size:
+            with self._cond:
+                if not self.waiting:
+                    break
+                seq = self.waiting[0]
+                ids = seq.prefill_ids()
+                with kv.lock:
+                    # Start on the cached prefix first: it may pin blocks that were counted as evictable
+                    blocks = prefix_cache.match(ids) if prefix_cache is not None else []
+                    if blocks:
+                        kv.share_blocks(seq.seq_id, blocks, len(blocks) * kv.block_size)
+                    need = kv.blocks_for_tokens(len(ids)) - len(blocks)
+                    if need + reserved > kv.num_available_blocks:
+                        kv.free(seq.seq_id)
+                        break
+                self.waiting.popleft()
+            seq.num_cached = len(blocks) * kv.block_size
+            if prefix_cache is not None:
+                prefix_cache.record_lookup(len(ids), seq.num_cached)
+            # Preempted sequences are already running from the caller's point of view
+            if seq.future.running() or seq.future.set_running_or_notify_cancel():
+                reserved += need + 1
+                admitted.append(seq)
+            else:
+                kv.free(seq.seq_id)
+
+        if not admitted:
+            return
+        if self.prefill_chunk_size:
+            for seq in admitted:
+                seq.prefill_tokens = seq.prefill_ids()
+            self.prefilling.extend(admitted)
+        else:
+            self._prefill(admitted)
+
+    def _prefill(self, seqs: List[Sequence]) -> None:
+        device = seqs[0].input_ids.device
+        inputs_embeds = [
+            self.llm.llama_embedding(torch.tensor(seq.prefill_ids()[seq.num_cached:], dtype=torch.long, device=device))
+            for seq in seqs
+        ]
+        hidden = self.runner.forward([seq.seq_id for seq in seqs], inputs_embeds)
+        prefix_cache = self.kv_cache.prefix_cache
+        if prefix_cache is not None:
+            for seq in seqs:
+                prefix_cache.insert(seq.seq_id, seq.input_ids[0].tolist())
+        logp = self.runner.compute_logits(hidden).log_softmax(dim=-1)
+        keep = self._accept(seqs, logp)
+        self.running.extend(seq for seq, k in zip(seqs, keep) if k)
+
+    def _schedule_chunks(self) -> List[Tuple[Sequence, int]]:
+        """Split this step's prefill token budget over the prefilling sequences, oldest first."""
+        chunks = []
+        budget = self.prefill_chunk_size or 0
+        for seq in self.prefilling:
+            if budget <= 0:
+                break
+            num_tokens = min(budget, len(seq.prefill_tokens) - self.kv_cache.get_seq_len(seq.seq_id))
+            chunks.append((seq, num_tokens))
+            budget -= num_tokens
+        return chunks
+
+    def _reserve_decode_slots(self) -> List[Tuple[Sequence, int]]:
+        """
+        Preempt the most recently admitted sequences until every running one can grow
+        by a token and this step's prefill chunks fit. Returns the prefill chunks.
+        """
+        kv = self.kv_cache
+        while True:
+            chunks = self._schedule_chunks()
+            need = sum(kv.blocks_needed(1, seq.seq_id) for seq in self.running)
+            need += sum(kv.blocks_needed(n, seq.seq_id) for seq, n in chunks)
+            if need <= kv.num_available_blocks:
+                return chunks
+            # Prefilling sequences were admitted after all running ones
+            victim = self.prefilling.pop() if self.prefilling else self.running.pop()
+            kv.free(victim.seq_id)
+            victim.prefill_tokens = []
+            victim.num_preemptions += 1
+            self.stats["preempted"] += 1
+            with self._cond:
+                self.waiting.appendleft(victim)
+
+    def _decode(self, chunks: List[Tuple[Sequence, int]]) -> None:
+        """One forward pass over the decode tokens of all running sequences plus the prefill chunks."""
+        kv = self.kv_cache
+        seqs = self.running + [seq for seq, _ in chunks]
+        device = seqs[0].input_ids.device
+        inputs_embeds = []
+        if self.running:
+            tokens = torch.tensor([seq.pending_token for seq in self.running], dtype=torch.long, device=device)
+            inputs_embeds.extend(self.llm.llama_embedding(tokens).unsqueeze(1).unbind(0))
+        for seq, num_tokens in chunks:
+            start = kv.get_seq_len(seq.seq_id)
+            chunk = torch.tensor(seq.prefill_tokens[start:start + num_tokens], dtype=torch.long, device=device)
+            inputs_embeds.append(self.llm.llama_embedding(chunk))
+
+        hidden = self.runner.forward([seq.seq_id for seq in seqs], inputs_embeds)
+
+        # Sequences whose prompt is now complete sample their first token in this step
+        prefilled = [seq for seq, _ in chunks if kv.get_seq_len(seq.seq_id) == len(seq.prefill_tokens)]
+        if prefilled:
+            self.prefilling = [seq for seq in self.prefilling if seq not in prefilled]
+            prefix_cache = kv.prefix_cache
+            for seq in prefilled:
+                seq.prefill_tokens = []
+                if prefix_cache is not None:
+                    prefix_cache.insert(seq.seq_id, seq.input_ids[0].tolist())
+        num_rows = len(self.running) + len(prefilled)
+        if num_rows < len(seqs):
+            rows = [row for row, seq in enumerate(seqs) if row < len(self.running) or seq in prefilled]
+            hidden = hidden[torch.tensor(rows, dtype=torch.long, device=device)]
+        if not num_rows:
+            return
+        logp = self.runner.compute_logits(hidden).log_softmax(dim=-1)
+
+        sampled = self.running + prefilled
+        keep = self._accept(sampled, logp)
+        self.running = [seq for seq, k in zip(sampled, keep) if k]
+
+    def _accept(self, seqs: List[Sequence], logp: torch.Tensor) -> List[bool]:
+        """
+        Sample the next token for a batch of sequences in one call and feed it back
+        into their state. Returns, per sequence, False (after resolving its future)
+        when the sequence is finished.
+        """
+        for seq in seqs:
+            if seq.pending_token is not None:
+                seq.out_tokens.append(seq.pending_token)
+                seq.pending_token = None
+
+        device = logp.device
+        sampler = self.llm.sampler
+        window = torch.cat([seq.window for seq in seqs])
+        ban_eos = torch.tensor([seq.num_generated < seq.min_len for seq in seqs], device=device)
+        use_ras = torch.tensor([seq.params.sample_method == "ras" for seq in seqs], device=device)
+        tokens = sampler.sample(logp, window, ban_eos, use_ras, [seq.params.sampling for seq in seqs])
+        window = sampler.update_window(window, tokens)
+        # Single host transfer for the whole batch
+        token_list = self.runner.to_vocab(tokens).tolist()
+
+        keep = []
+        for row, seq in enumerate(seqs):
+            if seq.num_generated < seq.max_len and token_list[row] != self.llm.eoa:
+                seq.pending_token = token_list[row]
+                seq.window = window[row:row + 1]
+                self.stats["generated_tokens"] += 1
+                keep.append(True)
+            else:
+                self._finish(seq)
+                keep.append(False)
+        return keep
+
+    def _finish(self, seq: Sequence) -> None:
+        self.kv_cache.free(seq.seq_id)
+        for token in seq.out_tokens:
+            if not (self.llm.ats <= token <= self.llm.ate):
+                print(f"Warning: Token {token} is out of the valid range ({self.llm.ats}, {self.llm.ate})")
+        self.stats["finished"] += 1
+        seq.future.set_result(list(seq.out_tokens))
+
+    def _fail_all(self, error: Exception) -> None:
+        with self._cond:
+            pending = list(self.waiting) + self.running + self.prefilling
+            self.waiting.clear()
+        self.running = []
+        self.prefilling = []
+        for seq in pending:
+            self.kv_cache.free(seq.seq_id)
+            if not seq.future.done():
+                seq.future.set_exception(error)
@@ -12,13 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import json
+import math
 import yaml
-from typing import Union, Optional, List, Dict, Any
+from typing import Union, Optional, List, Dict, Any, Tuple
 import torch
 import torch.nn as nn
 from transformers import LlamaConfig, LlamaForCausalLM
 from peft import LoraConfig, get_peft_model, TaskType
 from cosyvoice.utils import common
+from llm.kv_cache import PagedKVCache
+from llm.paged_llama import PagedLlamaRunner, SubVocabHead
+from llm.prefix_cache import PrefixCache
+from llm.sampler import BatchSampler
+from llm.speculative import verify_drafts
 
 
 class GLMTTS(nn.Module):
@@ -57,6 +63,15 @@ class GLMTTS(nn.Module):
         self.boa: Optional[int] = None  # Beginning of Audio
         self.eoa: Optional[int] = None  # End of Audio
         self.pad: Optional[int] = None  # Padding Token
+        # Sliced LM head used for decoding (see enable_audio_head)
+        self.decode_head: Optional[SubVocabHead] = None
+        # Shared KV pool with prefix caching (see enable_prefix_cache)
+        self.kv_cache: Optional[PagedKVCache] = None
+        self.prefix_cache: Optional[PrefixCache] = None
+        # Storage format of KV caches created for this model (None or "int8", see create_kv_cache)
+        self.kv_cache_quantization: Optional[str] = None
+        # Default draft proposer for speculative decoding (see llm/speculative.py)
+        self.speculative_proposer = None
 
         self.mode = mode
         
@@ -90,6 +105,9 @@ class GLMTTS(nn.Module):
         
         self.llama = get_peft_model(self.llama, lora_config)
         self.llama.print_trainable_parameters()
+        # PEFT may have wrapped lm_head (modules_to_save); follow the new module
+        if self.decode_head is not None:
+            self.enable_audio_head(full_normalizer=self.decode_head.full_normalizer)
 
     def set_runtime_vars(self, special_token_ids: Dict[str, int]) -> None:
         """
@@ -109,6 +127,62 @@ class GLMTTS(nn.Module):
         self.boa = special_token_ids['boa']
         self.eoa = special_token_ids['eoa']
         self.pad = special_token_ids['pad']
+        self.sampler = BatchSampler(eos_id=self.eoa)
+        self.decode_head = None
+
+    def enable_audio_head(self, full_normalizer: bool = False) -> None:
+        """
+        Decode with an LM head sliced to the audio tokens [ats, ate] plus eoa.
+
+        Logits are then computed and normalised only over the tokens decoding can
+        accept, instead of the full text+audio vocabulary. The sliced rows follow
+        the lm_head weights, so the head stays valid while the model is trained.
+
+        Renormalising over the audio tokens changes RAS when text tokens carry
+        probability mass: the nucleus (top_p) is cut on the audio-only
+        distribution, so it can hold more candidates than over the full
+        vocabulary, and text tokens, which the full-vocabulary decode could draw
+        (and then passed through out of range), are never candidates. With
+        `full_normalizer` the head also returns the mass of the other tokens, so
+        the nucleus is cut on full-vocabulary probabilities as before, at the
+        cost of the full projection; only text tokens stay excluded.
+        """
+        base = self.llama.get_base_model() if hasattr(self.llama, "get_base_model") else self.llama
+        token_ids = list(range(self.ats, self.ate + 1)) + [self.eoa]
+        self.decode_head = SubVocabHead.from_lm_head(base.lm_head, token_ids, full_normalizer=full_normalizer)
+        rest_id = self.decode_head.size if full_normalizer else None
+        self.sampler = BatchSampler(eos_id=self.decode_head.size - 1, rest_id=rest_id)
+
+    def disable_audio_head(self) -> None:
+        """Go back to decoding over the full vocabulary."""
+        self.decode_head = None
+        self.sampler = BatchSampler(eos_id=self.eoa)
+
+    def enable_prefix_cache(self, memory_budget_mb: float = 512, max_cached_mb: Optional[float] = None,
+                            block_size: int = 16) -> None:
+        """
+        Decode through a shared KV pool that keeps the blocks of common prompt
+        prefixes (SFT speaker prompt, registered prompt text) between calls, so
+        later requests only prefill their unique suffix.
+
+        Args:
+            memory_budget_mb: Size of the shared KV pool.
+            max_cached_mb: Cap for cached prefixes within the pool (default: no extra cap).
+            block_size: Tokens per KV block; only full blocks are shared.
+        """
+        self.kv_cache = self.create_kv_cache(memory_budget_mb=memory_budget_mb, block_size=block_size)
+        max_blocks = self.kv_cache.blocks_for_memory(max_cached_mb) if max_cached_mb else None
+        self.prefix_cache = PrefixCache(self.kv_cache, max_blocks=max_blocks)
+
+    def create_kv_cache(self, num_blocks: Optional[int] = None, memory_budget_mb: Optional[float] = None,
+                        block_size: int = 16) -> PagedKVCache:
+        """Paged KV cache for this model in the storage format set by `kv_cache_quantization`."""
+        return PagedKVCache.for_model(self.llama, num_blocks=num_blocks, memory_budget_mb=memory_budget_mb,
+                                      block_size=block_size, quantization=self.kv_cache_quantization)
+
+    def create_runner(self, kv_cache: PagedKVCache) -> PagedLlamaRunner:
+        """Paged runner over `kv_cache`, using the audio head if it is enabled."""
+        return PagedLlamaRunner(self.llama, kv_cache, head=self.decode_head)
 
     def sampling_ids(
         self,
@@ -144,6 +218,45 @@ class GLMTTS(nn.Module):
         """
         return common.ras_sampling(weighted_scores, decoded_tokens, sampling, temperature=1)
 
+    def build_input_ids(
+        self,
+        text: torch.Tensor,
+        prompt_text: torch.Tensor,
+        prompt_text_len: torch.Tensor,
+        prompt_speech_token: torch.Tensor,
+        prompt_speech_token_len: torch.Tensor,
+        spk: Optional[str] = "tongtong",
+    ) -> torch.Tensor:
+        """
+        Build the LLM input ids for one request according to the model mode.
+
+        PRETRAIN/LORA: [Text Prompt, Text, BOA, Speech Prompt]
+        SFT:           [Speaker Prompt, Text Prompt, Text, BOA, Speech Prompt]
+
+        Returns:
+            torch.Tensor: Input ids of shape (1, L).
+        """
+        device = text.device
+
+        # If prompts exist, add the audio start token offset if necessary
+        # (Note: Logic depends on how prompt_speech_token is pre-processed outside)
+        if prompt_speech_token_len != 0 and prompt_text_len != 0:
+            prompt_speech_token = prompt_speech_token + self.ats
+
+        boa_tensor = torch.tensor([self.boa], device=device).unsqueeze(0)
+
+        if self.mode == "SFT":
+            if spk not in self.spk_prompt_dict:
+                raise ValueError(f"Speaker '{spk}' not found in spk_prompt_dict.")
+            spk_prompt_tensor = torch.tensor(self.spk_prompt_dict[spk], device=device).unsqueeze(0)
+            segments = [spk_prompt_tensor, prompt_text, text, boa_tensor, prompt_speech_token]
+        elif self.mode in ["PRETRAIN", "LORA"]:
+            segments = [prompt_text, text, boa_tensor, prompt_speech_token]
+        else:
+            raise ValueError(f"Invalid mode: {self.mode}")
+
+        return torch.cat(segments, dim=1).to(torch.long)
+
     @torch.inference_mode()
     def inference(
         self,
@@ -158,7 +271,10 @@ class GLMTTS(nn.Module):
         max_token_text_ratio: float = 20,
         min_token_text_ratio: float = 2,
         sample_method: str = "ras",
-        spk: str = "tongtong"
+        spk: str = "tongtong",
+        kv_cache: Optional[PagedKVCache] = None,
+        eos_check_interval: Optional[int] = None,
+        proposer=None,
     ) -> torch.Tensor:
         """
         Autoregressive inference loop to generate speech tokens from text.
@@ -170,112 +286,131 @@ class GLMTTS(nn.Module):
             prompt_text_len: Length of prompt text.
             prompt_speech_token: Prompt speech token tensor.
             prompt_speech_token_len: Length of prompt speech tokens.
-            beam_size: Beam size for sampling (default 1).
-            sampling: Top-k value or sampling parameter.
+            beam_size: Beam size for sampling (only 1 is supported).
+            sampling: Top-k value for 'topk' (RAS uses its own fixed top-k).
             max_token_text_ratio: Multiplier to determine max generation length.
             min_token_text_ratio: Multiplier to determine min generation length.
             sample_method: 'ras' or 'topk'.
             spk: Speaker key for SFT mode.
+            kv_cache: Shared paged KV cache. If None, the pool from enable_prefix_cache is used when
+                it has room for the whole request (its blocks are reserved up front), otherwise a private
+                cache sized for this request.
+            eos_check_interval: Read the stop flag back from the device only every N steps;
+                tokens decoded past EOS are trimmed afterwards. Defaults to 8 on CUDA
+                (each check is a device->host sync) and 1 elsewhere.
+            proposer: Draft proposer (llm/speculative.py) for speculative decoding; defaults to
+                `self.speculative_proposer`. Drafts are verified against the same sampling
+                distribution, so the output distribution does not change.
 
         Returns:
             torch.Tensor: Generated audio tokens (shifted by ATS offset).
         """
-        device = text.device
-
-        # 1. Preprocess Prompt Tokens
-        # If prompts exist, add the audio start token offset if necessary
-        # (Note: Logic depends on how prompt_speech_token is pre-processed outside)
-        if prompt_speech_token_len != 0 and prompt_text_len != 0:
-            prompt_speech_token = prompt_speech_token + self.ats
-
-        # 2. Construct Input Embeddings
-        boa_tensor = torch.tensor([self.boa], device=device).unsqueeze(0)
-        
-        if self.mode == "SFT":
-            if spk not in self.spk_prompt_dict:
-                raise ValueError(f"Speaker '{spk}' not found in spk_prompt_dict.")
-            
-            spk_prompt_tensor = torch.tensor(self.spk_prompt_dict[spk], device=device).unsqueeze(0)
-            
-            # Concatenate: [Speaker Prompt, Text Prompt, Text, BOA, Speech Prompt]
-            input_ids = torch.cat([
-                spk_prompt_tensor, 
-                prompt_text, 
-                text, 
-                boa_tensor, 
-                prompt_speech_token
-            ], dim=1).to(torch.long)
-            
-            inputs_embeds = self.llama_embedding(input_ids)
-            
-        elif self.mode in ["PRETRAIN", "LORA"]:
-            # Concatenate: [Text Prompt, Text, BOA, Speech Prompt]
-            input_ids = torch.cat([
-                prompt_text, 
-                text, 
-                boa_tensor, 
-                prompt_speech_token
-            ], dim=1).to(torch.long)
-            
-            inputs_embeds = self.llama_embedding(input_ids)
-        else:
-            raise ValueError(f"Invalid mode: {self.mode}")
+        # 1. Construct Input Embeddings
+        input_ids = self.build_input_ids(
+            text, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len, spk
+        )
+        device = input_ids.device
 
-        # 3. Calculate Generation Bounds
+        # 2. Calculate Generation Bounds
         min_len = int(text_len * min_token_text_ratio)
         max_len = int(text_len * max_token_text_ratio)
+        if sample_method not in ("ras", "topk"):
+            raise ValueError(f"Unknown sample_method: {sample_method}")
 
-        # 4. Step-by-Step Decoding
-        out_tokens = []
-        past_key_values = None
-
-        for i in range(max_len):
-            model_input = {
-                "inputs_embeds": inputs_embeds,
-                "output_hidden_states": True,
-                "return_dict": True,
-                "use_cache": True,
-                "past_key_values": past_key_values
-            }
-
-            outputs = self.llama(**model_input)
-            past_key_values = outputs['past_key_values']
-            
-            # Get logits of the last token
-            logp = outputs['logits'][:, -1].log_softmax(dim=-1)
-                
-            # --- Sampling Logic ---
-            if sample_method == "ras":
-                # Mask the EOS token logit to negative infinity to prevent early stopping
-                # if we haven't reached the minimum length.
-                if i < min_len:
-                    logp[:, self.eoa] = -float('inf')
-                
-                top_ids = self.sampling_ids_ras(
-                    logp.squeeze(dim=0), 
-                    out_tokens, 
-                    sampling
-                ).item()
-            elif sample_method == "topk":
-                top_ids = self.sampling_ids(
-                    logp.squeeze(dim=0), 
-                    sampling, 
-                    beam_size,
-                    ignore_eos=(i < min_len)
-                ).item()
-            else:
-                raise ValueError(f"Unknown sample_method: {sample_method}")
-
-            # Check for End of Audio
-            if top_ids == self.eoa:
-                break
-                
-            out_tokens.append(top_ids)
-            
-            # Prepare input for the next step (auto-regressive)
-            inputs_embeds = self.llama_embedding(torch.LongTensor([top_ids]).to(device))[None]
+        # 3. Step-by-Step Decoding over a paged KV cache
+        prompt_ids = input_ids[0].tolist()
+        proposer = proposer if proposer is not None else self.speculative_proposer
+        # Speculative steps hold up to num_tokens drafts beyond the accepted length
+        num_tokens = len(prompt_ids) + max_len + (getattr(proposer, "num_tokens", 0) if proposer is not None else 0)
+        seq_id, num_cached = None, 0
+        if kv_cache is None and self.kv_cache is not None:
+            # Reserve the whole request in the shared pool, so concurrent requests cannot
+            # run it dry mid-utterance; fall back to a private cache if it has no room
+            seq_id, num_cached = self._reserve(self.kv_cache, prompt_ids, num_tokens)
+            if seq_id is not None:
+                kv_cache = self.kv_cache
+        if kv_cache is None:
+            block_size = 16
+            num_blocks = math.ceil(num_tokens / block_size)
+            kv_cache = self.create_kv_cache(num_blocks=max(1, num_blocks), block_size=block_size)
+        runner = self.create_runner(kv_cache)
+        prefix_cache = kv_cache.prefix_cache
+        if seq_id is None:
+            seq_id = kv_cache.new_seq_id()
+            # Reuse cached KV of a shared prompt prefix, prefill only the rest
+            num_cached = prefix_cache.fork(seq_id, prompt_ids) if prefix_cache is not None else 0
+        inputs_embeds = self.llama_embedding(input_ids[0, num_cached:])
+
+        use_ras = sample_method == "ras"
+        if proposer is not None:
+            num_speech = int(prompt_speech_token_len)
+            history = runner.to_local(input_ids[0, input_ids.shape[1] - num_speech:]).tolist()
+            try:
+                out_tokens = self._decode_speculative(runner, seq_id, inputs_embeds, prompt_ids, history,
+                                                      proposer, min_len, max_len, use_ras, sampling)
+            finally:
+                kv_cache.free(seq_id)
+            return self._finalize_tokens(out_tokens, device)
+
+        window = self.sampler.new_window(1, device)
+        if eos_check_interval is None:
+            eos_check_interval = 8 if device.type == "cuda" else 1
 
-        # 5. Validation and Output Construction
+        # Token buffer, EOS ban and stop flag stay on the device for the whole loop
+        out_buf = torch.full((max_len,), self.eoa, dtype=torch.long, device=device)
+        ban_eos = torch.ones(1, dtype=torch.bool, device=device)
+        no_ban = torch.zeros(1, dtype=torch.bool, device=device)
+        finished = torch.zeros(1, dtype=torch.bool, device=device)
+
+        try:
+            for i in range(max_len):
+                hidden = runner.forward([seq_id], [inputs_embeds])
+                if i == 0 and prefix_cache is not None:
+                    prefix_cache.insert(seq_id, prompt_ids)
+
+                # Get logits of the last token
+                logp = runner.compute_logits(hidden).log_softmax(dim=-1)
+
+                # EOS is masked until the minimum length is reached
+                local = self.sampler.sample(logp, window, ban_eos if i < min_len else no_ban, use_ras, sampling)
+                window = self.sampler.update_window(window, local)
+                token = runner.to_vocab(local)
+                out_buf[i:i + 1] = token
+                finished |= token == self.eoa
+
+                # Check for End of Audio (every few steps; overshoot is trimmed below)
+                if (i + 1) % eos_check_interval == 0 and finished.item():
+                    break
+
+                # Prepare input for the next step (auto-regressive)
+                inputs_embeds = self.llama_embedding(token)
+        finally:
+            kv_cache.free(seq_id)
+
+        # Keep everything before the first EOS
+        out_tokens = out_buf.tolist()
+        if self.eoa in out_tokens:
+            out_tokens = out_tokens[:out_tokens.index(self.eoa)]
+        return self._finalize_tokens(out_tokens, device)
+
+    @staticmethod
+    def _reserve(kv_cache: PagedKVCache, prompt_ids: List[int], num_tokens: int) -> Tuple[Optional[int], int]:
+        """
+        Starts a sequence on the cached prefix of `prompt_ids` in `kv_cache` and reserves
+        the blocks for the rest of its `num_tokens` tokens, all under the cache lock.
+        Returns (seq_id, cached tokens), or (None, 0) if the pool cannot hold it.
+        """
+        prefix_cache = kv_cache.prefix_cache
+        with kv_cache.lock:
+            seq_id = kv_cache.new_seq_id()
+            num_cached = prefix_cache.fork(seq_id, prompt_ids) if prefix_cache is not None else 0
+            if kv_cache.reserve(seq_id, num_tokens - num_cached):
+                return seq_id, num_cached
+            kv_cache.free(seq_id)
+            return None, 0
+
+    def _finalize_tokens(self, out_tokens: List[int], device: torch.device) -> torch.Tensor:
+        # 4. Validation and Output Construction
         # Ensure all tokens are within the valid audio token range
         for token in out_tokens:
             if not (self.ats <= token <= self.ate):
@@ -283,4 +418,83 @@ class GLMTTS(nn.Module):
                 print(f"Warning: Token {token} is out of the valid range ({self.ats}, {self.ate})")
         
         # Return tokens relative to Audio Token Start (ATS)
-        return torch.tensor([out_tokens], dtype=torch.int64, device=device) - self.ats
\ No newline at end of file
+        return torch.tensor([out_tokens], dtype=torch.int64, device=device) - self.ats
+
+    def _decode_speculative(
+        self,
+        runner: PagedLlamaRunner,
+        seq_id: int,
+        inputs_embeds: torch.Tensor,
+        prompt_ids: List[int],
+        history: List[int],
+        proposer,
+        min_len: int,
+        max_len: int,
+        use_ras: bool,
+        sampling: int,
+    ) -> List[int]:
+        """
+        Speculative variant of the decode loop in `inference`.
+
+        Each step feeds the pending token plus the proposer's drafts through the model
+        at once, accepts the drafts that pass rejection sampling against
+        `BatchSampler.target_probs` and rolls the KV cache back past the rejected ones.
+
+        Returns:
+            List[int]: Generated vocabulary ids, without EOS.
+        """
+        kv_cache = runner.kv_cache
+        prefix_cache = kv_cache.prefix_cache
+        device = inputs_embeds.device
+        eos = self.sampler.eos_id
+        win_size = self.sampler.win_size
+        state = proposer.begin(prompt_ids, history)
+        try:
+            hidden = runner.forward([seq_id], [inputs_embeds])
+            if prefix_cache is not None:
+                prefix_cache.insert(seq_id, prompt_ids)
+            logp = runner.compute_logits(hidden).log_softmax(dim=-1)
+            window = self.sampler.new_window(1, device)
+            ban_eos = torch.tensor([min_len > 0], device=device)
+            pending = self.sampler.sample(logp, window, ban_eos, use_ras, sampling)
+            window = self.sampler.update_window(window, pending)
+            out = pending.tolist()
+            state.accept(out, 0)
+
+            while out[-1] != eos and len(out) < max_len:
+                num_drafts = min(proposer.num_tokens, max_len - len(out) - 1)
+                if num_drafts > 0:
+                    drafts, draft_probs = state.propose(num_drafts, device)
+                else:
+                    drafts, draft_probs = pending.new_empty(0), None
+                num_drafts = drafts.shape[0]
+
+                # Score the pending token and all drafts in one pass
+                step_ids = runner.to_vocab(torch.cat([pending, drafts]))
+                hidden = runner.forward([seq_id], [self.llama_embedding(step_ids)], all_positions=True)[0]
+                logp = runner.compute_logits(hidden).log_softmax(dim=-1)       # (K + 1, V)
+
+                # Position j sees the window rolled by the first j drafts and its own EOS ban
+                windows = torch.cat([window[0], drafts]).unfold(0, win_size, 1)
+                ban_eos = len(out) + torch.arange(num_drafts + 1, device=device) < min_len
+                target = self.sampler.target_probs(logp, windows, ban_eos, use_ras, sampling)
+                num_accepted, pending = verify_drafts(target, drafts, draft_probs)
+
+                # The cache holds the pending token and all drafts; drop the rejected ones
+                kv_cache.truncate(seq_id, kv_cache.get_seq_len(seq_id) - (num_drafts - num_accepted))
+                emitted = torch.cat([drafts[:num_accepted], pending])
+                window = torch.cat([window, emitted[None]], dim=1)[:, -win_size:]
+                tokens = emitted.tolist()
+                state.accept(tokens, num_accepted)
+                if eos in tokens:
+                    out.extend(tokens[:tokens.index(eos) + 1])
+                    break
+                out.extend(tokens)
+        finally:
+            state.close()
+
+        if out[-1] == eos:
+            out = out[:-1]
+        if not out:
+            return []
+        return runner.to_vocab(torch.tensor(out, device=device)).tolist()
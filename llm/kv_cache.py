@@ -0,0 +1,377 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Paged KV cache for the Llama backbone.
+
+Keys and values of all sequences live in one preallocated pool of fixed-size
+blocks. Each sequence owns a block table (list of block ids), so growing a
+sequence never reallocates or copies existing cache entries, and memory freed by
+finished sequences is immediately reusable by new ones.
+
+Blocks are reference counted so that full blocks of a common prefix can be
+shared between sequences and a PrefixCache (see llm/prefix_cache.py).
+
+With `quantization="int8"` keys and values are stored as int8 with one scale per
+token and KV head (absmax over head_dim), which holds about 4x (fp32 model) or
+2x (fp16/bf16 model) as many tokens in the same memory. They are dequantized to
+the compute dtype when read.
+"""
+
+import itertools
+import math
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
+import torch
+
+
+class OutOfBlocksError(RuntimeError):
+    """Raised when the block pool cannot satisfy an allocation."""
+
+
+def host_to_device(data, device: torch.device, dtype: torch.dtype = torch.long) -> torch.Tensor:
+    """
+    Copy host-side metadata (a list or CPU tensor) to `device` without stalling the
+    host: on CUDA the copy goes through pinned memory and is queued asynchronously.
+    """
+    tensor = data if isinstance(data, torch.Tensor) else torch.tensor(data, dtype=dtype)
+    if device.type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+KV_QUANT_MODES = ("int8",)
+
+
+class PagedKVCache:
+    """
+    Block manager and storage for a paged KV cache.
+
+    Storage layout per layer is a flat slot array of shape
+    (num_blocks * block_size, num_kv_heads, head_dim); slot `b * block_size + i`
+    holds position `i` of block `b`. Quantized caches keep an additional
+    (num_blocks * block_size, num_kv_heads) scale array per layer.
+    """
+
+    def __init__(
+        self,
+        num_layers: int,
+        num_kv_heads: int,
+        head_dim: int,
+        num_blocks: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float32,
+        device: Union[str, torch.device] = "cpu",
+        quantization: Optional[str] = None,
+    ):
+        assert num_blocks > 0 and block_size > 0
+        if quantization is not None and quantization not in KV_QUANT_MODES:
+            raise ValueError(f"Unknown KV cache quantization: {quantization}. Supported: {KV_QUANT_MODES}")
+        self.num_layers = num_layers
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = torch.device(device)
+        self.quantization = quantization
+
+        num_slots = num_blocks * block_size
+        storage_dtype = torch.int8 if quantization else dtype
+        self.key_cache = torch.zeros(num_layers, num_slots, num_kv_heads, head_dim, dtype=storage_dtype,
+                                     device=self.device)
+        self.value_cache = torch.zeros(num_layers, num_slots, num_kv_heads, head_dim, dtype=storage_dtype,
+                                       device=self.device)
+        if quantization:
+            self.key_scales = torch.zeros(num_layers, num_slots, num_kv_heads, dtype=torch.float32, device=self.device)
+            self.value_scales = torch.zeros(num_layers, num_slots, num_kv_heads, dtype=torch.float32,
+                                            device=self.device)
+
+        self.free_blocks: Deque[int] = deque(range(num_blocks))
+        self.ref_counts: List[int] = [0] * num_blocks
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lens: Dict[int, int] = {}
+        # Blocks promised to a sequence (see reserve) but not allocated yet
+        self.reserved: Dict[int, int] = {}
+        self.num_reserved_blocks = 0
+        self._seq_counter = itertools.count()
+        # Guards all bookkeeping, so one pool can be shared by concurrent decode loops
+        self.lock = threading.RLock()
+        # Set by PrefixCache; its unused blocks are reclaimed when the free list runs dry
+        self.prefix_cache = None
+
+    @classmethod
+    def for_model(
+        cls,
+        llama,
+        num_blocks: Optional[int] = None,
+        memory_budget_mb: Optional[float] = None,
+        block_size: int = 16,
+        dtype: Optional[torch.dtype] = None,
+        device: Optional[Union[str, torch.device]] = None,
+        quantization: Optional[str] = None,
+    ) -> "PagedKVCache":
+        """
+        Create a cache matching a LlamaForCausalLM. Exactly one of `num_blocks`
+        or `memory_budget_mb` must be given; the budget accounts for `quantization`.
+        """
+        config = llama.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        param = next(llama.parameters())
+        dtype = dtype or param.dtype
+        device = device or param.device
+
+        if (num_blocks is None) == (memory_budget_mb is None):
+            raise ValueError("Specify exactly one of num_blocks or memory_budget_mb.")
+        if num_blocks is None:
+            per_block = cls.bytes_per_block(config.num_hidden_layers, num_kv_heads, head_dim, block_size, dtype,
+                                            quantization)
+            num_blocks = max(1, int(memory_budget_mb * 1024 * 1024 // per_block))
+
+        return cls(config.num_hidden_layers, num_kv_heads, head_dim, num_blocks, block_size, dtype, device,
+                   quantization)
+
+    @staticmethod
+    def bytes_per_block(num_layers: int, num_kv_heads: int, head_dim: int, block_size: int,
+                        dtype: torch.dtype, quantization: Optional[str] = None) -> int:
+        """Memory taken by one block (keys and values of all layers, plus scales if quantized)."""
+        if quantization:
+            # int8 values and one fp32 scale per token and head
+            per_head = head_dim + 4
+        else:
+            per_head = head_dim * torch.tensor([], dtype=dtype).element_size()
+        return 2 * num_layers * block_size * num_kv_heads * per_head
+
+    # ------------------------------------------------------------------
+    # Accounting
+    # ------------------------------------------------------------------
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    @property
+    def num_available_blocks(self) -> int:
+        """Free blocks plus blocks the prefix cache could release on demand, minus reservations."""
+        evictable = self.prefix_cache.num_evictable_blocks if self.prefix_cache is not None else 0
+        return len(self.free_blocks) + evictable - self.num_reserved_blocks
+
+    def blocks_for_memory(self, memory_mb: float) -> int:
+        """Number of blocks of this cache that fit into `memory_mb`."""
+        per_block = self.bytes_per_block(self.num_layers, self.num_kv_heads, self.head_dim,
+                                         self.block_size, self.dtype, self.quantization)
+        return int(memory_mb * 1024 * 1024 // per_block)
+
+    def blocks_for_tokens(self, num_tokens: int) -> int:
+        return math.ceil(num_tokens / self.block_size)
+
+    def blocks_needed(self, num_tokens: int, seq_id: Optional[int] = None) -> int:
+        """Number of new blocks required to append `num_tokens` tokens to `seq_id`."""
+        cur_len = self.seq_lens.get(seq_id, 0)
+        cur_blocks = len(self.block_tables.get(seq_id, ()))
+        return max(0, self.blocks_for_tokens(cur_len + num_tokens) - cur_blocks)
+
+    def can_allocate(self, num_tokens: int, seq_id: Optional[int] = None) -> bool:
+        """Whether `num_tokens` more tokens fit (for `seq_id` if it already exists)."""
+        return self.blocks_needed(num_tokens, seq_id) - self.reserved.get(seq_id, 0) <= self.num_available_blocks
+
+    def reserve(self, seq_id: int, num_tokens: int) -> bool:
+        """
+        Promise `seq_id` the blocks for `num_tokens` more tokens, so that concurrent
+        sequences on the same pool cannot take them between the check and the
+        allocation. Returns False (reserving nothing) if they are not available.
+        The reservation is used up by `append_slots` and dropped by `free`.
+        """
+        with self.lock:
+            need = self.blocks_needed(num_tokens, seq_id) - self.reserved.get(seq_id, 0)
+            if need > self.num_available_blocks:
+                return False
+            if need > 0:
+                self.reserved[seq_id] = self.reserved.get(seq_id, 0) + need
+                self.num_reserved_blocks += need
+            else:
+                self.reserved.setdefault(seq_id, 0)
+            return True
+
+    def usage(self) -> Dict[str, float]:
+        per_block = self.bytes_per_block(self.num_layers, self.num_kv_heads, self.head_dim,
+                                         self.block_size, self.dtype, self.quantization)
+        return {
+            "block_size": self.block_size,
+            "quantization": self.quantization,
+            "total_blocks": self.num_blocks,
+            "free_blocks": self.num_free_blocks,
+            "available_blocks": self.num_available_blocks,
+            "used_blocks": self.num_used_blocks,
+            "reserved_blocks": self.num_reserved_blocks,
+            "num_sequences": len(self.block_tables),
+            "total_mb": round(self.num_blocks * per_block / 1024 / 1024, 2),
+            "used_mb": round(self.num_used_blocks * per_block / 1024 / 1024, 2),
+        }
+
+    # ------------------------------------------------------------------
+    # Allocation
+    # ------------------------------------------------------------------
+
+    def new_seq_id(self) -> int:
+        """Return a sequence id that is unique within this cache."""
+        return next(self._seq_counter)
+
+    def append_slots(self, seq_id: int, num_tokens: int) -> None:
+        """
+        Reserve room for `num_tokens` new tokens of `seq_id` (registering the
+        sequence on first use) and advance its length.
+        """
+        with self.lock:
+            need = self.blocks_needed(num_tokens, seq_id)
+            self._check_unreserved(need - min(need, self.reserved.get(seq_id, 0)), seq_id)
+            self._reclaim(need)
+            if need > len(self.free_blocks):
+                raise OutOfBlocksError(
+                    f"Need {need} blocks for sequence {seq_id}, only {len(self.free_blocks)} free."
+                )
+            self._use_reservation(seq_id, need)
+            table = self.block_tables.setdefault(seq_id, [])
+            for _ in range(need):
+                block = self.free_blocks.popleft()
+                self.ref_counts[block] = 1
+                table.append(block)
+            self.seq_lens[seq_id] = self.seq_lens.get(seq_id, 0) + num_tokens
+
+    def append_slots_batch(self, seq_ids: List[int], num_tokens: List[int]) -> None:
+        """Reserve room for a whole batch at once; on failure nothing is allocated."""
+        with self.lock:
+            needs = [self.blocks_needed(n, seq_id) for seq_id, n in zip(seq_ids, num_tokens)]
+            need = sum(needs)
+            extra = sum(n - min(n, self.reserved.get(seq_id, 0)) for seq_id, n in zip(seq_ids, needs))
+            self._check_unreserved(extra)
+            self._reclaim(need)
+            if need > len(self.free_blocks):
+                raise OutOfBlocksError(f"Need {need} blocks for this step, only {len(self.free_blocks)} free.")
+            for seq_id, n in zip(seq_ids, num_tokens):
+                self.append_slots(seq_id, n)
+
+    def share_blocks(self, seq_id: int, blocks: List[int], num_tokens: int) -> None:
+        """
+        Start a new sequence whose first `num_tokens` tokens are the (full) `blocks`
+        of another owner. The blocks are shared read-only; new tokens go to fresh blocks.
+        """
+        assert num_tokens == len(blocks) * self.block_size
+        with self.lock:
+            assert seq_id not in self.block_tables
+            for block in blocks:
+                self.ref_counts[block] += 1
+            self.block_tables[seq_id] = list(blocks)
+            self.seq_lens[seq_id] = num_tokens
+
+    def incref(self, block: int) -> None:
+        with self.lock:
+            self.ref_counts[block] += 1
+
+    def decref(self, block: int) -> None:
+        with self.lock:
+            self.ref_counts[block] -= 1
+            if self.ref_counts[block] == 0:
+                self.free_blocks.append(block)
+
+    def truncate(self, seq_id: int, num_tokens: int) -> None:
+        """Drop all but the first `num_tokens` tokens of a sequence (e.g. rejected draft tokens)."""
+        with self.lock:
+            assert num_tokens <= self.seq_lens.get(seq_id, 0)
+            table = self.block_tables[seq_id]
+            keep = self.blocks_for_tokens(num_tokens)
+            for block in table[keep:]:
+                self.decref(block)
+            # Rolled-back blocks return to the sequence's reservation, if it holds one
+            if seq_id in self.reserved and len(table) > keep:
+                self.reserved[seq_id] += len(table) - keep
+                self.num_reserved_blocks += len(table) - keep
+            del table[keep:]
+            self.seq_lens[seq_id] = num_tokens
+
+    def free(self, seq_id: int) -> None:
+        """Release a sequence; blocks go back to the free list once nothing references them."""
+        with self.lock:
+            for block in self.block_tables.pop(seq_id, []):
+                self.decref(block)
+            self.seq_lens.pop(seq_id, None)
+            self.num_reserved_blocks -= self.reserved.pop(seq_id, 0)
+
+    def _check_unreserved(self, extra: int, seq_id: Optional[int] = None) -> None:
+        """Raises unless `extra` blocks beyond the caller's reservation are free of other reservations."""
+        if extra <= 0 or extra <= len(self.free_blocks) - self.num_reserved_blocks:
+            return
+        if extra > self.num_available_blocks:
+            owner = f" for sequence {seq_id}" if seq_id is not None else " for this step"
+            raise OutOfBlocksError(f"Need {extra} unreserved blocks{owner}, only "
+                                   f"{max(self.num_available_blocks, 0)} available.")
+
+    def _use_reservation(self, seq_id: int, need: int) -> None:
+        if seq_id in self.reserved:
+            used = min(need, self.reserved[seq_id])
+            self.reserved[seq_id] -= used
+            self.num_reserved_blocks -= used
+
+    def _reclaim(self, need: int) -> None:
+        if need > len(self.free_blocks) and self.prefix_cache is not None:
+            self.prefix_cache.evict(need - len(self.free_blocks))
+
+    # ------------------------------------------------------------------
+    # Storage
+    # ------------------------------------------------------------------
+
+    def write(self, layer_idx: int, slots: torch.Tensor, key: torch.Tensor, value: torch.Tensor) -> None:
+        """Store keys/values of shape (N, num_kv_heads, head_dim) into the flat `slots` (N,) of a layer."""
+        if self.quantization is None:
+            self.key_cache[layer_idx][slots] = key.to(self.dtype)
+            self.value_cache[layer_idx][slots] = value.to(self.dtype)
+            return
+        for cache, scales, x in ((self.key_cache, self.key_scales, key), (self.value_cache, self.value_scales, value)):
+            x = x.float()
+            scale = x.abs().amax(dim=-1).clamp(min=1e-8) / 127
+            cache[layer_idx][slots] = (x / scale[..., None]).round().clamp(-127, 127).to(torch.int8)
+            scales[layer_idx][slots] = scale
+
+    def read(self, layer_idx: int, slots: torch.Tensor, dtype: torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Keys and values at `slots` (any shape S), as (*S, num_kv_heads, head_dim) tensors of `dtype`."""
+        key = self.key_cache[layer_idx][slots].to(dtype)
+        value = self.value_cache[layer_idx][slots].to(dtype)
+        if self.quantization is not None:
+            key = key * self.key_scales[layer_idx][slots][..., None].to(dtype)
+            value = value * self.value_scales[layer_idx][slots][..., None].to(dtype)
+        return key, value
+
+    def get_seq_len(self, seq_id: int) -> int:
+        return self.seq_lens.get(seq_id, 0)
+
+    def slot_table(self, seq_ids: List[int], max_len: int) -> torch.Tensor:
+        """
+        Slot indices of positions [0, max_len) for each sequence, shape (B, max_len).
+        Positions beyond a sequence's allocation point to slot 0 and must be masked.
+        """
+        max_blocks = self.blocks_for_tokens(max_len)
+        tables = torch.zeros(len(seq_ids), max_blocks, dtype=torch.long)
+        for row, seq_id in enumerate(seq_ids):
+            table = self.block_tables[seq_id][:max_blocks]
+            tables[row, :len(table)] = torch.tensor(table, dtype=torch.long)
+        tables = host_to_device(tables, self.device)
+        offsets = torch.arange(self.block_size, device=self.device)
+        slots = (tables[:, :, None] * self.block_size + offsets).view(len(seq_ids), -1)
+        return slots[:, :max_len]
@@ -0,0 +1,249 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Llama forward pass over a paged KV cache.
+
+Runs the decoder layers of a (possibly LoRA-wrapped) LlamaForCausalLM directly,
+reading and writing keys/values through PagedKVCache block tables. A single call
+handles a ragged batch: every sequence contributes any number of new tokens
+(a whole prompt for prefill, one token for decode).
+"""
+
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb, repeat_kv
+
+from llm.kv_cache import PagedKVCache, host_to_device
+
+
+class SubVocabHead:
+    """
+    LM head restricted to a subset of the vocabulary.
+
+    Holds a copy of the selected rows of the full head, so logits are only
+    computed for the tokens that can actually be sampled. Sampling works on
+    local indices into `token_ids`; `to_vocab` maps them back to vocabulary ids.
+    Deliberately not an nn.Module so it never shows up in state dicts.
+
+    The copy is tied to the source head: whenever its weights change (optimizer
+    step, `load_state_dict`, checkpoint load, dtype/device move), the rows are
+    sliced again on the next call, so a head enabled on a model that is being
+    trained (GRPO rollouts) always samples from the current policy.
+
+    With `full_normalizer`, one extra column (index `size`) holds the
+    log-sum-exp of all logits outside the head. A softmax over the output then
+    gives the full-vocabulary probabilities of the head's tokens; the sampler
+    counts the column towards normalisation but never draws it (see
+    `BatchSampler.rest_id`). This needs the full projection again, so it is for
+    parity checks rather than serving.
+    """
+
+    def __init__(self, lm_head: nn.Module, token_ids: torch.Tensor, full_normalizer: bool = False):
+        self.lm_head = lm_head
+        self.token_ids = token_ids
+        self.full_normalizer = full_normalizer
+        self.weight: Optional[torch.Tensor] = None
+        self.bias: Optional[torch.Tensor] = None
+        self._source_key = None
+        self._outside: Optional[torch.Tensor] = None
+
+    @classmethod
+    def from_lm_head(cls, lm_head: nn.Module, token_ids: List[int], full_normalizer: bool = False) -> "SubVocabHead":
+        index = torch.tensor(token_ids, dtype=torch.long, device=cls._resolve(lm_head).weight.device)
+        head = cls(lm_head, index, full_normalizer=full_normalizer)
+        head.refresh()
+        return head
+
+    @staticmethod
+    def _resolve(lm_head: nn.Module) -> nn.Module:
+        """The linear layer actually used by `lm_head`."""
+        # PEFT wraps heads listed in `modules_to_save`; slice the copy that is actually used
+        if hasattr(lm_head, "modules_to_save") and not getattr(lm_head, "disable_adapters", False):
+            adapter = lm_head.active_adapter
+            adapter = adapter[0] if isinstance(adapter, (list, tuple)) else adapter
+            if adapter in lm_head.modules_to_save:
+                return lm_head.modules_to_save[adapter]
+            return lm_head.original_module
+        if hasattr(lm_head, "original_module"):
+            return lm_head.original_module
+        return lm_head
+
+    @staticmethod
+    def _key(linear: nn.Module):
+        # In-place updates bump `_version`, reassigned / moved tensors change the storage
+        return tuple((t.data_ptr(), t._version, t.dtype) if t is not None else None
+                     for t in (linear.weight, linear.bias))
+
+    def refresh(self) -> nn.Module:
+        """Slices the rows again if the source head changed since the last call; returns the source."""
+        linear = self._resolve(self.lm_head)
+        key = (id(linear),) + self._key(linear)
+        if key == self._source_key:
+            return linear
+        index = self.token_ids.to(linear.weight.device)
+        self.token_ids = index
+        if self.full_normalizer:
+            outside = torch.ones(linear.weight.shape[0], dtype=torch.bool, device=index.device)
+            outside[index] = False
+            self._outside = outside
+        else:
+            self.weight = linear.weight.detach().index_select(0, index).clone()
+            self.bias = linear.bias.detach().index_select(0, index).clone() if linear.bias is not None else None
+        self._source_key = key
+        return linear
+
+    @property
+    def size(self) -> int:
+        return self.token_ids.shape[0]
+
+    def local_id(self, token_id: int) -> int:
+        """Local index of a vocabulary id that belongs to the head."""
+        return int((self.token_ids == token_id).nonzero()[0, 0])
+
+    def to_vocab(self, local_ids: torch.Tensor) -> torch.Tensor:
+        return self.token_ids[local_ids]
+
+    def to_local(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """Inverse of `to_vocab`; ids outside the head map to -1."""
+        lookup = torch.full((int(self.token_ids.max()) + 1,), -1, dtype=torch.long, device=self.token_ids.device)
+        lookup[self.token_ids] = torch.arange(self.size, device=self.token_ids.device)
+        valid = (token_ids >= 0) & (token_ids < lookup.shape[0])
+        return torch.where(valid, lookup[token_ids.clamp(0, lookup.shape[0] - 1)], -1)
+
+    def __call__(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        linear = self.refresh()
+        if not self.full_normalizer:
+            return F.linear(hidden_states, self.weight, self.bias)
+        logits = linear(hidden_states)
+        rest = logits.float().masked_fill(~self._outside, -float("inf")).logsumexp(dim=-1, keepdim=True)
+        return torch.cat([logits.index_select(-1, self.token_ids), rest.to(logits.dtype)], dim=-1)
+
+
+class PagedLlamaRunner:
+    def __init__(self, llama, kv_cache: PagedKVCache, head: Optional[SubVocabHead] = None):
+        # Unwrap PEFT models; LoRA layers are injected in place so the base modules include them
+        base = llama.get_base_model() if hasattr(llama, "get_base_model") else llama
+        self.model = base.model
+        # Logits come from the restricted head when given, otherwise from the full vocabulary
+        self.lm_head = head if head is not None else base.lm_head
+        self.head = head
+        self.kv_cache = kv_cache
+
+        config = base.config
+        self.num_heads = config.num_attention_heads
+        self.num_kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        self.head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        self.num_kv_groups = self.num_heads // self.num_kv_heads
+
+    def forward(self, seq_ids: List[int], inputs_embeds: List[torch.Tensor],
+                all_positions: bool = False) -> torch.Tensor:
+        """
+        Append new tokens for a batch of sequences and run the model.
+
+        Args:
+            seq_ids: Sequence ids in the KV cache (registered on first use).
+            inputs_embeds: Per-sequence embeddings of the new tokens, each (q_len, hidden).
+            all_positions: Return the hidden states of every new token instead of the last one.
+
+        Returns:
+            torch.Tensor: Final hidden state of the last new token of each sequence, (B, hidden),
+            or of all new tokens, (B, max_q_len, hidden), right padded.
+        """
+        kv = self.kv_cache
+        batch = len(seq_ids)
+        device = inputs_embeds[0].device
+
+        past_lens = [kv.get_seq_len(seq_id) for seq_id in seq_ids]
+        q_lens = [emb.shape[0] for emb in inputs_embeds]
+        # Allocates for the whole batch or raises OutOfBlocksError leaving the cache untouched
+        kv.append_slots_batch(seq_ids, q_lens)
+
+        q_max = max(q_lens)
+        ctx_max = max(p + q for p, q in zip(past_lens, q_lens))
+
+        # All metadata is derived from host-side lengths, so building it never waits on the device
+        past_t = host_to_device(past_lens, device)
+        q_len_t = host_to_device(q_lens, device)
+        valid_rows = host_to_device([row for row, q_len in enumerate(q_lens) for _ in range(q_len)], device)
+        valid_cols = host_to_device([col for q_len in q_lens for col in range(q_len)], device)
+        q_valid = (valid_rows, valid_cols)                                      # (N,), (N,)
+        q_idx = torch.arange(q_max, device=device)
+        # Padded queries reuse the last valid position so every attention row is non-empty
+        position_ids = past_t[:, None] + torch.minimum(q_idx[None, :], (q_len_t - 1)[:, None])
+
+        slots = kv.slot_table(seq_ids, ctx_max)                                  # (B, L)
+        new_slots = slots[valid_rows, position_ids[q_valid]]                    # (N,)
+        key_idx = torch.arange(ctx_max, device=device)
+        attn_mask = (key_idx[None, None, :] <= position_ids[:, :, None])[:, None]  # (B, 1, Q, L)
+
+        hidden_states = torch.zeros(batch, q_max, inputs_embeds[0].shape[-1],
+                                    dtype=inputs_embeds[0].dtype, device=device)
+        for row, emb in enumerate(inputs_embeds):
+            hidden_states[row, :emb.shape[0]] = emb
+
+        position_embeddings = self.model.rotary_emb(hidden_states, position_ids)
+
+        for layer_idx, layer in enumerate(self.model.layers):
+            residual = hidden_states
+            hidden_states = layer.input_layernorm(hidden_states)
+            hidden_states = self._attention(layer.self_attn, layer_idx, hidden_states, position_embeddings,
+                                            q_valid, new_slots, slots, attn_mask)
+            hidden_states = residual + hidden_states
+
+            residual = hidden_states
+            hidden_states = layer.post_attention_layernorm(hidden_states)
+            hidden_states = residual + layer.mlp(hidden_states)
+
+        if all_positions:
+            return self.model.norm(hidden_states)
+        last = hidden_states[torch.arange(batch, device=device), q_len_t - 1]
+        return self.model.norm(last)
+
+    def _attention(self, attn, layer_idx, hidden_states, position_embeddings,
+                   q_valid, new_slots, slots, attn_mask):
+        batch, q_len, _ = hidden_states.shape
+        shape = (batch, q_len, -1, self.head_dim)
+        query = attn.q_proj(hidden_states).view(shape).transpose(1, 2)
+        key = attn.k_proj(hidden_states).view(shape).transpose(1, 2)
+        value = attn.v_proj(hidden_states).view(shape).transpose(1, 2)
+
+        cos, sin = position_embeddings
+        query, key = apply_rotary_pos_emb(query, key, cos, sin)
+
+        # Write the new keys/values into their slots, then gather each sequence's full context
+        self.kv_cache.write(layer_idx, new_slots, key.transpose(1, 2)[q_valid], value.transpose(1, 2)[q_valid])
+        key, value = self.kv_cache.read(layer_idx, slots, query.dtype)
+        key = key.transpose(1, 2)                                    # (B, H_kv, L, D)
+        value = value.transpose(1, 2)
+        key = repeat_kv(key, self.num_kv_groups)
+        value = repeat_kv(value, self.num_kv_groups)
+
+        out = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask)
+        out = out.transpose(1, 2).reshape(batch, q_len, -1)
+        return attn.o_proj(out)
+
+    def compute_logits(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Logits over the full vocabulary, or over the head's sub-vocabulary if one is set."""
+        return self.lm_head(hidden_states)
+
+    def to_vocab(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """Map ids sampled from `compute_logits` to vocabulary ids."""
+        return self.head.to_vocab(token_ids) if self.head is not None else token_ids
+
+    def to_local(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """Map vocabulary ids to the id space of `compute_logits` (-1 if not covered)."""
+        return self.head.to_local(token_ids) if self.head is not None else token_ids
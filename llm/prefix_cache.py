@@ -0,0 +1,197 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Prefix KV cache on top of PagedKVCache.
+
+Prompts of GLMTTS requests often start with the same tokens: the SFT speaker
+prompt from `spk_prompt_dict`, followed by the prompt text of a registered voice.
+This cache keeps the KV blocks of such prefixes in a radix tree whose edges are
+block-sized token chunks, so a new request forks the matching blocks and only
+prefills its unique suffix.
+
+Only full blocks are cached (a partially filled block is still being written by
+its sequence). Cached blocks hold one reference each; blocks no sequence is
+using are evicted in LRU order when the pool runs out of free blocks or the
+cache grows beyond `max_blocks`.
+"""
+
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+from llm.kv_cache import PagedKVCache
+
+
+class _Node:
+    __slots__ = ("key", "block", "parent", "children", "last_access")
+
+    def __init__(self, key: Optional[Tuple[int, ...]], block: int, parent: Optional["_Node"]):
+        self.key = key
+        self.block = block
+        self.parent = parent
+        self.children: Dict[Tuple[int, ...], "_Node"] = {}
+        self.last_access = 0
+
+
+class PrefixCache:
+    def __init__(self, kv_cache: PagedKVCache, max_blocks: Optional[int] = None):
+        """
+        Args:
+            kv_cache: Block pool to cache prefixes in. The cache registers itself
+                on it, so allocations can reclaim unused prefix blocks.
+            max_blocks: Upper bound on the number of cached blocks (None: whole pool).
+        """
+        self.kv_cache = kv_cache
+        self.block_size = kv_cache.block_size
+        self.max_blocks = max_blocks if max_blocks is not None else kv_cache.num_blocks
+        self.root = _Node(None, -1, None)
+        self.num_blocks = 0
+        self._clock = itertools.count(1)
+        self.stats: Dict[str, int] = {
+            "queries": 0,
+            "hits": 0,
+            "query_tokens": 0,
+            "hit_tokens": 0,
+            "inserted_blocks": 0,
+            "evicted_blocks": 0,
+        }
+        kv_cache.prefix_cache = self
+
+    def _chunks(self, token_ids: List[int], num_blocks: int):
+        bs = self.block_size
+        for i in range(num_blocks):
+            yield tuple(token_ids[i * bs:(i + 1) * bs])
+
+    # ------------------------------------------------------------------
+    # Lookup / insertion
+    # ------------------------------------------------------------------
+
+    def match(self, token_ids: List[int]) -> List[int]:
+        """
+        Blocks of the longest cached prefix of `token_ids`. At least one token is
+        always left uncached so the caller still gets logits for the last position.
+        """
+        with self.kv_cache.lock:
+            now = next(self._clock)
+            node = self.root
+            blocks = []
+            for key in self._chunks(token_ids, (len(token_ids) - 1) // self.block_size):
+                node = node.children.get(key)
+                if node is None:
+                    break
+                node.last_access = now
+                blocks.append(node.block)
+            return blocks
+
+    def fork(self, seq_id: int, token_ids: List[int]) -> int:
+        """
+        Start `seq_id` on the longest cached prefix of `token_ids` and record the
+        lookup in the hit counters. Returns the number of tokens that need no prefill.
+        """
+        with self.kv_cache.lock:
+            blocks = self.match(token_ids)
+            num_cached = len(blocks) * self.block_size
+            if blocks:
+                self.kv_cache.share_blocks(seq_id, blocks, num_cached)
+                # Pinning evictable blocks must not take away blocks reserved by other sequences
+                if self.kv_cache.num_reserved_blocks and self.kv_cache.num_available_blocks < 0:
+                    self.kv_cache.free(seq_id)
+                    num_cached = 0
+            self.record_lookup(len(token_ids), num_cached)
+            return num_cached
+
+    def record_lookup(self, query_tokens: int, hit_tokens: int) -> None:
+        """Update the hit counters (for callers that use match/share_blocks directly)."""
+        self.stats["queries"] += 1
+        self.stats["query_tokens"] += query_tokens
+        self.stats["hits"] += int(hit_tokens > 0)
+        self.stats["hit_tokens"] += hit_tokens
+
+    def insert(self, seq_id: int, token_ids: List[int]) -> None:
+        """
+        Cache the full blocks of `token_ids`, which must already be computed in
+        `seq_id`'s leading blocks (call right after its prefill).
+        """
+        with self.kv_cache.lock:
+            table = self.kv_cache.block_tables.get(seq_id, [])
+            num_full = min(len(token_ids) // self.block_size, len(table),
+                           self.kv_cache.get_seq_len(seq_id) // self.block_size)
+            now = next(self._clock)
+            node = self.root
+            for i, key in enumerate(self._chunks(token_ids, num_full)):
+                child = node.children.get(key)
+                if child is None:
+                    if self.num_blocks >= self.max_blocks:
+                        # Stop if nothing can be evicted or the eviction took the path we are extending
+                        if not self.evict(1) or (node is not self.root and node.key not in node.parent.children):
+                            break
+                    child = _Node(key, table[i], node)
+                    node.children[key] = child
+                    self.kv_cache.incref(table[i])
+                    self.num_blocks += 1
+                    self.stats["inserted_blocks"] += 1
+                child.last_access = now
+                node = child
+
+    # ------------------------------------------------------------------
+    # Eviction
+    # ------------------------------------------------------------------
+
+    def _is_evictable(self, node: _Node) -> bool:
+        # Only the cache references the block; descendants are then unused as well
+        return self.kv_cache.ref_counts[node.block] == 1
+
+    def _iter_nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    @property
+    def num_evictable_blocks(self) -> int:
+        with self.kv_cache.lock:
+            return sum(1 for node in self._iter_nodes() if self._is_evictable(node))
+
+    def evict(self, num_blocks: int) -> int:
+        """Release up to `num_blocks` unused blocks, least recently used leaves first."""
+        with self.kv_cache.lock:
+            heap = [(node.last_access, id(node), node) for node in self._iter_nodes()
+                    if not node.children and self._is_evictable(node)]
+            heapq.heapify(heap)
+            evicted = 0
+            while heap and evicted < num_blocks:
+                _, _, node = heapq.heappop(heap)
+                parent = node.parent
+                del parent.children[node.key]
+                self.kv_cache.decref(node.block)
+                self.num_blocks -= 1
+                evicted += 1
+                if parent is not self.root and not parent.children and self._is_evictable(parent):
+                    heapq.heappush(heap, (parent.last_access, id(parent), parent))
+            self.stats["evicted_blocks"] += evicted
+            return evicted
+
+    def clear(self) -> None:
+        """Drop all unused cached prefixes (e.g. after the model weights changed)."""
+        self.evict(self.num_blocks)
+
+    def get_stats(self) -> Dict[str, float]:
+        stats = dict(self.stats)
+        stats["cached_blocks"] = self.num_blocks
+        stats["max_blocks"] = self.max_blocks
+        stats["hit_rate"] = round(stats["hits"] / stats["queries"], 4) if stats["queries"] else 0.0
+        stats["token_hit_rate"] = (round(stats["hit_tokens"] / stats["query_tokens"], 4)
+                                   if stats["query_tokens"] else 0.0)
+        return stats
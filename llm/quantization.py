@@ -0,0 +1,126 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Weight quantization of the GLMTTS Llama backbone for inference.
+
+The linear layers of the decoder blocks are replaced in place:
+
+- "int8": dynamic int8 quantization (torch.ao). Weights are stored as int8 with
+  per-output-channel scales and activations are quantized per call; runs on the
+  CPU int8 GEMM kernels.
+- "int4": weight-only int4 with one scale per group of input channels. Weights
+  are packed two per byte and dequantized on the fly for each matmul, so this
+  mainly saves memory and bandwidth; it works on any device.
+
+Embeddings, norms and the LM head stay in floating point (decoding uses the
+small audio-only head from `GLMTTS.enable_audio_head` anyway).
+"""
+
+import io
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANT_MODES = ("int8", "int4")
+
+
+class Int4Linear(nn.Module):
+    """Weight-only int4 linear layer with symmetric per-group scales."""
+
+    def __init__(self, in_features: int, out_features: int, group_size: int,
+                 packed_weight: torch.Tensor, scales: torch.Tensor, bias: torch.Tensor = None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        # (out, in // 2) uint8, low nibble = even input channel
+        self.register_buffer("packed_weight", packed_weight)
+        # (out, in // group_size)
+        self.register_buffer("scales", scales)
+        self.register_buffer("bias", bias)
+        # Byte -> (low, high) signed nibble values; unpacking is a single table lookup
+        byte = torch.arange(256)
+        nibbles = torch.stack([byte & 0xF, byte >> 4], dim=-1) - 8
+        self.register_buffer("nibble_table", nibbles.to(scales.dtype).to(scales.device), persistent=False)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, group_size: int = 128) -> "Int4Linear":
+        out_features, in_features = linear.weight.shape
+        if in_features % 2:
+            raise ValueError(f"int4 packing needs an even number of input features, got {in_features}.")
+        if in_features % group_size:
+            group_size = in_features
+
+        weight = linear.weight.detach().float().view(out_features, in_features // group_size, group_size)
+        scales = weight.abs().amax(dim=-1).clamp(min=1e-8) / 7
+        q = (weight / scales[..., None]).round().clamp(-8, 7).to(torch.int16).view(out_features, in_features) + 8
+        packed = (q[:, 0::2] | (q[:, 1::2] << 4)).to(torch.uint8)
+
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(in_features, out_features, group_size, packed, scales.to(linear.weight.dtype), bias)
+
+    def dequantize(self, dtype: torch.dtype) -> torch.Tensor:
+        q = F.embedding(self.packed_weight.long(), self.nibble_table.to(dtype))
+        weight = q.view(self.out_features, -1, self.group_size) * self.scales.to(dtype)[..., None]
+        return weight.view(self.out_features, self.in_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(x, self.dequantize(x.dtype), self.bias)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+def _replace_linears(module: nn.Module, group_size: int) -> None:
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int4Linear.from_linear(child, group_size))
+        else:
+            _replace_linears(child, group_size)
+
+
+def quantize_llama(llama, mode: str, group_size: int = 128):
+    """
+    Quantize the decoder layers of a LlamaForCausalLM in place.
+
+    Args:
+        llama: The backbone (`GLMTTS.llama`). LoRA adapters must be merged first.
+        mode: "int8" (dynamic, CPU only) or "int4" (weight-only).
+        group_size: Input channels per scale for "int4".
+
+    Returns:
+        The same model, for chaining.
+    """
+    if mode not in QUANT_MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}. Supported: {QUANT_MODES}")
+    if hasattr(llama, "peft_config"):
+        raise ValueError("Merge LoRA adapters (merge_and_unload) before quantizing the LLM.")
+
+    layers = llama.model.layers
+    if mode == "int8":
+        if next(layers.parameters()).device.type != "cpu":
+            raise ValueError("Dynamic int8 quantization only runs on CPU; use 'int4' on GPU.")
+        qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+        torch.ao.quantization.quantize_dynamic(layers, {nn.Linear: qconfig}, dtype=torch.qint8, inplace=True)
+    else:
+        _replace_linears(layers, group_size)
+    return llama
+
+
+def model_size_mb(module: nn.Module) -> float:
+    """Serialized size of a module's state (covers packed int8 weights, which are not parameters)."""
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 1024 / 1024
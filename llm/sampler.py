@@ -0,0 +1,186 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Vectorised, device-side sampler for speech-token decoding.
+
+Samples one token for every row of a batch in a handful of tensor ops, without
+Python loops over the vocabulary or host synchronisation. It reproduces the
+output distributions of the per-sequence samplers it replaces:
+
+- RAS (`cosyvoice.utils.common.ras_sampling`): nucleus sampling (top-p within
+  top-k) that falls back to plain sampling from the full distribution when the
+  drawn token already occurs too often in the recent window.
+- Top-k (`GLMTTS.sampling_ids`): sampling from the k most likely tokens, with
+  EOS rejected (i.e. removed from the candidate set) while it is banned.
+
+The repetition window of each sequence is kept as a rolling (B, win_size)
+tensor of token ids, padded with -1 until enough tokens have been generated.
+
+`target_probs` returns the full distribution these procedures sample from, which
+speculative decoding needs to accept or reject drafted tokens.
+
+Over a sliced decode head (`GLMTTS.enable_audio_head`) the vocabulary is the
+head's sub-vocabulary, normalised on its own. If the head was built with
+`full_normalizer`, its last column (`rest_id`) carries the mass of every other
+token: it counts towards the probabilities that cut the nucleus but is never a
+candidate, and the fallback draws from the head's tokens only.
+"""
+
+from typing import List, Optional, Union
+
+import torch
+
+
+class BatchSampler:
+    def __init__(
+        self,
+        eos_id: int,
+        top_p: float = 0.8,
+        ras_top_k: int = 25,
+        win_size: int = 10,
+        tau_r: float = 0.1,
+        temperature: float = 1.0,
+        rest_id: Optional[int] = None,
+    ):
+        """
+        Args:
+            eos_id: End-of-audio token id, masked while a row is below its minimum length.
+            top_p: Nucleus probability mass for RAS.
+            ras_top_k: Candidate cap for RAS (independent of the per-row top-k of 'topk').
+            win_size: Length of the repetition window.
+            tau_r: Fallback is triggered when the drawn token occurs at least
+                `win_size * tau_r` times in the window.
+            temperature: Temperature applied to the nucleus candidates of RAS.
+            rest_id: Column holding the log-sum-exp of the tokens outside a sliced
+                head; normalises the probabilities but is never sampled.
+        """
+        self.eos_id = eos_id
+        self.top_p = top_p
+        self.ras_top_k = ras_top_k
+        self.win_size = win_size
+        self.tau_r = tau_r
+        self.temperature = temperature
+        self.rest_id = rest_id
+
+    def new_window(self, batch_size: int, device: Union[str, torch.device],
+                   history: Optional[List[List[int]]] = None) -> torch.Tensor:
+        """
+        Create the repetition window for `batch_size` sequences, optionally seeded
+        with already generated tokens (e.g. when a sequence is recomputed).
+        """
+        window = torch.full((batch_size, self.win_size), -1, dtype=torch.long)
+        if history is not None:
+            for row, tokens in enumerate(history):
+                tokens = tokens[-self.win_size:]
+                if tokens:
+                    window[row, self.win_size - len(tokens):] = torch.tensor(tokens, dtype=torch.long)
+        return window.to(device)
+
+    @staticmethod
+    def update_window(window: torch.Tensor, tokens: torch.Tensor) -> torch.Tensor:
+        """Shift the newly accepted tokens (B,) into the windows (B, win_size)."""
+        return torch.cat([window[:, 1:], tokens[:, None].to(window.dtype)], dim=1)
+
+    def _candidates(self, logits, ban_eos, use_ras, top_k):
+        """Shared first stage of `sample` and `target_probs`: the top-k / nucleus candidate set."""
+        batch, vocab = logits.shape
+        device = logits.device
+        if isinstance(use_ras, bool):
+            use_ras = torch.full((batch,), use_ras, dtype=torch.bool, device=device)
+        # Scalar settings are materialised on-device so sampling needs no host transfer
+        if isinstance(top_k, int):
+            max_k = min(vocab, max(top_k, self.ras_top_k))
+            k = torch.full((batch,), top_k, dtype=torch.long, device=device)
+        else:
+            max_k = min(vocab, max(max(top_k), self.ras_top_k))
+            k = torch.tensor(top_k, device=device)
+        k = torch.where(use_ras, torch.full_like(k, self.ras_top_k), k)
+
+        is_eos = torch.arange(vocab, device=device) == self.eos_id
+        # RAS masks EOS before normalising; top-k rejects it after drawing from the unmasked top-k
+        scores = logits.float().masked_fill((ban_eos & use_ras)[:, None] & is_eos, -float("inf"))
+        scaled = scores / torch.where(use_ras, self.temperature, 1.0)[:, None]
+
+        probs = scaled.softmax(dim=-1)
+        if self.rest_id is not None:
+            # The rest column only normalises; it is neither ranked nor drawn
+            is_rest = torch.arange(vocab, device=device) == self.rest_id
+            probs = probs.masked_fill(is_rest, 0.0)
+            scores = scores.masked_fill(is_rest, -float("inf"))
+        probs, indices = probs.topk(max_k, dim=-1)   # sorted, descending
+        rank = torch.arange(max_k, device=device)
+        keep = rank < k[:, None]
+        # Nucleus: keep a candidate while the mass before it is still below top_p
+        mass_before = probs.cumsum(dim=-1) - probs
+        keep &= (mass_before < self.top_p) | ~use_ras[:, None]
+        keep &= ~((ban_eos & ~use_ras)[:, None] & (indices == self.eos_id))
+        # A row left without candidates (only possible for top-k with k == 1) keeps its best token
+        keep[:, 0] |= ~keep.any(dim=-1)
+
+        return scores, probs, indices, keep, use_ras
+
+    def sample(
+        self,
+        logits: torch.Tensor,
+        window: torch.Tensor,
+        ban_eos: torch.Tensor,
+        use_ras: Union[bool, torch.Tensor] = True,
+        top_k: Union[int, List[int]] = 25,
+    ) -> torch.Tensor:
+        """
+        Draw one token per row.
+
+        Args:
+            logits: Scores of the next position, (B, V). Log-probabilities work as well.
+            window: Repetition windows, (B, win_size).
+            ban_eos: (B,) bool, True for rows that must not emit EOS yet.
+            use_ras: RAS for True rows, top-k for False rows (scalar or (B,) bool).
+            top_k: Candidate count for top-k rows (scalar or per-row list).
+
+        Returns:
+            torch.Tensor: Sampled token ids, (B,), on the logits' device.
+        """
+        scores, probs, indices, keep, use_ras = self._candidates(logits, ban_eos, use_ras, top_k)
+
+        choice = torch.multinomial(probs * keep, 1)
+        tokens = indices.gather(1, choice).squeeze(1)
+
+        # Repetition-aware fallback to sampling from the full (EOS-masked) distribution
+        repeats = (window == tokens[:, None]).sum(dim=-1)
+        fallback = use_ras & (repeats >= self.win_size * self.tau_r)
+        random_tokens = torch.multinomial(scores.softmax(dim=-1), 1).squeeze(1)
+        return torch.where(fallback, random_tokens, tokens)
+
+    def target_probs(
+        self,
+        logits: torch.Tensor,
+        window: torch.Tensor,
+        ban_eos: torch.Tensor,
+        use_ras: Union[bool, torch.Tensor] = True,
+        top_k: Union[int, List[int]] = 25,
+    ) -> torch.Tensor:
+        """
+        Distribution that `sample` draws from, as a (B, V) probability matrix.
+
+        For RAS this is the nucleus distribution with the mass of repeated tokens
+        redistributed according to the full (EOS-masked) distribution.
+        """
+        scores, probs, indices, keep, use_ras = self._candidates(logits, ban_eos, use_ras, top_k)
+        weights = probs * keep
+        nucleus = torch.zeros_like(scores).scatter_(1, indices, weights / weights.sum(dim=-1, keepdim=True))
+
+        counts = torch.zeros_like(scores).scatter_add_(1, window.clamp(min=0), (window >= 0).to(scores.dtype))
+        repeated = (counts >= self.win_size * self.tau_r) & use_ras[:, None]
+        fallback_mass = (nucleus * repeated).sum(dim=-1, keepdim=True)
+        return nucleus * ~repeated + fallback_mass * scores.softmax(dim=-1)
@@ -0,0 +1,187 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Draft proposers and verification for speculative speech-token decoding.
+
+A proposer drafts up to k tokens; GLMTTS verifies all of them with one forward
+pass of the main model and keeps the longest prefix that passes rejection
+sampling against the sampler's target distribution (see
+`BatchSampler.target_probs`), so the output distribution is unchanged.
+
+All token ids handled here live in the sampler's id space, i.e. local ids of
+the audio head when it is enabled.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from llm.kv_cache import host_to_device
+
+
+def verify_drafts(
+    target: torch.Tensor,
+    drafts: torch.Tensor,
+    draft_probs: Optional[torch.Tensor] = None,
+) -> Tuple[int, torch.Tensor]:
+    """
+    Speculative sampling acceptance for one sequence.
+
+    Args:
+        target: Target distributions at the K + 1 verified positions, (K + 1, V).
+        drafts: Drafted tokens, (K,).
+        draft_probs: Distributions the drafts were sampled from, (K, V);
+            None for deterministic proposers (point mass on each draft).
+
+    Returns:
+        Tuple[int, torch.Tensor]: Number of accepted drafts n, and the token sampled
+        at position n (from the residual distribution after a rejection, otherwise
+        from the bonus position), shape (1,).
+    """
+    num_drafts = drafts.shape[0]
+    num_accepted = 0
+    if num_drafts:
+        rows = torch.arange(num_drafts, device=drafts.device)
+        q = target[rows, drafts]
+        r = draft_probs[rows, drafts] if draft_probs is not None else torch.ones_like(q)
+        accept = torch.rand_like(q) < (q / r).clamp(max=1.0)
+        num_accepted = int(accept.long().cumprod(dim=0).sum())
+
+    probs = target[num_accepted]
+    if num_accepted < num_drafts:
+        if draft_probs is not None:
+            proposal = draft_probs[num_accepted]
+        else:
+            proposal = torch.zeros_like(probs).scatter_(0, drafts[num_accepted:num_accepted + 1], 1.0)
+        residual = (probs - proposal).clamp(min=0)
+        # Empty residual means the draft could not have been rejected; keep the target as a guard
+        probs = torch.where(residual.sum() > 0, residual, probs)
+    return num_accepted, torch.multinomial(probs, 1)
+
+
+class NGramProposer:
+    """
+    Prompt/history lookup proposer: finds the most recent earlier occurrence of the
+    current n-gram suffix (longest first) and proposes the tokens that followed it.
+    Speech-token sequences are locally repetitive, so this drafts well at no model cost.
+    """
+
+    def __init__(self, num_tokens: int = 4, max_ngram: int = 4, min_ngram: int = 2):
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def begin(self, prompt_ids: List[int], history: List[int]) -> "_NGramState":
+        return _NGramState(self, history)
+
+
+class _NGramState:
+    def __init__(self, proposer: NGramProposer, history: List[int]):
+        self.proposer = proposer
+        self.tokens: List[int] = []
+        # n-gram -> position right after its latest occurrence
+        self.index: Dict[Tuple[int, ...], int] = {}
+        self._append(history)
+
+    def _append(self, tokens: List[int]) -> None:
+        for token in tokens:
+            end = len(self.tokens)
+            for n in range(self.proposer.min_ngram, self.proposer.max_ngram + 1):
+                if end >= n:
+                    self.index[tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token)
+
+    def propose(self, num_tokens: int, device: torch.device) -> Tuple[torch.Tensor, None]:
+        drafts: List[int] = []
+        for n in range(self.proposer.max_ngram, self.proposer.min_ngram - 1, -1):
+            if len(self.tokens) < n:
+                continue
+            start = self.index.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                drafts = self.tokens[start:start + num_tokens]
+                break
+        # Tokens outside the sampler's id space (-1) cannot be drafted
+        if -1 in drafts:
+            drafts = drafts[:drafts.index(-1)]
+        return host_to_device(drafts, device), None
+
+    def accept(self, tokens: List[int], num_accepted: int) -> None:
+        self._append(tokens)
+
+    def close(self) -> None:
+        pass
+
+
+class DraftModelProposer:
+    """
+    Proposer backed by a small GLMTTS draft model with the same vocabulary and
+    decode head as the main model. Drafts are sampled from the draft's softmax and
+    verified with the corresponding probabilities.
+    """
+
+    def __init__(self, draft, num_tokens: int = 4, memory_budget_mb: float = 64, block_size: int = 16):
+        self.draft = draft
+        self.num_tokens = num_tokens
+        self.kv_cache = draft.create_kv_cache(memory_budget_mb=memory_budget_mb, block_size=block_size)
+        self.runner = draft.create_runner(self.kv_cache)
+
+    def begin(self, prompt_ids: List[int], history: List[int]) -> "_DraftState":
+        return _DraftState(self, prompt_ids)
+
+
+class _DraftState:
+    def __init__(self, proposer: DraftModelProposer, prompt_ids: List[int]):
+        self.proposer = proposer
+        self.seq_id = proposer.kv_cache.new_seq_id()
+        # Accepted vocabulary ids whose KV is not in the draft cache yet
+        self.unfed: List[int] = list(prompt_ids)
+        self.base_len = 0
+        self.num_drafted = 0
+
+    @torch.inference_mode()
+    def propose(self, num_tokens: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        draft, runner = self.proposer.draft, self.proposer.runner
+        inputs_embeds = draft.llama_embedding(host_to_device(self.unfed, device))
+        self.base_len = runner.kv_cache.get_seq_len(self.seq_id) + len(self.unfed)
+        self.unfed = []
+
+        drafts, probs = [], []
+        for j in range(num_tokens):
+            hidden = runner.forward([self.seq_id], [inputs_embeds])
+            logits = runner.compute_logits(hidden).float()
+            if draft.sampler.rest_id is not None:
+                # Mass of tokens outside the sliced head is never drafted
+                logits[..., draft.sampler.rest_id] = -float("inf")
+            p = logits.softmax(dim=-1)[0]
+            token = torch.multinomial(p, 1)
+            drafts.append(token)
+            probs.append(p)
+            if j < num_tokens - 1:
+                inputs_embeds = draft.llama_embedding(runner.to_vocab(token))
+        self.num_drafted = num_tokens
+        return torch.cat(drafts), torch.stack(probs)
+
+    def accept(self, tokens: List[int], num_accepted: int) -> None:
+        runner = self.proposer.runner
+        # The cache holds the first num_drafted - 1 drafts; keep those that were accepted
+        kept = min(num_accepted, max(self.num_drafted - 1, 0))
+        if self.num_drafted:
+            runner.kv_cache.truncate(self.seq_id, self.base_len + kept)
+        self.num_drafted = 0
+        if tokens[kept:]:
+            local = torch.tensor(tokens[kept:], dtype=torch.long, device=runner.kv_cache.device)
+            self.unfed.extend(runner.to_vocab(local).tolist())
+
+    def close(self) -> None:
+        self.proposer.kv_cache.free(self.seq_id)
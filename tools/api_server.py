@@ -34,9 +34,31 @@ from tools.gradio_app import (
     get_models,
     run_inference,
     clear_memory,
+    enable_decode_engine,
+    enable_llm_quantization,
+    enable_kv_cache_quantization,
+    set_llm_audio_head,
+    get_engine_stats,
+    enable_prefix_cache,
+    enable_speculative_decoding,
+    set_flow_fused_cfg,
+    set_flow_batch_size,
+    set_flow_block_sparse_attn,
+    set_flow_guidance,
+    enable_flow_adaptive_steps,
+    get_flow_step_stats,
+    set_vocoder_serving_build,
+    set_vocoder_batching,
+    get_vocoder_batch_stats,
+    set_model_memory_budget,
+    get_model_registry_stats,
+    get_prefix_cache_stats,
+    EngineOverloadedError,
     MODEL_CACHE
 )
 import gradio as gr
+from flow.guidance import guidance_weights
+from flow.solvers import SOLVERS
 
 # Import optimization modules
 from tools.config import TTSConfig
@@ -202,7 +224,10 @@ def tts_inference_wrapper(
     use_phoneme: bool = False,
     sample_method: str = "ras",
     sampling: int = 25,
-    beam_size: int = 1
+    beam_size: int = 1,
+    flow_solver: str = "euler",
+    flow_steps: int = 10,
+    flow_guidance: Optional[str] = None
 ) -> Tuple[int, np.ndarray]:
     """
     Wrapper for run_inference that handles errors properly for API.
@@ -219,9 +244,16 @@ def tts_inference_wrapper(
             use_phoneme=use_phoneme,
             sample_method=sample_method,
             sampling=sampling,
-            beam_size=beam_size
+            beam_size=beam_size,
+            flow_solver=flow_solver,
+            flow_steps=flow_steps,
+            flow_guidance=flow_guidance
         )
         return result
+    except EngineOverloadedError as e:
+        # KV cache / decode queue is full: ask the client to retry later
+        logging.warning(f"Decode engine overloaded: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
     except gr.Error as e:
         # Convert Gradio errors to HTTP exceptions
         logging.error(f"Inference error (Gradio): {e}")
@@ -240,6 +272,47 @@ async def startup_event():
     # Initialize concurrency manager
     concurrency_manager.initialize()
     logging.info("Concurrency manager initialized")
+    if TTSConfig.LLM_QUANTIZATION:
+        enable_llm_quantization(TTSConfig.LLM_QUANTIZATION)
+        logging.info(f"LLM quantization enabled ({TTSConfig.LLM_QUANTIZATION})")
+    if TTSConfig.KV_CACHE_QUANTIZATION:
+        enable_kv_cache_quantization(TTSConfig.KV_CACHE_QUANTIZATION)
+        logging.info(f"KV cache quantization enabled ({TTSConfig.KV_CACHE_QUANTIZATION})")
+    set_llm_audio_head(TTSConfig.LLM_AUDIO_HEAD)
+    logging.info(f"LLM decode head: {TTSConfig.LLM_AUDIO_HEAD}")
+    if TTSConfig.ENABLE_DECODE_ENGINE:
+        enable_decode_engine(
+            max_batch_size=TTSConfig.DECODE_ENGINE_MAX_BATCH,
+            kv_cache_memory_mb=TTSConfig.KV_CACHE_MEMORY_MB,
+            kv_block_size=TTSConfig.KV_CACHE_BLOCK_SIZE,
+            max_waiting=TTSConfig.QUEUE_MAX_SIZE,
+            prefill_chunk_size=TTSConfig.PREFILL_CHUNK_SIZE or None,
+        )
+        logging.info("Decode engine enabled")
+    if TTSConfig.ENABLE_PREFIX_CACHE:
+        enable_prefix_cache(
+            memory_mb=TTSConfig.KV_CACHE_MEMORY_MB,
+            max_cached_mb=TTSConfig.PREFIX_CACHE_MAX_MB or None,
+            block_size=TTSConfig.KV_CACHE_BLOCK_SIZE,
+        )
+        logging.info("Prefix cache enabled")
+    if TTSConfig.SPECULATIVE_NGRAM_TOKENS > 0 and not TTSConfig.ENABLE_DECODE_ENGINE:
+        enable_speculative_decoding(ngram_tokens=TTSConfig.SPECULATIVE_NGRAM_TOKENS)
+        logging.info("Speculative decoding enabled")
+    set_flow_fused_cfg(TTSConfig.FLOW_FUSED_CFG)
+    set_flow_batch_size(TTSConfig.FLOW_BATCH_SIZE)
+    set_flow_block_sparse_attn(TTSConfig.FLOW_BLOCK_SPARSE_ATTN)
+    set_flow_guidance(TTSConfig.FLOW_GUIDANCE)
+    if TTSConfig.FLOW_ADAPTIVE_TOLERANCE > 0 or TTSConfig.FLOW_LATENCY_BUDGET > 0:
+        enable_flow_adaptive_steps(
+            tolerance=TTSConfig.FLOW_ADAPTIVE_TOLERANCE,
+            min_steps=TTSConfig.FLOW_MIN_STEPS,
+            latency_budget=TTSConfig.FLOW_LATENCY_BUDGET or None
+        )
+        logging.info("Adaptive flow step control enabled")
+    set_vocoder_serving_build(TTSConfig.VOCODER_SERVING_BUILD)
+    set_vocoder_batching(TTSConfig.VOCODER_BATCH_SIZE, TTSConfig.VOCODER_BATCH_WAIT_MS)
+    set_model_memory_budget(TTSConfig.MODEL_MEMORY_BUDGET_MB)
     logging.info(f"Configuration: {TTSConfig.get_all_config()}")
 
 
@@ -256,7 +329,10 @@ async def generate_tts(
     use_phoneme: bool = Form(False),
     sample_method: str = Form("ras"),
     sampling: int = Form(25),
-    beam_size: int = Form(1)
+    beam_size: int = Form(1),
+    flow_solver: str = Form("euler"),
+    flow_steps: int = Form(10),
+    flow_guidance: Optional[str] = Form(None)
 ):
     """
     Generate TTS audio. Supports two modes:
@@ -283,6 +359,19 @@ async def generate_tts(
         if not (1 <= beam_size <= 5):
             raise HTTPException(status_code=400, detail="beam_size must be between 1 and 5")
         
+        # Validate flow ODE solver and step count
+        if flow_solver not in SOLVERS:
+            raise HTTPException(status_code=400, detail=f"flow_solver must be one of {list(SOLVERS)}")
+        if not (1 <= flow_steps <= 50):
+            raise HTTPException(status_code=400, detail="flow_steps must be between 1 and 50")
+        
+        # Validate flow CFG schedule (None: server default FLOW_GUIDANCE)
+        if flow_guidance:
+            try:
+                guidance_weights(flow_guidance, flow_steps, 1.0)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"flow_guidance: {e}")
+        
         # Determine prompt source
         final_prompt_text = None
         final_prompt_audio_path = None
@@ -363,7 +452,10 @@ async def generate_tts(
                             use_phoneme=use_phoneme,
                             sample_method=sample_method,
                             sampling=sampling,
-                            beam_size=beam_size
+                            beam_size=beam_size,
+                            flow_solver=flow_solver,
+                            flow_steps=flow_steps,
+                            flow_guidance=flow_guidance or None
                         )
                     )
                 
@@ -534,6 +626,7 @@ async def health_check():
         "model_loaded": MODEL_CACHE.get("loaded", False),
         "model_sample_rate": MODEL_CACHE.get("sample_rate"),
         "model_use_phoneme": MODEL_CACHE.get("use_phoneme"),
+        "resident_sample_rates": list((get_model_registry_stats() or {}).get("backends", {})),
         "prompt_cache_count": len(PROMPT_CACHE)
     }
 
@@ -547,6 +640,11 @@ async def get_concurrency_stats():
     return {
         "success": True,
         "stats": stats,
+        "engine": get_engine_stats(),
+        "prefix_cache": get_prefix_cache_stats(),
+        "flow_steps": get_flow_step_stats(),
+        "vocoder": get_vocoder_batch_stats(),
+        "models": get_model_registry_stats(),
         "config": TTSConfig.get_all_config()
     }
 
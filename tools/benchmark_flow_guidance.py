@@ -0,0 +1,142 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Mel error / speaker similarity / speed of flow CFG schedules against full guidance.
+
+For every item of an examples/*.jsonl set, the LLM generates one speech-token
+stream. The flow model renders it with guidance on every step (reference) and with
+each candidate schedule, all from the same initial noise. Candidates are compared
+to the reference mel (relative L1), and the vocoded audio of every schedule is
+scored by speaker similarity to the prompt (CAM++ embedding cosine, as used by the
+frontend).
+
+Usage:
+    python -m tools.benchmark_flow_guidance --data example_zh
+    python -m tools.benchmark_flow_guidance --data example_zh --schedules "none;2-7;3-8;1-5:1.0"
+"""
+import argparse
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+import torchaudio
+
+from glmtts_inference import (
+    DEVICE,
+    load_frontends,
+    load_llm,
+    local_llm_forward,
+    yaml_util,
+    SpeechTokenizer
+)
+from flow.guidance import guidance_weights, guided_function_evals
+from utils import file_utils, seed_util
+from utils.tts_model_util import Token2Wav
+
+REFERENCE = "all"
+# ';'-separated because per-step weight lists contain commas
+DEFAULT_SCHEDULES = "none;1-5;2-7;3-8;2-9;1-10:0.5"
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timed_render(token2wav, seed, guidance, n_timesteps, **inputs):
+    seed_util.set_seed(seed)
+    synchronize()
+    start = time.time()
+    wav, mel = token2wav.token2wav_with_cache(n_timesteps=n_timesteps, guidance=guidance, **inputs)
+    synchronize()
+    return wav, mel.float(), time.time() - start
+
+
+def speaker_similarity(frontend, wav, sample_rate, prompt_embedding):
+    wav_16k = torchaudio.functional.resample(wav.float().cpu(), sample_rate, 16000)
+    embedding = frontend._extract_spk_embedding(wav_16k)
+    return F.cosine_similarity(embedding, prompt_embedding).item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare flow CFG schedules with guidance on every step")
+    parser.add_argument("--data", default="example_zh", type=str)
+    parser.add_argument("--schedules", default=DEFAULT_SCHEDULES, type=str,
+                        help="';'-separated guidance schedules (see flow/guidance.py)")
+    parser.add_argument("--flow_steps", type=int, default=10)
+    parser.add_argument("--sample_rate", type=int, default=24000)
+    parser.add_argument("--max_items", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    schedules = [REFERENCE] + [spec.strip() for spec in args.schedules.split(";") if spec.strip()]
+
+    _model, _feature_extractor = yaml_util.load_speech_tokenizer(os.path.join("ckpt", "speech_tokenizer"))
+    frontend, text_frontend = load_frontends(SpeechTokenizer(_model, _feature_extractor),
+                                             sample_rate=args.sample_rate)
+    llm = load_llm(frontend)
+    flow = yaml_util.load_flow_model(os.path.join("ckpt", "flow", "flow.pt"),
+                                     os.path.join("ckpt", "flow", "config.yaml"), DEVICE)
+    token2wav = Token2Wav(flow, sample_rate=args.sample_rate, device=DEVICE)
+    weights = {spec: guidance_weights(spec, args.flow_steps, flow.inference_cfg_rate) for spec in schedules}
+
+    items = file_utils.get_jsonl(os.path.join("examples", args.data + ".jsonl"))[:args.max_items]
+    totals = {spec: {"rel_l1": 0.0, "sim": 0.0, "time": 0.0} for spec in schedules}
+    for item in items:
+        prompt_text = text_frontend.text_normalize(item["prompt_text"])
+        synth_text = text_frontend.text_normalize(item["syn_text"])
+        prompt_speech_token = frontend._extract_speech_token([item["prompt_speech"]]).to(DEVICE)
+        prompt_embedding = frontend._extract_spk_embedding(item["prompt_speech"]).to(DEVICE)
+        seed_util.set_seed(args.seed)
+        tokens = local_llm_forward(
+            llm=llm,
+            prompt_text_token=frontend._extract_text_token(prompt_text + " "),
+            tts_text_token=frontend._extract_text_token(synth_text),
+            prompt_speech_token=prompt_speech_token,
+        )
+        inputs = dict(
+            token_bt=tokens,
+            prompt_token=prompt_speech_token,
+            prompt_feat=frontend._extract_speech_feat(item["prompt_speech"], sample_rate=args.sample_rate).to(DEVICE),
+            embedding=prompt_embedding,
+        )
+
+        line = []
+        for spec in schedules:
+            wav, mel, elapsed = timed_render(token2wav, args.seed, None if spec == REFERENCE else spec,
+                                             args.flow_steps, **inputs)
+            if spec == REFERENCE:
+                ref = mel
+                line.append(f"frames={ref.shape[-1]}")
+            rel_l1 = ((mel - ref).abs().sum() / ref.abs().sum()).item()
+            sim = speaker_similarity(frontend, wav, args.sample_rate, prompt_embedding)
+            total = totals[spec]
+            total["rel_l1"] += rel_l1
+            total["sim"] += sim
+            total["time"] += elapsed
+            line.append(f"{spec}: l1={rel_l1 * 100:.2f}% sim={sim:.3f}")
+        print(f"[{item['uttid']}] " + " | ".join(line))
+
+    if not items:
+        return
+    ref_time = totals[REFERENCE]["time"]
+    print(f"{'schedule':>16} {'NFE':>4} {'rel L1':>8} {'SIM':>6} {'time/item':>10} {'speedup':>8}")
+    for spec, total in totals.items():
+        print(f"{spec:>16} {guided_function_evals(weights[spec]):>4} "
+              f"{total['rel_l1'] / len(items) * 100:>7.2f}% {total['sim'] / len(items):>6.3f} "
+              f"{total['time'] / len(items):>9.3f}s {ref_time / total['time']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Mel error / speed of flow ODE solvers against the 10-step Euler reference.
+
+For every item of an examples/*.jsonl set, the LLM generates one speech-token
+stream. The flow model then renders it with the reference (euler, 10 steps) and
+with each candidate solver/step count, all starting from the same initial noise,
+and the candidate mels are compared to the reference (relative L1 and max error).
+
+Usage:
+    python -m tools.benchmark_flow_solvers --data example_zh
+    python -m tools.benchmark_flow_solvers --data example_zh --configs heun:4,dpm_multistep:6
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from glmtts_inference import (
+    DEVICE,
+    load_frontends,
+    load_llm,
+    local_llm_forward,
+    yaml_util,
+    SpeechTokenizer
+)
+from flow.solvers import num_function_evals
+from utils import file_utils, seed_util
+
+REFERENCE = ("euler", 10)
+DEFAULT_CONFIGS = "euler:5,heun:3,heun:4,midpoint:4,rk4:2,dpm_multistep:4,dpm_multistep:6"
+
+
+def parse_configs(spec):
+    configs = []
+    for entry in spec.split(","):
+        name, steps = entry.split(":")
+        num_function_evals(name, int(steps))  # validates the solver name
+        configs.append((name, int(steps)))
+    return configs
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timed_mel(flow, seed, solver, n_timesteps, **inputs):
+    seed_util.set_seed(seed)
+    synchronize()
+    start = time.time()
+    mel, _ = flow.inference_with_cache(solver=solver, n_timesteps=n_timesteps, **inputs)
+    synchronize()
+    return mel.float(), time.time() - start
+
+
+def mel_errors(mel, ref):
+    diff = (mel - ref).abs()
+    return (diff.sum() / ref.abs().sum()).item(), diff.max().item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare flow ODE solvers with 10-step Euler")
+    parser.add_argument("--data", default="example_zh", type=str)
+    parser.add_argument("--configs", default=DEFAULT_CONFIGS, type=str,
+                        help="Comma-separated solver:steps candidates")
+    parser.add_argument("--sample_rate", type=int, default=24000)
+    parser.add_argument("--max_items", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    configs = parse_configs(args.configs)
+
+    _model, _feature_extractor = yaml_util.load_speech_tokenizer(os.path.join("ckpt", "speech_tokenizer"))
+    frontend, text_frontend = load_frontends(SpeechTokenizer(_model, _feature_extractor),
+                                             sample_rate=args.sample_rate)
+    llm = load_llm(frontend)
+    flow = yaml_util.load_flow_model(os.path.join("ckpt", "flow", "flow.pt"),
+                                     os.path.join("ckpt", "flow", "config.yaml"), DEVICE)
+
+    items = file_utils.get_jsonl(os.path.join("examples", args.data + ".jsonl"))[:args.max_items]
+    totals = {config: {"rel_l1": 0.0, "max_abs": 0.0, "time": 0.0} for config in [REFERENCE] + configs}
+    for item in items:
+        prompt_text = text_frontend.text_normalize(item["prompt_text"])
+        synth_text = text_frontend.text_normalize(item["syn_text"])
+        prompt_speech_token = frontend._extract_speech_token([item["prompt_speech"]]).to(DEVICE)
+        seed_util.set_seed(args.seed)
+        tokens = local_llm_forward(
+            llm=llm,
+            prompt_text_token=frontend._extract_text_token(prompt_text + " "),
+            tts_text_token=frontend._extract_text_token(synth_text),
+            prompt_speech_token=prompt_speech_token,
+        )
+        inputs = dict(
+            token=torch.tensor([tokens], dtype=torch.long, device=DEVICE),
+            prompt_token=prompt_speech_token,
+            prompt_feat=frontend._extract_speech_feat(item["prompt_speech"], sample_rate=args.sample_rate).to(DEVICE),
+            embedding=frontend._extract_spk_embedding(item["prompt_speech"]).to(DEVICE),
+        )
+
+        ref, elapsed = timed_mel(flow, args.seed, *REFERENCE, **inputs)
+        totals[REFERENCE]["time"] += elapsed
+        line = [f"[{item['uttid']}] frames={ref.shape[-1]}"]
+        for name, steps in configs:
+            mel, elapsed = timed_mel(flow, args.seed, name, steps, **inputs)
+            rel_l1, max_abs = mel_errors(mel, ref)
+            total = totals[(name, steps)]
+            total["rel_l1"] += rel_l1
+            total["max_abs"] = max(total["max_abs"], max_abs)
+            total["time"] += elapsed
+            line.append(f"{name}:{steps}={rel_l1 * 100:.2f}%")
+        print(" ".join(line))
+
+    if not items:
+        return
+    ref_time = totals[REFERENCE]["time"]
+    print(f"{'solver':>14} {'steps':>5} {'NFE':>4} {'rel L1':>8} {'max abs':>8} {'time/item':>10} {'speedup':>8}")
+    for (name, steps), total in totals.items():
+        print(f"{name:>14} {steps:>5} {num_function_evals(name, steps):>4} "
+              f"{total['rel_l1'] / len(items) * 100:>7.2f}% {total['max_abs']:>8.4f} "
+              f"{total['time'] / len(items):>9.3f}s {ref_time / total['time']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Accuracy / speed check of a quantized LLM (weights and/or KV cache) against the fp32 model.
+
+For every item of an examples/*.jsonl set, the fp32 model generates a speech-token
+stream. The quantized model is then teacher-forced on that stream through its paged
+KV cache and compared position by position (top-1 agreement and KL divergence over
+the audio head), and both models are timed on free-running generation with the same seed.
+
+For CER / speaker similarity, synthesize the set with `glmtts_inference.py`
+(--llm_quantization / --kv_cache_quantization, separate --exp_name) and score both
+output folders with grpo/run_wer.py and grpo/run_sim.py.
+
+Usage:
+    python -m tools.benchmark_llm_quantization --data example_zh --mode int8
+    python -m tools.benchmark_llm_quantization --data example_zh --mode none --kv_cache int8
+"""
+import argparse
+import math
+import os
+import time
+
+import torch
+
+from glmtts_inference import (
+    DEVICE,
+    load_frontends,
+    load_llm,
+    local_llm_forward,
+    yaml_util,
+    SpeechTokenizer
+)
+from llm.quantization import model_size_mb
+from utils import file_utils, seed_util
+
+
+@torch.inference_mode()
+def audio_head_log_probs(llm, input_ids, block_size=16):
+    """Log-probabilities of the audio head for every position of `input_ids` (1, L), via the paged KV cache."""
+    kv_cache = llm.create_kv_cache(num_blocks=math.ceil(input_ids.shape[1] / block_size), block_size=block_size)
+    runner = llm.create_runner(kv_cache)
+    seq_id = kv_cache.new_seq_id()
+    hidden = runner.forward([seq_id], [llm.llama_embedding(input_ids[0])], all_positions=True)[0]
+    return runner.compute_logits(hidden).float().log_softmax(dim=-1)
+
+
+def kv_bytes_per_token(llm):
+    kv = llm.create_kv_cache(num_blocks=1, block_size=1)
+    return kv.bytes_per_block(kv.num_layers, kv.num_kv_heads, kv.head_dim, 1, kv.dtype, kv.quantization)
+
+
+def teacher_forced_agreement(ref_llm, quant_llm, prompt_text_token, tts_text_token, prompt_speech_token, out_tokens):
+    """Top-1 agreement and mean KL(ref || quant) of the next-token distributions along `out_tokens`."""
+    prompt_ids = ref_llm.build_input_ids(
+        tts_text_token, prompt_text_token, prompt_text_token.shape[1],
+        prompt_speech_token, prompt_speech_token.shape[1], None
+    )
+    generated = torch.tensor([out_tokens], dtype=torch.long, device=prompt_ids.device) + ref_llm.ats
+    input_ids = torch.cat([prompt_ids, generated], dim=1)
+    # Positions whose next token is a generated one (the last prompt token predicts the first)
+    start = prompt_ids.shape[1] - 1
+    ref = audio_head_log_probs(ref_llm, input_ids)[start:]
+    quant = audio_head_log_probs(quant_llm, input_ids)[start:]
+    agree = (ref.argmax(dim=-1) == quant.argmax(dim=-1)).float().mean().item()
+    kl = (ref.exp() * (ref - quant)).sum(dim=-1).mean().item()
+    return agree, kl
+
+
+def timed_generate(llm, seed, **inputs):
+    seed_util.set_seed(seed)
+    start = time.time()
+    tokens = local_llm_forward(llm=llm, **inputs)
+    return tokens, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a quantized GLMTTS LLM with the fp32 model")
+    parser.add_argument("--data", default="example_zh", type=str)
+    parser.add_argument("--mode", choices=["int8", "int4", "none"], default="int8",
+                        help="Weight quantization of the candidate model")
+    parser.add_argument("--kv_cache", choices=["int8"], default=None,
+                        help="KV-cache storage format of the candidate model")
+    parser.add_argument("--max_items", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    _model, _feature_extractor = yaml_util.load_speech_tokenizer(os.path.join("ckpt", "speech_tokenizer"))
+    frontend, text_frontend = load_frontends(SpeechTokenizer(_model, _feature_extractor))
+
+    ref_llm = load_llm(frontend)
+    quant_llm = load_llm(frontend, llm_quantization=None if args.mode == "none" else args.mode,
+                         kv_cache_quantization=args.kv_cache)
+    name = "+".join([args.mode] + ([f"kv-{args.kv_cache}"] if args.kv_cache else []))
+    ref_mb = model_size_mb(ref_llm.llama)
+    quant_mb = model_size_mb(quant_llm.llama)
+    ref_kv = kv_bytes_per_token(ref_llm)
+    quant_kv = kv_bytes_per_token(quant_llm)
+
+    items = file_utils.get_jsonl(os.path.join("examples", args.data + ".jsonl"))[:args.max_items]
+    ref_time = quant_time = 0.0
+    ref_tokens = quant_tokens = 0
+    agreements, kls = [], []
+    for item in items:
+        prompt_text = text_frontend.text_normalize(item["prompt_text"])
+        synth_text = text_frontend.text_normalize(item["syn_text"])
+        inputs = dict(
+            prompt_text_token=frontend._extract_text_token(prompt_text + " "),
+            tts_text_token=frontend._extract_text_token(synth_text),
+            prompt_speech_token=frontend._extract_speech_token([item["prompt_speech"]]).to(DEVICE),
+        )
+        ref_out, elapsed = timed_generate(ref_llm, args.seed, **inputs)
+        ref_time += elapsed
+        ref_tokens += len(ref_out)
+        quant_out, elapsed = timed_generate(quant_llm, args.seed, **inputs)
+        quant_time += elapsed
+        quant_tokens += len(quant_out)
+
+        agree, kl = teacher_forced_agreement(ref_llm, quant_llm, out_tokens=ref_out, **inputs)
+        agreements.append(agree)
+        kls.append(kl)
+        print(f"[{item['uttid']}] tokens fp32={len(ref_out)} {name}={len(quant_out)} "
+              f"top1_agree={agree:.4f} kl={kl:.5f}")
+
+    ref_tps = ref_tokens / ref_time if ref_time else 0.0
+    quant_tps = quant_tokens / quant_time if quant_time else 0.0
+    print(f"Memory (LLM state): fp32={ref_mb:.1f} MB, {name}={quant_mb:.1f} MB "
+          f"({(1 - quant_mb / ref_mb) * 100:.1f}% smaller)")
+    print(f"KV cache per token: fp32={ref_kv / 1024:.1f} KB, {name}={quant_kv / 1024:.1f} KB "
+          f"({ref_kv / quant_kv:.2f}x tokens per MB)")
+    print(f"Decode speed: fp32={ref_tps:.1f} tok/s, {name}={quant_tps:.1f} tok/s "
+          f"({quant_tps / ref_tps if ref_tps else 0:.2f}x)")
+    if agreements:
+        print(f"Teacher-forced top-1 agreement: {sum(agreements) / len(agreements):.4f}, "
+              f"mean KL: {sum(kls) / len(kls):.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Text normalisation throughput on a long mixed zh/en document.
+
+Times `TextFrontEnd.pre_replace` / `post_replace` (custom rules loaded once and
+compiled, post-normalizer maps in one pass) against the previous implementation
+(rule file parsed on every call, one `str.replace` / `re.sub` pass per rule) and
+checks that both give the same output, then reports end-to-end `text_normalize`
+throughput over the document's paragraphs.
+
+Usage:
+    python -m tools.benchmark_text_frontend
+    python -m tools.benchmark_text_frontend --repeat 200 --iters 5
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+from cosyvoice.cli.frontend import TextFrontEnd, CUSTOM_REPLACE_RULES
+from cosyvoice.utils.frontend_utils import PUNCTUATION_CHARS, remove_bracket, tn_scientific_notation
+
+PARAGRAPHS = [
+    "今天是2025年3月14日，气温-3~5℃，湿度约为45%。请在18:30之前到达会议室（B栋3层）。",
+    "In 2024, the model reached 98.5% accuracy on the test set - a 12% improvement over the baseline!",
+    "已知α+β=π/2，且sinα>0，求证：①cosβ>0；②tanα·tanβ=1。∵α∈(0,π/2)，∴结论成立。",
+    "He said: \"The price is $19.99 per unit, or 3 units for $50.\" That's a good deal, isn't it?",
+    "欸，你听说了吗？噢——原来是这样……他的电话是138-0013-8000，邮箱是test_user@example.com。",
+    "设集合A⊆B，B∩C=∅，若x∉A且x∈C，则△ABC的面积为5m²，体积为2cm³，误差Δ<0.01。",
+    "Dr. Smith's lab (est. 1998) published 42 papers; see https://example.com/papers for details.",
+    "“春眠不觉晓，处处闻啼鸟。”这首诗的作者是孟浩然——唐代著名诗人；μ和σ分别表示均值与标准差。",
+]
+
+
+def build_document(repeat):
+    return [paragraph for _ in range(repeat) for paragraph in PARAGRAPHS]
+
+
+def legacy_pre_replace(sentence, custom_replace_path):
+    sentence = tn_scientific_notation(sentence)
+    sentence = re.sub(r'(?<=\d)\s*-\s*(?=\d)', '减', sentence)
+    sentence = sentence.replace('-', '')
+    sentence = re.sub(r'咯([' + re.escape(PUNCTUATION_CHARS) + r'])', r'喽\1', sentence)
+    if os.path.exists(custom_replace_path):
+        with open(custom_replace_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = json.loads(line)
+                sentence = sentence.replace(line['origin'], line['new'])
+    return sentence
+
+
+def legacy_post_replace(sentence):
+    sentence = remove_bracket(sentence)
+    sentence = sentence.replace(" - ", "，")
+    sentence = sentence.replace("——", "，")
+    sentence = re.sub(r'[,:：;；、]+', '，', sentence)
+    sentence = re.sub(r'[.…]+', '。', sentence)
+    sentence = re.sub(r'[_·]+', '', sentence)
+    sentence = re.sub(r"""['"‘’“”|]+""", '', sentence)
+    for k, v in [('†', '，'), ('²', '平方'), ('³', '立方'), ('/', '每'), ('~', '到'), ('～', '到')]:
+        sentence = sentence.replace(k, v)
+    maps = [
+        {'①': '一', '②': '二', '③': '三', '④': '四', '⑤': '五',
+         '⑥': '六', '⑦': '七', '⑧': '八', '⑨': '九', '⑩': '十'},
+        {'α': '阿尔法', 'β': '贝塔', 'γ': '伽玛', 'Γ': '伽玛',
+         'δ': '德尔塔', 'Δ': '德尔塔', '△': '德尔塔', 'ε': '艾普西龙',
+         'ζ': '捷塔', 'η': '依塔', 'θ': '西塔', 'Θ': '西塔',
+         'ι': '艾欧塔', 'κ': '喀帕', 'λ': '拉姆达', 'Λ': '拉姆达',
+         'μ': '缪', 'ν': '拗', 'ξ': '克西', 'Ξ': '克西',
+         'ο': '欧米克伦', 'π': '派', 'Π': '派', 'ρ': '肉',
+         'ς': '西格玛', 'Σ': '西格玛', 'σ': '西格玛', 'τ': '套',
+         'υ': '宇普西龙', 'φ': '服艾', 'Φ': '服艾', 'χ': '器',
+         'ψ': '普赛', 'Ψ': '普赛', 'ω': '欧米伽', 'Ω': '欧米伽',
+         '□': '方框'},
+        {'>': '大于', '<': '小于', '∈': '属于', '∉': '不属于',
+         '∪': '并', '∩': '交', '⊥': '垂直', '∥': '平行',
+         '≠': '不等于', '∵': '因为', '∴': '所以', '∅': '空集',
+         '⊂': '真包含于', '⊃': '包含', '⊆': '包含于', '⊇': '真包含',
+         '⊄': '不属于', '⊅': '非超集', '⊈': '不属于', '⊉': '非超集'},
+    ]
+    for replacements in maps:
+        for k, v in replacements.items():
+            sentence = sentence.replace(k, v)
+    return sentence
+
+
+def timed(fn, sentences, iters):
+    best = float("inf")
+    for _ in range(iters):
+        start = time.perf_counter()
+        outputs = [fn(sentence) for sentence in sentences]
+        best = min(best, time.perf_counter() - start)
+    return outputs, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text frontend replacement / normalisation throughput")
+    parser.add_argument("--repeat", type=int, default=100, help="Copies of the paragraph set in the document")
+    parser.add_argument("--iters", type=int, default=3, help="Timed passes (best is reported)")
+    args = parser.parse_args()
+
+    sentences = build_document(args.repeat)
+    num_chars = sum(len(sentence) for sentence in sentences)
+    print(f"document: {len(sentences)} paragraphs, {num_chars} chars")
+    frontend = TextFrontEnd(use_phoneme=False)
+
+    stages = [
+        ("pre_replace", lambda s: legacy_pre_replace(s, CUSTOM_REPLACE_RULES.path), frontend.pre_replace),
+        ("post_replace", legacy_post_replace, frontend.post_replace),
+    ]
+    print(f"{'stage':>14} {'legacy':>10} {'compiled':>10} {'speedup':>8} {'match':>6}")
+    for name, legacy_fn, new_fn in stages:
+        legacy_out, legacy_time = timed(legacy_fn, sentences, args.iters)
+        new_out, new_time = timed(new_fn, sentences, args.iters)
+        print(f"{name:>14} {legacy_time * 1000:>8.1f}ms {new_time * 1000:>8.1f}ms "
+              f"{legacy_time / new_time:>7.2f}x {str(legacy_out == new_out):>6}")
+
+    _, normalize_time = timed(frontend.text_normalize, sentences, args.iters)
+    print(f"text_normalize: {normalize_time:.2f}s, {num_chars / normalize_time:.0f} chars/s, "
+          f"{normalize_time / len(sentences) * 1000:.2f} ms/paragraph")
+
+
+if __name__ == "__main__":
+    main()
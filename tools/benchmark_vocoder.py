@@ -0,0 +1,72 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+CPU real-time factor of the training-form vocoders against their serving builds.
+
+Each vocoder renders random mels of --seconds of audio; RTF is the wall time per
+second of audio (lower is better). Serving builds come from
+tools/build_serving_vocoder.py; without one, the model is folded / frozen in memory.
+
+Usage:
+    python -m tools.benchmark_vocoder
+    python -m tools.benchmark_vocoder --vocoders hift --seconds 5 --threads 1
+"""
+import argparse
+import time
+
+import torch
+
+from utils.hift_util import load_hift
+from utils.vocos_util import load_vocos_jit
+
+# (loader, sample rate, hop size)
+VOCODERS = {
+    "hift": (load_hift, 24000, 480),
+    "vocos": (load_vocos_jit, 32000, 640),
+}
+
+
+def real_time_factor(vocoder, mel, seconds, repeats):
+    with torch.inference_mode():
+        vocoder(mel)  # warm-up (TorchScript profiling runs)
+        vocoder(mel)
+        start = time.time()
+        for _ in range(repeats):
+            vocoder(mel)
+    return (time.time() - start) / repeats / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU RTF of training-form vs serving vocoders")
+    parser.add_argument("--vocoders", default="hift,vocos", type=str, help="Comma-separated: hift, vocos")
+    parser.add_argument("--seconds", default=10.0, type=float, help="Audio length per call")
+    parser.add_argument("--threads", default=None, type=int, help="torch.set_num_threads (default: torch default)")
+    parser.add_argument("--repeats", default=5, type=int)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    print(f"{'vocoder':>8} {'form':>9} {'RTF':>8} {'speedup':>8}")
+    for name in args.vocoders.split(","):
+        loader, sample_rate, hop_size = VOCODERS[name]
+        mel = torch.randn(1, 80, int(args.seconds * sample_rate / hop_size))
+        baseline = None
+        for form, serving in (("training", False), ("serving", True)):
+            rtf = real_time_factor(loader("cpu", serving=serving), mel, args.seconds, args.repeats)
+            baseline = baseline or rtf
+            print(f"{name:>8} {form:>9} {rtf:>8.4f} {baseline / rtf:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Build the inference-optimised ("serving") vocoders and check them against the
+training-form models.
+
+- HiFT (24 kHz): weight norm is folded into the conv weights, Snake activations get
+  their alpha / 1/alpha precomputed, and every stage used at inference (full
+  vocoding, f0, decode, source merge for streaming) is traced and frozen to
+  ckpt/hift/hift_serving.jit.
+- Vocos (32 kHz): the TorchScript generator is frozen to
+  ckpt/vocos2d/generator_serving.jit; parameters become constants, so weight-norm
+  and other weight-only expressions are folded.
+
+Snake cannot be folded into the neighbouring convolution (it is not linear); in the
+frozen graph its elementwise ops are left to the TorchScript fuser.
+
+Parity: on random mels of several lengths, HiFT decode / f0 (given the same source)
+and Vocos output must match the training form within --atol; full HiFT vocoding is
+compared with the same random seed. Builds are made on one device but loaded on
+whatever device serves them, so each build is also loaded and checked on the other
+device (CUDA if built on CPU and vice versa) when one is available. The script exits
+with status 1 otherwise.
+Load the builds with VOCODER_SERVING_BUILD=true (API) or --vocoder_serving.
+
+Usage:
+    python -m tools.build_serving_vocoder
+    python -m tools.build_serving_vocoder --vocoders hift --device cuda
+    python -m tools.build_serving_vocoder --device cpu --cross_device cuda:1
+"""
+import argparse
+import sys
+
+import torch
+
+from utils.hift_util import HIFT_SERVING_PATH, load_hift
+from utils.vocos_util import VOCOS_SERVING_PATH, load_vocos_jit
+
+PARITY_FRAMES = (17, 100, 500)
+
+
+def max_error(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+
+def check_hift(hift, serving, device):
+    errors = {"f0": 0.0, "decode": 0.0, "vocode": 0.0}
+    for frames in PARITY_FRAMES:
+        mel = torch.randn(2, 80, frames, device=device)
+        source = torch.randn(2, 1, frames * hift.upsample_scale, device=device) * 0.1
+        with torch.inference_mode():
+            errors["f0"] = max(errors["f0"], max_error(serving.predict_f0(mel), hift.predict_f0(mel)))
+            errors["decode"] = max(errors["decode"], max_error(serving.decode(mel, source), hift.decode(mel, source)))
+            torch.manual_seed(frames)
+            ref = hift(mel)
+            torch.manual_seed(frames)
+            errors["vocode"] = max(errors["vocode"], max_error(serving(mel), ref))
+    return errors
+
+
+def check_vocos(vocos, serving, device):
+    error = 0.0
+    for frames in PARITY_FRAMES:
+        mel = torch.randn(2, 80, frames, device=device)
+        with torch.inference_mode():
+            error = max(error, max_error(serving(mel), vocos(mel)))
+    return {"vocode": error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and check the serving vocoders")
+    parser.add_argument("--vocoders", default="hift,vocos", type=str, help="Comma-separated: hift, vocos")
+    parser.add_argument("--device", default="cpu", type=str, help="Device to build and check on")
+    parser.add_argument("--atol", default=1e-4, type=float, help="Max abs sample / f0 error of the parity check")
+    parser.add_argument("--cross_device", default=None, type=str,
+                        help="Second device to load and check the builds on (default: cuda <-> cpu when available)")
+    args = parser.parse_args()
+
+    cross_device = args.cross_device
+    if cross_device is None:
+        if torch.device(args.device).type == "cpu":
+            cross_device = "cuda" if torch.cuda.is_available() else None
+        else:
+            cross_device = "cpu"
+
+    failed = False
+    for name in args.vocoders.split(","):
+        if name == "hift":
+            load, check, path = load_hift, check_hift, HIFT_SERVING_PATH
+        elif name == "vocos":
+            load, check, path = load_vocos_jit, check_vocos, VOCOS_SERVING_PATH
+        else:
+            raise ValueError(f"Unknown vocoder: {name}")
+
+        load(args.device).export_serving(path)
+        for device in [args.device] + ([cross_device] if cross_device else []):
+            try:
+                errors = check(load(device), load(device, serving=True), device)
+            except RuntimeError as e:
+                failed = True
+                print(f"[{name}] {path} on {device}: FAILED ({e})")
+                continue
+            ok = all(error <= args.atol for error in errors.values())
+            failed |= not ok
+            print(f"[{name}] {path} on {device}: " + " ".join(f"{k}={v:.2e}" for k, v in errors.items())
+                  + (" OK" if ok else f" FAILED (atol={args.atol})"))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
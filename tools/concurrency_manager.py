@@ -13,7 +13,7 @@
 # limitations under the License.
 """
 并发控制管理模块
-基于文本长度管理不同的并发限制
+基于文本长度管理不同的并发限制；启用解码引擎时改由引擎按空闲 KV 块做准入控制
 """
 import asyncio
 import time
@@ -35,11 +35,14 @@ class ConcurrencyManager:
             'long_text_total': 0
         }
         self._lock = asyncio.Lock()
+        # 为 True 时不再按文本长度限流，排队与拒绝由解码引擎根据空闲 KV 块决定
+        self.kv_admission: bool = False
     
     def initialize(self):
         """初始化信号量"""
         self.short_text_semaphore = asyncio.Semaphore(TTSConfig.SHORT_TEXT_CONCURRENCY)
         self.long_text_semaphore = asyncio.Semaphore(TTSConfig.LONG_TEXT_CONCURRENCY)
+        self.kv_admission = TTSConfig.ENABLE_DECODE_ENGINE
     
     def get_semaphore(self, text_length: int) -> asyncio.Semaphore:
         """
@@ -63,8 +66,9 @@ class ConcurrencyManager:
         Args:
             text_length: 文本长度（字符数）
         """
-        semaphore = self.get_semaphore(text_length)
-        await semaphore.acquire()
+        if not self.kv_admission:
+            semaphore = self.get_semaphore(text_length)
+            await semaphore.acquire()
         
         async with self._lock:
             if text_length <= TTSConfig.TEXT_LENGTH_THRESHOLD:
@@ -81,8 +85,9 @@ class ConcurrencyManager:
         Args:
             text_length: 文本长度（字符数）
         """
-        semaphore = self.get_semaphore(text_length)
-        semaphore.release()
+        if not self.kv_admission:
+            semaphore = self.get_semaphore(text_length)
+            semaphore.release()
         
         # 更新统计信息（需要锁保护）
         async with self._lock:
@@ -100,6 +105,7 @@ class ConcurrencyManager:
         """
         async with self._lock:
             return {
+                'kv_admission': self.kv_admission,
                 'short_text': {
                     'active': self.stats['short_text_active'],
                     'total': self.stats['short_text_total'],
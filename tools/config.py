@@ -40,6 +40,45 @@ class TTSConfig:
     # 多进程配置
     WORKER_PROCESSES: int = int(os.getenv('WORKERS', '1'))  # 默认单进程
     
+    # LLM 权重量化（int8：CPU 动态量化；int4：仅权重量化，按组缩放；留空表示 fp32）
+    LLM_QUANTIZATION: str = os.getenv('LLM_QUANTIZATION', '').lower()
+    # 解码 LM head（on：只计算音频 token 与 eoa 的 logits；full：同上，但 RAS nucleus 按全词表概率截断；off：全词表）
+    LLM_AUDIO_HEAD: str = os.getenv('LLM_AUDIO_HEAD', 'on').lower()
+    
+    # 连续批处理解码引擎配置
+    ENABLE_DECODE_ENGINE: bool = os.getenv('ENABLE_DECODE_ENGINE', 'false').lower() == 'true'
+    DECODE_ENGINE_MAX_BATCH: int = int(os.getenv('DECODE_ENGINE_MAX_BATCH', '8'))  # 同时解码的最大序列数
+    PREFILL_CHUNK_SIZE: int = int(os.getenv('PREFILL_CHUNK_SIZE', '256'))  # 每步 prefill 的最大 token 数，0 表示整段 prefill
+    
+    # 分页 KV Cache 配置（启用解码引擎时生效，按空闲 KV 块做准入控制，替代按文本长度的并发限制）
+    KV_CACHE_MEMORY_MB: float = float(os.getenv('KV_CACHE_MEMORY_MB', '1024'))  # KV Cache 显存预算（MB）
+    KV_CACHE_BLOCK_SIZE: int = int(os.getenv('KV_CACHE_BLOCK_SIZE', '16'))  # 每个 KV 块包含的 token 数
+    KV_CACHE_QUANTIZATION: str = os.getenv('KV_CACHE_QUANTIZATION', '').lower()  # KV 存储格式：int8 或留空（与模型精度一致）
+    
+    # 前缀 KV Cache 配置（复用说话人 prompt / 已注册音色 prompt 文本等公共前缀的 KV）
+    ENABLE_PREFIX_CACHE: bool = os.getenv('ENABLE_PREFIX_CACHE', 'false').lower() == 'true'
+    PREFIX_CACHE_MAX_MB: float = float(os.getenv('PREFIX_CACHE_MAX_MB', '0'))  # 前缀缓存占用上限（MB），0 表示不单独限制
+    
+    # 投机解码配置（n-gram 草稿，未启用解码引擎时生效）
+    SPECULATIVE_NGRAM_TOKENS: int = int(os.getenv('SPECULATIVE_NGRAM_TOKENS', '0'))  # 每步草稿 token 数，0 表示关闭
+    
+    # Flow（DiT）采样配置
+    FLOW_FUSED_CFG: bool = os.getenv('FLOW_FUSED_CFG', 'true').lower() == 'true'  # CFG 两个分支合并为一次批量前向
+    FLOW_BATCH_SIZE: int = int(os.getenv('FLOW_BATCH_SIZE', '1'))  # 长文本各分段合并渲染的最大 batch，1 表示逐段渲染
+    FLOW_BLOCK_SPARSE_ATTN: bool = os.getenv('FLOW_BLOCK_SPARSE_ATTN', 'true').lower() == 'true'  # 块因果注意力按块计算，不构造 T×T 稠密 mask
+    FLOW_GUIDANCE: str = os.getenv('FLOW_GUIDANCE', '')  # 默认 CFG 调度（如 "2-7"），空表示每步都做 CFG
+    FLOW_ADAPTIVE_TOLERANCE: float = float(os.getenv('FLOW_ADAPTIVE_TOLERANCE', '0'))  # 相邻两步平均速度相对变化低于该值时提前结束，0 表示关闭
+    FLOW_MIN_STEPS: int = int(os.getenv('FLOW_MIN_STEPS', '3'))  # 自适应步数下至少执行的步数
+    FLOW_LATENCY_BUDGET: float = float(os.getenv('FLOW_LATENCY_BUDGET', '0'))  # 每次 Flow 采样的目标耗时（秒），按实测代价减少步数，0 表示关闭
+    
+    # 声码器配置
+    VOCODER_SERVING_BUILD: bool = os.getenv('VOCODER_SERVING_BUILD', 'false').lower() == 'true'  # 加载折叠 weight norm 并冻结的推理版声码器
+    VOCODER_BATCH_SIZE: int = int(os.getenv('VOCODER_BATCH_SIZE', '1'))  # 各分段及并发请求合并声码的最大 batch，1 表示逐段声码
+    VOCODER_BATCH_WAIT_MS: float = float(os.getenv('VOCODER_BATCH_WAIT_MS', '5'))  # 等待其他请求凑批的最长时间（毫秒）
+    
+    # 模型常驻配置（LLM/Flow/语音 tokenizer 只加载一次，24k/32k 声码器按需加载并常驻）
+    MODEL_MEMORY_BUDGET_MB: float = float(os.getenv('MODEL_MEMORY_BUDGET_MB', '0'))  # 常驻模型显存预算（MB），超出时淘汰最久未用的空闲声码器，0 表示不限制
+    
     @classmethod
     def get_timeout(cls, text_length: int) -> int:
         """
@@ -98,6 +137,40 @@ class TTSConfig:
                 'worker_count': cls.WORKER_COUNT,
                 'enabled': cls.ENABLE_QUEUE_MODE
             },
-            'workers': cls.WORKER_PROCESSES
+            'workers': cls.WORKER_PROCESSES,
+            'llm_quantization': cls.LLM_QUANTIZATION or None,
+            'llm_audio_head': cls.LLM_AUDIO_HEAD,
+            'decode_engine': {
+                'enabled': cls.ENABLE_DECODE_ENGINE,
+                'max_batch_size': cls.DECODE_ENGINE_MAX_BATCH,
+                'prefill_chunk_size': cls.PREFILL_CHUNK_SIZE,
+                'kv_cache_memory_mb': cls.KV_CACHE_MEMORY_MB,
+                'kv_cache_block_size': cls.KV_CACHE_BLOCK_SIZE,
+                'kv_cache_quantization': cls.KV_CACHE_QUANTIZATION or None
+            },
+            'prefix_cache': {
+                'enabled': cls.ENABLE_PREFIX_CACHE,
+                'max_mb': cls.PREFIX_CACHE_MAX_MB
+            },
+            'speculative': {
+                'ngram_tokens': cls.SPECULATIVE_NGRAM_TOKENS
+            },
+            'flow': {
+                'fused_cfg': cls.FLOW_FUSED_CFG,
+                'batch_size': cls.FLOW_BATCH_SIZE,
+                'block_sparse_attn': cls.FLOW_BLOCK_SPARSE_ATTN,
+                'guidance': cls.FLOW_GUIDANCE or 'all',
+                'adaptive_tolerance': cls.FLOW_ADAPTIVE_TOLERANCE,
+                'min_steps': cls.FLOW_MIN_STEPS,
+                'latency_budget': cls.FLOW_LATENCY_BUDGET
+            },
+            'models': {
+                'memory_budget_mb': cls.MODEL_MEMORY_BUDGET_MB or None
+            },
+            'vocoder': {
+                'serving_build': cls.VOCODER_SERVING_BUILD,
+                'batch_size': cls.VOCODER_BATCH_SIZE,
+                'batch_wait_ms': cls.VOCODER_BATCH_WAIT_MS
+            }
         }
 
@@ -11,17 +11,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import contextlib
 import gradio as gr
 import torch
 import numpy as np
 import logging
 import os
+import threading
 from glmtts_inference import (
-    load_models,
+    load_shared_models,
+    make_feat_extractor,
     generate_long,
     local_llm_forward,
+    local_flow_forward,
+    local_flow_batch_forward,
+    local_vocode_batch,
     DEVICE
 )
+from llm.engine import DecodeEngine, EngineOverloadedError
+from llm.speculative import NGramProposer
+from flow.adaptive import AdaptiveStepController
+from utils.tts_model_util import Token2Wav
+from utils.vocoder_batch import VocoderBatcher
+from tools.model_registry import ModelRegistry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,40 +43,345 @@ MODEL_CACHE = {
     "loaded": False,
     "sample_rate": None,
     "use_phoneme": None,
-    "components": None
+    "registry": None,
+    "engine": None
 }
+# Concurrent first requests must not build two registries (and load the LLM twice)
+_REGISTRY_LOCK = threading.Lock()
 
-def get_models(use_phoneme=False, sample_rate=24000):
+# Budget for all resident models; idle sample-rate back ends beyond it are evicted (None: no limit)
+MODEL_REGISTRY_CONFIG = {
+    "memory_budget_mb": None
+}
+
+def set_model_memory_budget(memory_mb=None):
+    """
+    Memory budget (MB) for the resident models. The LLM, flow and speech tokenizer are
+    always kept; idle vocoder back ends (24 kHz HiFT, 32 kHz Vocos) are evicted, least
+    recently used first, while the total exceeds it. None keeps everything loaded.
+    Takes effect the next time models are loaded.
+    """
+    MODEL_REGISTRY_CONFIG["memory_budget_mb"] = memory_mb or None
+
+def get_model_registry_stats():
+    """
+    Return resident model sizes, per-rate back ends and load/eviction counters, or None before the first load.
+    """
+    registry = MODEL_CACHE["registry"]
+    return registry.get_stats() if registry is not None else None
+
+# LLM weight quantization ("int8", "int4" or None for fp32), KV-cache format ("int8" or None)
+# and decode head ("on", "full" or "off")
+LLM_QUANT_CONFIG = {
+    "mode": None,
+    "kv_cache": None,
+    "audio_head": "on"
+}
+
+def enable_llm_quantization(mode="int8"):
+    """
+    Quantize the LLM decoder layers after loading ("int8": dynamic, CPU only;
+    "int4": weight-only). Takes effect the next time models are loaded.
+    """
+    LLM_QUANT_CONFIG["mode"] = mode
+
+def enable_kv_cache_quantization(mode="int8"):
+    """
+    Store the LLM KV cache as int8 with per-head scales, so the same KV memory budget
+    holds more concurrent tokens. Takes effect the next time models are loaded.
+    """
+    LLM_QUANT_CONFIG["kv_cache"] = mode
+
+def set_llm_audio_head(mode="on"):
+    """
+    Decode head of the LLM: "on" computes logits over the audio tokens plus eoa only,
+    "full" also keeps the full-vocabulary normaliser for the RAS nucleus (costs the full
+    projection), "off" decodes over the full vocabulary. Takes effect the next time
+    models are loaded.
+    """
+    LLM_QUANT_CONFIG["audio_head"] = mode
+
+# Continuous-batching decode engine settings (disabled by default)
+ENGINE_CONFIG = {
+    "enabled": False,
+    "max_batch_size": 8,
+    "kv_cache_memory_mb": 1024,
+    "kv_block_size": 16,
+    "max_waiting": None,
+    "prefill_chunk_size": None
+}
+
+def enable_decode_engine(max_batch_size=8, kv_cache_memory_mb=1024, kv_block_size=16, max_waiting=None,
+                         prefill_chunk_size=None):
+    """
+    Route LLM decoding through a shared DecodeEngine so concurrent requests are batched.
+    Requests are admitted based on free KV-cache blocks; once `max_waiting` requests are
+    queued, further ones are rejected with EngineOverloadedError. With `prefill_chunk_size`,
+    prompts are prefilled at most that many tokens per step, interleaved with decoding.
+    Takes effect the next time models are loaded.
+    """
+    ENGINE_CONFIG["enabled"] = True
+    ENGINE_CONFIG["max_batch_size"] = max_batch_size
+    ENGINE_CONFIG["kv_cache_memory_mb"] = kv_cache_memory_mb
+    ENGINE_CONFIG["kv_block_size"] = kv_block_size
+    ENGINE_CONFIG["max_waiting"] = max_waiting
+    ENGINE_CONFIG["prefill_chunk_size"] = prefill_chunk_size
+
+def get_engine_stats():
+    """
+    Return decode engine statistics, or None if the engine is not running.
+    """
+    engine = MODEL_CACHE.get("engine")
+    return engine.get_stats() if engine is not None else None
+
+# Prefix KV cache settings (disabled by default)
+PREFIX_CACHE_CONFIG = {
+    "enabled": False,
+    "memory_mb": 512,
+    "max_cached_mb": None,
+    "block_size": 16
+}
+
+def enable_prefix_cache(memory_mb=512, max_cached_mb=None, block_size=16):
+    """
+    Keep KV blocks of shared prompt prefixes (speaker prompt, registered prompt text)
+    between requests. With the decode engine the engine's KV pool is used and
+    `memory_mb`/`block_size` are ignored. Takes effect the next time models are loaded.
+    """
+    PREFIX_CACHE_CONFIG["enabled"] = True
+    PREFIX_CACHE_CONFIG["memory_mb"] = memory_mb
+    PREFIX_CACHE_CONFIG["max_cached_mb"] = max_cached_mb
+    PREFIX_CACHE_CONFIG["block_size"] = block_size
+
+# Speculative decoding settings (disabled by default)
+SPECULATIVE_CONFIG = {
+    "ngram_tokens": 0
+}
+
+def enable_speculative_decoding(ngram_tokens=4):
+    """
+    Draft up to `ngram_tokens` tokens per step by n-gram lookup in the prompt speech
+    tokens and the generated history, verified in one LLM pass. Only used without the
+    decode engine. Takes effect the next time models are loaded.
+    """
+    SPECULATIVE_CONFIG["ngram_tokens"] = ngram_tokens
+
+# Flow (DiT) sampling settings
+FLOW_CONFIG = {
+    "fused_cfg": True,
+    "batch_size": 1,
+    "block_sparse_attn": True,
+    "guidance": None,
+    "step_controller": None
+}
+
+def set_flow_fused_cfg(enabled=True):
+    """
+    Run the conditional and unconditional classifier-free guidance branches of the
+    Flow model as one batched DiT call per step (default). Disable on memory-constrained
+    hosts to use two sequential calls with half the activation memory.
+    Takes effect the next time models are loaded.
+    """
+    FLOW_CONFIG["fused_cfg"] = enabled
+
+def set_flow_batch_size(batch_size=8):
+    """
+    Render the text segments of a request in flow batches of up to `batch_size`
+    (one padded DiT batch per ODE step) after all LLM calls, instead of one by one.
+    """
+    FLOW_CONFIG["batch_size"] = batch_size
+
+def set_flow_block_sparse_attn(enabled=True):
+    """
+    Evaluate the block-causal DiT attention (streaming) block by block over the key
+    ranges each block can see (default), instead of one dense (B, 1, T, T) mask.
+    Takes effect the next time models are loaded.
     """
-    Lazy loader for models. Reloads if sample_rate or use_phoneme changes.
-    """
-    # Check if loaded and if sample_rate and use_phoneme match
-    if (MODEL_CACHE["loaded"] and 
-        MODEL_CACHE["sample_rate"] == sample_rate and 
-        MODEL_CACHE["use_phoneme"] == use_phoneme):
-        return MODEL_CACHE["components"]
-    
-    logging.info(f"Loading models with sample_rate={sample_rate}...")
-    
-    # Clean up old models if they exist to save VRAM before loading new ones
-    if MODEL_CACHE["components"]:
-        del MODEL_CACHE["components"]
-        import gc
-        gc.collect()
-        torch.cuda.empty_cache()
-
-    # Load models using the function from glmtts_inference.py
-    frontend, text_frontend, speech_tokenizer, llm, flow = load_models(
-        use_phoneme=use_phoneme, 
-        sample_rate=sample_rate
+    FLOW_CONFIG["block_sparse_attn"] = enabled
+
+def set_flow_guidance(schedule=None):
+    """
+    Default classifier-free guidance schedule for requests that do not set one, e.g.
+    "2-7" to run the unconditional branch only on steps 2..7 (see flow/guidance.py).
+    None guides every step.
+    """
+    FLOW_CONFIG["guidance"] = schedule or None
+
+def enable_flow_adaptive_steps(tolerance=0.0, min_steps=3, latency_budget=None):
+    """
+    Let offline flow sampling stop early once the ODE trajectory is straight (relative
+    velocity change below `tolerance`) and/or plan fewer steps to keep one sampling call
+    within `latency_budget` seconds. Takes effect the next time models are loaded.
+    """
+    FLOW_CONFIG["step_controller"] = AdaptiveStepController(
+        tolerance=tolerance, min_steps=min_steps, latency_budget=latency_budget
+    )
+
+VOCODER_CONFIG = {
+    "serving": False,
+    "batch_size": 1,
+    "max_wait_ms": 5.0
+}
+
+def set_vocoder_serving_build(enabled=True):
+    """
+    Load the vocoder serving build (weight norm folded, frozen TorchScript; see
+    tools/build_serving_vocoder.py). Takes effect the next time models are loaded.
+    """
+    VOCODER_CONFIG["serving"] = enabled
+
+def set_vocoder_batching(batch_size=8, max_wait_ms=5.0):
+    """
+    Vocode the segments of a request together, and coalesce vocoding of concurrent
+    requests in a background batcher (up to `batch_size` mels per forward, waiting at
+    most `max_wait_ms` for others to join). 1 vocodes every segment on its own.
+    The batcher starts the next time models are loaded.
+    """
+    VOCODER_CONFIG["batch_size"] = batch_size
+    VOCODER_CONFIG["max_wait_ms"] = max_wait_ms
+
+def get_vocoder_batch_stats():
+    """
+    Return vocoder batcher counters per resident sample rate, or None if vocoder batching is off.
+    """
+    registry = MODEL_CACHE["registry"]
+    if registry is None or VOCODER_CONFIG["batch_size"] <= 1:
+        return None
+    with registry.lock:
+        batchers = {rate: backend.token2wav.vocode_batcher for rate, backend in registry.backends.items()}
+    return {rate: batcher.get_stats() for rate, batcher in batchers.items() if batcher is not None}
+
+def get_flow_step_stats():
+    """
+    Return adaptive flow step counters, or None if the controller is off.
+    """
+    controller = FLOW_CONFIG["step_controller"]
+    return controller.get_stats() if controller is not None else None
+
+def get_prefix_cache_stats():
+    """
+    Return prefix cache hit counters, or None if prefix caching is off.
+    """
+    engine = MODEL_CACHE.get("engine")
+    if engine is not None:
+        prefix_cache = engine.kv_cache.prefix_cache
+    elif MODEL_CACHE["registry"] is not None and MODEL_CACHE["registry"].loaded:
+        prefix_cache = MODEL_CACHE["registry"].shared["llm"].prefix_cache
+    else:
+        prefix_cache = None
+    return prefix_cache.get_stats() if prefix_cache is not None else None
+
+def _shutdown_engine():
+    if MODEL_CACHE.get("engine") is not None:
+        MODEL_CACHE["engine"].shutdown()
+        MODEL_CACHE["engine"] = None
+
+def _load_shared_models(sample_rate):
+    """Speech tokenizer, LLM (or decode engine), flow and frontends, shared by all sample rates."""
+    frontend, text_frontend, speech_tokenizer, llm, flow = load_shared_models(
+        sample_rate=sample_rate,
+        llm_quantization=LLM_QUANT_CONFIG["mode"],
+        kv_cache_quantization=LLM_QUANT_CONFIG["kv_cache"],
+        audio_head=LLM_QUANT_CONFIG["audio_head"],
     )
-    
-    MODEL_CACHE["components"] = (frontend, text_frontend, speech_tokenizer, llm, flow)
+
+    flow.fused_cfg = FLOW_CONFIG["fused_cfg"]
+    flow.estimator.block_sparse_attn = FLOW_CONFIG["block_sparse_attn"]
+    flow.step_controller = FLOW_CONFIG["step_controller"]
+
+    # The engine exposes the same `inference` interface, so it replaces llm transparently
+    if ENGINE_CONFIG["enabled"]:
+        llm = DecodeEngine(
+            llm,
+            max_batch_size=ENGINE_CONFIG["max_batch_size"],
+            kv_cache_memory_mb=ENGINE_CONFIG["kv_cache_memory_mb"],
+            kv_block_size=ENGINE_CONFIG["kv_block_size"],
+            max_waiting=ENGINE_CONFIG["max_waiting"],
+            enable_prefix_cache=PREFIX_CACHE_CONFIG["enabled"],
+            prefix_cache_memory_mb=PREFIX_CACHE_CONFIG["max_cached_mb"],
+            prefill_chunk_size=ENGINE_CONFIG["prefill_chunk_size"],
+        ).start()
+        MODEL_CACHE["engine"] = llm
+        kv_usage = llm.kv_cache.usage()
+        logging.info(f"Decode engine started (max_batch_size={ENGINE_CONFIG['max_batch_size']}, "
+                     f"kv_blocks={kv_usage['total_blocks']}, kv_mb={kv_usage['total_mb']}).")
+    elif PREFIX_CACHE_CONFIG["enabled"]:
+        llm.enable_prefix_cache(
+            memory_budget_mb=PREFIX_CACHE_CONFIG["memory_mb"],
+            max_cached_mb=PREFIX_CACHE_CONFIG["max_cached_mb"],
+            block_size=PREFIX_CACHE_CONFIG["block_size"],
+        )
+        logging.info(f"Prefix cache enabled (kv_mb={PREFIX_CACHE_CONFIG['memory_mb']}).")
+    if not ENGINE_CONFIG["enabled"] and SPECULATIVE_CONFIG["ngram_tokens"] > 0:
+        llm.speculative_proposer = NGramProposer(num_tokens=SPECULATIVE_CONFIG["ngram_tokens"])
+        logging.info(f"Speculative decoding enabled (ngram_tokens={SPECULATIVE_CONFIG['ngram_tokens']}).")
+
+    return {
+        "frontend": frontend,
+        "text_frontend": text_frontend,
+        "speech_tokenizer": speech_tokenizer,
+        "llm": llm,
+        "flow": flow,
+    }
+
+def _load_rate_backend(shared, sample_rate):
+    """Prompt frontend and Token2Wav (vocoder) of `sample_rate` on top of the shared models."""
+    frontend = shared["frontend"].with_feat_extractor(make_feat_extractor(sample_rate))
+    token2wav = Token2Wav(shared["flow"], sample_rate=sample_rate, device=DEVICE,
+                          serving_vocoder=VOCODER_CONFIG["serving"])
+    if VOCODER_CONFIG["batch_size"] > 1:
+        token2wav.vocode_batcher = VocoderBatcher(
+            token2wav.vocoder,
+            max_batch_size=VOCODER_CONFIG["batch_size"],
+            max_wait_ms=VOCODER_CONFIG["max_wait_ms"],
+        ).start()
+        logging.info(f"Vocoder batcher started for {sample_rate} Hz (max_batch_size={VOCODER_CONFIG['batch_size']}, "
+                     f"max_wait_ms={VOCODER_CONFIG['max_wait_ms']}).")
+    return frontend, token2wav
+
+def _release_rate_backend(backend):
+    if backend.token2wav is not None and backend.token2wav.vocode_batcher is not None:
+        backend.token2wav.vocode_batcher.shutdown()
+
+def _get_registry():
+    registry = MODEL_CACHE["registry"]
+    if registry is None:
+        with _REGISTRY_LOCK:
+            registry = MODEL_CACHE["registry"]
+            if registry is None:
+                registry = ModelRegistry(
+                    _load_shared_models,
+                    _load_rate_backend,
+                    release_backend=_release_rate_backend,
+                    memory_budget_mb=MODEL_REGISTRY_CONFIG["memory_budget_mb"],
+                )
+                MODEL_CACHE["registry"] = registry
+    return registry
+
+def _mark_loaded(sample_rate, use_phoneme):
     MODEL_CACHE["sample_rate"] = sample_rate
     MODEL_CACHE["use_phoneme"] = use_phoneme
     MODEL_CACHE["loaded"] = True
-    logging.info(f"Models loaded successfully. (sample_rate={sample_rate}, use_phoneme={use_phoneme})")
-    return MODEL_CACHE["components"]
+
+def get_models(use_phoneme=False, sample_rate=24000):
+    """
+    Lazy loader for models. The speech tokenizer, LLM and flow are loaded once; the
+    vocoder and feature extractor of each sample rate are loaded on first use and stay
+    resident (see tools/model_registry.py). G2P resources load on the first phoneme request.
+    """
+    components = _get_registry().get(sample_rate)
+    _mark_loaded(sample_rate, use_phoneme)
+    return components
+
+@contextlib.contextmanager
+def lease_models(use_phoneme=False, sample_rate=24000):
+    """
+    `get_models` for the duration of a request: the back end of `sample_rate` is not
+    evicted while the block runs.
+    """
+    with _get_registry().lease(sample_rate) as components:
+        _mark_loaded(sample_rate, use_phoneme)
+        yield components
 
 def custom_local_llm_forward(llm, prompt_text_token, tts_text_token, prompt_speech_token, 
                               beam_size=1, sampling=25, sample_method="ras"):
@@ -82,9 +399,11 @@ def custom_local_llm_forward(llm, prompt_text_token, tts_text_token, prompt_spee
     )
 
 def run_inference(prompt_text, prompt_audio_path, input_text, seed, sample_rate, 
-                  use_cache, use_phoneme, sample_method, sampling, beam_size):
+                  use_cache, use_phoneme, sample_method, sampling, beam_size,
+                  flow_solver="euler", flow_steps=10, flow_guidance=None):
     """
     Main inference handler for Gradio with all advanced features.
+    `flow_guidance` is a CFG schedule (flow/guidance.py); None uses the server default.
     """
     if not input_text:
         raise gr.Error("Please provide text to synthesize.")
@@ -93,9 +412,13 @@ def run_inference(prompt_text, prompt_audio_path, input_text, seed, sample_rate,
     if not prompt_text:
         gr.Warning("Prompt text is empty. Results might be suboptimal.")
 
+    # Holds the sample-rate back end for the whole request (not evicted meanwhile)
+    request_models = contextlib.ExitStack()
     try:
         # 1. Load Models (Pass sample_rate and use_phoneme)
-        frontend, text_frontend, _, llm, flow = get_models(use_phoneme=use_phoneme, sample_rate=sample_rate)
+        frontend, text_frontend, _, llm, flow = request_models.enter_context(
+            lease_models(use_phoneme=use_phoneme, sample_rate=sample_rate)
+        )
 
         # 2. Pre-process Prompt (Text Normalization)
         norm_prompt_text = text_frontend.text_normalize(prompt_text) + ' '
@@ -140,23 +463,50 @@ def run_inference(prompt_text, prompt_audio_path, input_text, seed, sample_rate,
             sampling=sampling,
             sample_method=sample_method
         )
-        
-        tts_speech, _, _, _ = generate_long(
-            frontend=frontend,
-            text_frontend=text_frontend,
-            llm=llm,
-            flow=flow,
-            text_info=['', norm_input_text],
-            cache=cache,
-            embedding=embedding,
-            flow_prompt_token=flow_prompt_token,
-            speech_feat=speech_feat,
-            sample_method=sample_method,
-            seed=seed,
-            device=DEVICE,
-            use_phoneme=use_phoneme,
-            local_llm_forward=custom_llm_forward
+        if flow_guidance is None:
+            flow_guidance = FLOW_CONFIG["guidance"]
+        custom_flow_forward = partial(
+            local_flow_forward,
+            n_timesteps=int(flow_steps),
+            solver=flow_solver,
+            guidance=flow_guidance
         )
+        
+        # Per-request record of the flow steps used (adaptive step controller)
+        controller = FLOW_CONFIG["step_controller"]
+        step_records = controller.collect() if controller is not None else contextlib.nullcontext([])
+        with step_records as flow_calls:
+            tts_speech, _, _, _ = generate_long(
+                frontend=frontend,
+                text_frontend=text_frontend,
+                llm=llm,
+                flow=flow,
+                text_info=['', norm_input_text],
+                cache=cache,
+                embedding=embedding,
+                flow_prompt_token=flow_prompt_token,
+                speech_feat=speech_feat,
+                sample_method=sample_method,
+                seed=seed,
+                device=DEVICE,
+                use_phoneme=use_phoneme,
+                local_llm_forward=custom_llm_forward,
+                local_flow_forward=custom_flow_forward,
+                local_flow_batch_forward=partial(
+                    local_flow_batch_forward,
+                    n_timesteps=int(flow_steps),
+                    solver=flow_solver,
+                    max_batch_size=FLOW_CONFIG["batch_size"],
+                    guidance=flow_guidance
+                ) if FLOW_CONFIG["batch_size"] > 1 else None,
+                local_vocode_batch=partial(
+                    local_vocode_batch,
+                    max_batch_size=VOCODER_CONFIG["batch_size"]
+                ) if VOCODER_CONFIG["batch_size"] > 1 else None
+            )
+        if flow_calls:
+            logging.info("Flow steps per call (used/planned/requested): " + ", ".join(
+                f"{r['used_steps']}/{r['planned_steps']}/{r['requested_steps']}" for r in flow_calls))
 
         # 6. Post-process Audio
         # Convert torch tensor to int16 numpy array for Gradio
@@ -168,27 +518,28 @@ def run_inference(prompt_text, prompt_audio_path, input_text, seed, sample_rate,
         # Update: Return dynamic sample_rate instead of hardcoded 32000
         return (sample_rate, audio_int16)
 
+    except EngineOverloadedError:
+        # Let the API layer map capacity errors to 503 instead of a generic failure
+        raise
     except Exception as e:
         logging.error(f"Inference failed: {e}")
         import traceback
         traceback.print_exc()
         raise gr.Error(f"Inference failed: {str(e)}")
+    finally:
+        request_models.close()
 
 def clear_memory():
     """
     Clears VRAM and resets the model cache.
     """
     global MODEL_CACHE
-    if MODEL_CACHE["components"]:
-        del MODEL_CACHE["components"]
-    MODEL_CACHE["components"] = None
+    _shutdown_engine()
+    if MODEL_CACHE["registry"] is not None:
+        MODEL_CACHE["registry"].clear()
     MODEL_CACHE["loaded"] = False
     MODEL_CACHE["sample_rate"] = None
     MODEL_CACHE["use_phoneme"] = None
-    
-    import gc
-    gc.collect()
-    torch.cuda.empty_cache()
     return "Memory cleared. Models will reload on next inference."
 
 # --- Gradio UI Layout ---
@@ -0,0 +1,303 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Resident models of the serving stack.
+
+The speech tokenizer, LLM, flow model and text frontend do not depend on the
+output sample rate and are loaded once. Only the vocoder (HiFT at 24 kHz, Vocos
+at 32 kHz) and the prompt feature extractor are rate specific; they form one
+back end per rate, loaded on first use and kept resident next to the others.
+
+With a memory budget, idle back ends (no request holding them) are evicted,
+least recently used first, whenever the resident models exceed it. The back end
+being requested and back ends in use are never evicted.
+
+Loading never holds the registry lock: each rate loads under its own lock, so a
+cold 32 kHz load (or a reload after eviction) does not stall requests for a
+resident 24 kHz back end. Requests for the rate being loaded wait for that load.
+"""
+
+import collections
+import contextlib
+import gc
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+
+def module_nbytes(*objs) -> int:
+    """
+    Bytes of the parameters and buffers of `objs` (modules, or objects holding modules
+    as attributes), each tensor counted once.
+    """
+    seen = set()
+    total = 0
+    for obj in objs:
+        if isinstance(obj, torch.nn.Module):
+            modules = [obj]
+        else:
+            modules = [value for value in getattr(obj, "__dict__", {}).values() if isinstance(value, torch.nn.Module)]
+        for module in modules:
+            for tensor in list(module.parameters()) + list(module.buffers()):
+                key = (tensor.data_ptr(), tensor.numel())
+                if key in seen:
+                    continue
+                seen.add(key)
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def _measured(load_fn: Callable, estimate: Callable[[Any], int]) -> Tuple[Any, int]:
+    """Runs `load_fn` and returns its result with the device memory it took (CUDA) or an estimate."""
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_allocated()
+        result = load_fn()
+        torch.cuda.synchronize()
+        return result, max(torch.cuda.memory_allocated() - before, 0)
+    result = load_fn()
+    return result, estimate(result)
+
+
+class RateBackend:
+    """Rate-specific components: prompt frontend and Token2Wav (vocoder)."""
+
+    def __init__(self, sample_rate: int, frontend, token2wav, nbytes: int):
+        self.sample_rate = sample_rate
+        self.frontend = frontend
+        self.token2wav = token2wav
+        self.nbytes = nbytes
+        self.in_use = 0
+        self.last_used = time.time()
+
+
+class ModelRegistry:
+    def __init__(self,
+                 load_shared: Callable[[int], Dict[str, Any]],
+                 load_backend: Callable[[Dict[str, Any], int], Tuple[Any, Any]],
+                 release_backend: Optional[Callable[[RateBackend], None]] = None,
+                 memory_budget_mb: Optional[float] = None):
+        """
+        Args:
+            load_shared: sample_rate -> dict with "frontend", "text_frontend",
+                "speech_tokenizer", "llm" and "flow" (the frontend is only a template).
+            load_backend: (shared, sample_rate) -> (frontend, token2wav).
+            release_backend: Called for evicted back ends (e.g. to stop threads).
+            memory_budget_mb: Budget for all resident models (None: never evict).
+        """
+        self.load_shared = load_shared
+        self.load_backend = load_backend
+        self.release_backend = release_backend
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024) if memory_budget_mb else None
+
+        self.shared: Optional[Dict[str, Any]] = None
+        self.shared_nbytes = 0
+        # Least recently used first
+        self.backends: "collections.OrderedDict[int, RateBackend]" = collections.OrderedDict()
+        # Bookkeeping only; loads run under the shared / per-rate locks below
+        self.lock = threading.RLock()
+        self._shared_lock = threading.Lock()
+        self._load_locks: Dict[int, threading.Lock] = {}
+        self.stats: Dict[str, float] = {
+            "hits": 0,
+            "backend_loads": 0,
+            "evictions": 0,
+            "load_time": 0.0,
+        }
+
+    def get(self, sample_rate: int) -> Tuple[Any, Any, Any, Any, Any]:
+        """Returns (frontend, text_frontend, speech_tokenizer, llm, token2wav) for `sample_rate`."""
+        _, components = self._acquire(sample_rate, lease=False)
+        return components
+
+    @contextlib.contextmanager
+    def lease(self, sample_rate: int):
+        """Like `get`, but the back end cannot be evicted inside the block."""
+        backend, components = self._acquire(sample_rate, lease=True)
+        try:
+            yield components
+        finally:
+            with self.lock:
+                backend.in_use -= 1
+                backend.last_used = time.time()
+                # Back ends in use could not be evicted earlier; the most recent one stays
+                evicted = self._evict_to_budget(keep=next(reversed(self.backends))) if self.backends else []
+            for evicted_backend in evicted:
+                self._release(evicted_backend)
+
+    def evict(self, sample_rate: int) -> bool:
+        """Drops the back end of `sample_rate` (requests holding it keep their references)."""
+        with self.lock:
+            backend = self.backends.pop(sample_rate, None)
+        if backend is None:
+            return False
+        self._release(backend)
+        return True
+
+    def clear(self):
+        """Drops all back ends and the shared models."""
+        with self.lock:
+            backends = list(self.backends.values())
+            self.backends.clear()
+            self.shared = None
+            self.shared_nbytes = 0
+        for backend in backends:
+            self._release(backend)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    @property
+    def loaded(self) -> bool:
+        return self.shared is not None
+
+    def resident_nbytes(self) -> int:
+        with self.lock:
+            return self.shared_nbytes + sum(backend.nbytes for backend in self.backends.values())
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "shared_loaded": self.shared is not None,
+                "shared_mb": round(self.shared_nbytes / 1024 / 1024, 1),
+                "backends": {
+                    rate: {
+                        "mb": round(backend.nbytes / 1024 / 1024, 1),
+                        "in_use": backend.in_use,
+                        "idle_sec": round(time.time() - backend.last_used, 1) if not backend.in_use else 0.0,
+                    }
+                    for rate, backend in self.backends.items()
+                },
+                "resident_mb": round(self.resident_nbytes() / 1024 / 1024, 1),
+                "memory_budget_mb": round(self.memory_budget / 1024 / 1024, 1) if self.memory_budget else None,
+                "hits": self.stats["hits"],
+                "backend_loads": self.stats["backend_loads"],
+                "evictions": self.stats["evictions"],
+                "load_time": round(self.stats["load_time"], 2),
+            }
+
+    # ------------------------------------------------------------------
+
+    def _components(self, backend: RateBackend):
+        shared = self.shared
+        return backend.frontend, shared["text_frontend"], shared["speech_tokenizer"], shared["llm"], backend.token2wav
+
+    def _ensure_shared(self, sample_rate: int) -> Dict[str, Any]:
+        shared = self.shared
+        if shared is not None:
+            return shared
+        with self._shared_lock:
+            if self.shared is None:
+                logging.info(f"Loading shared models (sample_rate={sample_rate})...")
+                start = time.time()
+                shared, nbytes = _measured(
+                    lambda: self.load_shared(sample_rate),
+                    lambda loaded: module_nbytes(loaded["llm"], loaded["flow"], loaded["speech_tokenizer"]),
+                )
+                with self.lock:
+                    self.shared, self.shared_nbytes = shared, nbytes
+                    self.stats["load_time"] += time.time() - start
+            return self.shared
+
+    def _acquire(self, sample_rate: int, lease: bool) -> Tuple[RateBackend, Tuple[Any, Any, Any, Any, Any]]:
+        """Returns the back end of `sample_rate` and its components, loading what is missing."""
+        while True:
+            shared = self._ensure_shared(sample_rate)
+            if shared is None:
+                # Cleared right after loading
+                continue
+            backend, evicted = None, []
+            with self.lock:
+                if sample_rate in self.backends and self.shared is not None:
+                    backend = self.backends[sample_rate]
+                    self.stats["hits"] += 1
+                    components, evicted = self._use(backend, lease)
+                else:
+                    load_lock = self._load_locks.setdefault(sample_rate, threading.Lock())
+            if backend is None:
+                backend, components, evicted = self._load(sample_rate, shared, load_lock, lease)
+            for evicted_backend in evicted:
+                self._release(evicted_backend)
+            if backend is not None:
+                return backend, components
+
+    def _load(self, sample_rate: int, shared: Dict[str, Any], load_lock: threading.Lock, lease: bool):
+        """
+        Loads the back end of `sample_rate` under its own lock, outside the registry lock.
+        Returns (backend, components, evicted), or Nones if the caller has to look again.
+        """
+        with load_lock:
+            with self.lock:
+                # Loaded by another request while this one waited, or cleared meanwhile
+                if sample_rate in self.backends or self.shared is not shared:
+                    return None, None, []
+            start = time.time()
+            logging.info(f"Loading {sample_rate} Hz back end...")
+            (frontend, token2wav), nbytes = _measured(
+                lambda: self.load_backend(shared, sample_rate),
+                lambda loaded: module_nbytes(loaded[1].vocoder),
+            )
+            backend = RateBackend(sample_rate, frontend, token2wav, nbytes)
+            with self.lock:
+                if self.shared is not shared:
+                    # The registry was cleared during the load
+                    return None, None, [backend]
+                self.backends[sample_rate] = backend
+                self.stats["backend_loads"] += 1
+                self.stats["load_time"] += time.time() - start
+                components, evicted = self._use(backend, lease)
+        logging.info(f"{sample_rate} Hz back end loaded ({nbytes / 1024 / 1024:.1f} MB, "
+                     f"resident {self.resident_nbytes() / 1024 / 1024:.1f} MB).")
+        return backend, components, evicted
+
+    def _use(self, backend: RateBackend, lease: bool):
+        """
+        Marks `backend` as most recently used (and leased) and evicts others to the budget;
+        the caller holds the lock and releases the returned evicted back ends after it.
+        """
+        self.backends.move_to_end(backend.sample_rate)
+        backend.last_used = time.time()
+        if lease:
+            backend.in_use += 1
+        return self._components(backend), self._evict_to_budget(keep=backend.sample_rate)
+
+    def _evict_to_budget(self, keep: Optional[int]) -> List[RateBackend]:
+        """Drops idle back ends until the budget holds; returns them for `_release` outside the lock."""
+        evicted = []
+        if self.memory_budget is None:
+            return evicted
+        for rate in list(self.backends):
+            if self.resident_nbytes() <= self.memory_budget:
+                break
+            backend = self.backends[rate]
+            if rate == keep or backend.in_use:
+                continue
+            del self.backends[rate]
+            self.stats["evictions"] += 1
+            logging.info(f"Evicting idle {rate} Hz back end ({backend.nbytes / 1024 / 1024:.1f} MB) "
+                         f"to stay within the model memory budget.")
+            evicted.append(backend)
+        return evicted
+
+    def _release(self, backend: RateBackend):
+        if self.release_backend is not None:
+            self.release_backend(backend)
+        backend.frontend = None
+        backend.token2wav = None
+        if torch.cuda.is_available():
+            gc.collect()
+            torch.cuda.empty_cache()
@@ -11,68 +11,105 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""
+Block-causal attention masks for streaming flow inference.
+
+Frames are grouped into consecutive blocks (`block_list`, the last size repeating);
+a frame attends to every frame up to the end of its block, extended so that at
+least half a block (two thirds for blocks over 172 frames) of look-ahead is visible.
+Each mask row is therefore a prefix of the keys, and only its length is cached.
+"""
+import functools
 import itertools
-import copy
 import time
 
 import torch
 
+# Number of (block pattern, length) entries kept by `create_with_cache`
+CACHE_SIZE = 256
 
-def create(block_list, tensor_len):
-    assert type(block_list) == list
+
+def row_limits(block_list, tensor_len):
+    """
+    Number of visible keys for every query frame, shape (tensor_len,) int64:
+    row i of the mask is `arange(tensor_len) < limits[i]`.
+    """
+    assert type(block_list) in (list, tuple)
     assert len(block_list) > 0
     assert tensor_len > 0
 
-    block_list = copy.deepcopy(block_list)
+    block_sizes = torch.tensor(block_list, dtype=torch.long)
+    total = int(block_sizes.sum())
+    if total < tensor_len:
+        # Repeat the last block size until the sequence is covered
+        assert block_list[-1] > 0
+        repeats = -(-(tensor_len - total) // block_list[-1])
+        block_sizes = torch.cat([block_sizes, block_sizes[-1:].repeat(repeats)])
+    block_ends = torch.cumsum(block_sizes, dim=0)
 
-    block_list = block_list + [block_list[-1]] * 10000
+    frames = torch.arange(tensor_len)
+    block_index = torch.searchsorted(block_ends, frames, right=True)
+    cur_block_size = block_sizes[block_index]
+    last_size = block_ends[block_index] - cur_block_size
 
-    block_list_accumulate = list(itertools.accumulate(block_list, lambda x, y: x + y))
+    look_future_size = cur_block_size - 1 - (frames - last_size)
+    min_future_size = torch.where(cur_block_size <= 172,
+                                  cur_block_size // 2,
+                                  (cur_block_size.double() / 1.5).floor().long())
+    delta = (min_future_size - look_future_size).clamp(min=0)
+    return last_size + cur_block_size + delta
 
-    zeros = torch.zeros([tensor_len, tensor_len])
 
-    for i in range(tensor_len):
-        for j in range(len(block_list_accumulate)):
-            if i < block_list_accumulate[j]:
-                cur_block_size = block_list[j]
-
-                if j == 0:
-                    last_size = 0
-                else:
-                    last_size = block_list_accumulate[j - 1]
+def create(block_list, tensor_len):
+    limits = row_limits(block_list, tensor_len)
+    return (torch.arange(tensor_len)[None, :] < limits[:, None]).int()
 
-                break
 
-        index_in_cur_block = i - last_size
-        look_future_size = cur_block_size - 1 - index_in_cur_block
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _cached_row_limits(block_key, tensor_len):
+    return row_limits(block_key, tensor_len)
 
-        if cur_block_size <= 172:
-            min_future_size = int(cur_block_size / 2)
-        else:
-            min_future_size = int(cur_block_size / 1.5)
 
-        if look_future_size >= min_future_size:
-            delta = 0
-        else:
-            delta = min_future_size - look_future_size
+def create_row_limits(block_list, tensor_len, row_start=0, device=None):
+    """`row_limits` of rows [row_start, tensor_len) on `device`, cached per (block pattern, length)."""
+    limits = _cached_row_limits(tuple(int(i) for i in block_list), tensor_len)
+    return limits[row_start:].to(device)
 
-        aim_len_with_accumu = last_size + cur_block_size + delta
-        zeros[i, 0:aim_len_with_accumu] = 1
 
-    return zeros.int()
+def create_with_cache(block_list, tensor_len, row_start=0, device=None):
+    """
+    Boolean mask rows [row_start, tensor_len) over all tensor_len keys, built on `device`.
+    Row limits are cached per (block pattern, length) in a bounded LRU.
+    """
+    limits = create_row_limits(block_list, tensor_len, row_start, device)
+    keys = torch.arange(tensor_len, device=device)
+    return keys[None, :] < limits[:, None]
 
 
-global_cache = {}
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _cached_query_chunks(block_key, tensor_len):
+    limits = _cached_row_limits(block_key, tensor_len).tolist()
+    chunks, start = [], 0
+    for size in itertools.chain(block_key, itertools.repeat(block_key[-1])):
+        end = min(start + size, tensor_len)
+        if end > start:
+            chunks.append((start, end, min(max(limits[start:end]), tensor_len)))
+        if end == tensor_len:
+            break
+        start = end
+    return tuple(chunks)
 
 
-def create_with_cache(block_list, tensor_len):
-    key = ",".join([str(i) for i in block_list])
-    if key not in global_cache:
-        global_cache[key] = create(block_list, 10000)
-    big_tensor = global_cache[key]
-    assert big_tensor.shape[0] > tensor_len
-    result = big_tensor[0:tensor_len, 0:tensor_len].clone()
-    return result
+def query_chunks(block_list, tensor_len, row_start=0):
+    """
+    One (q_start, q_end, k_end) per block for rows [row_start, tensor_len): the block's
+    queries (relative to row_start) only attend to keys [0, k_end).
+    """
+    chunks = []
+    for q_start, q_end, k_end in _cached_query_chunks(tuple(int(i) for i in block_list), tensor_len):
+        if q_end > row_start:
+            chunks.append((max(q_start, row_start) - row_start, q_end - row_start, k_end))
+    return chunks
 
 
 if __name__ == "__main__":
@@ -82,4 +119,4 @@ if __name__ == "__main__":
     res = create_with_cache([2, 4, 8], 40)
     t3 = time.time()
     print(t2 - t1)
-    print(t3 - t2)
\ No newline at end of file
+    print(t3 - t2)
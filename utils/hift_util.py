@@ -12,27 +12,101 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
 import torch
 import pathlib
-from typing import Union
+from typing import List, Optional, Union
+from torch.nn.utils import parametrize
 from utils.audio import mel_spectrogram
+from utils.vocoder_batch import vocode_in_batches
+from cosyvoice.transformer.activation import Snake
 from cosyvoice.hifigan_cosy2.f0_predictor import ConvRNNF0Predictor
 from cosyvoice.hifigan_cosy2.generator import HiFTGenerator
 
+HIFT_SERVING_PATH = 'ckpt/hift/hift_serving.jit'
+# Output samples per mel frame: prod(upsample_rates) * istft hop_len
+HIFT_UPSAMPLE_SCALE = 8 * 5 * 3 * 4
+
+
+class FoldedSnake(torch.nn.Module):
+    """Snake with alpha and 1 / alpha precomputed as (1, C, 1) buffers, for the serving build."""
+
+    def __init__(self, snake: Snake):
+        super().__init__()
+        alpha = snake.alpha.detach()
+        if snake.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.register_buffer("alpha", alpha[None, :, None].clone())
+        self.register_buffer("inv_alpha", 1.0 / (self.alpha + snake.no_div_by_zero))
+
+    def forward(self, x):
+        return x + self.inv_alpha * torch.sin(x * self.alpha) ** 2
+
+
+def fold_for_serving(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Folds weight norm into plain conv weights and replaces Snake activations by
+    FoldedSnake, in place. `HiFTGenerator.remove_weight_norm` predates the
+    parametrization-based weight_norm (and the NSF source has no such method).
+    """
+    for module in list(model.modules()):
+        if parametrize.is_parametrized(module, "weight"):
+            parametrize.remove_parametrizations(module, "weight", leave_parametrized=True)
+        elif hasattr(module, "weight_g"):
+            torch.nn.utils.remove_weight_norm(module)
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Snake):
+                setattr(module, child_name, FoldedSnake(child))
+    return model
+
+
+class HiFTServingModule(torch.nn.Module):
+    """Inference graph of a folded HiFTGenerator, traced and frozen by `HiFTInference.export_serving`."""
+
+    def __init__(self, generator: HiFTGenerator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, mel):
+        f0 = self.generator.f0_predictor(mel)
+        source, _, _ = self.generator.m_source(self.generator.f0_upsamp(f0[:, None]).transpose(1, 2))
+        return self.generator.decode(x=mel, s=source.transpose(1, 2))
+
+    def predict_f0(self, mel):
+        return self.generator.f0_predictor(mel)
+
+    def decode(self, mel, source):
+        return self.generator.decode(x=mel, s=source)
+
+    def merge_source(self, sine_waves):
+        return self.generator.m_source.l_tanh(self.generator.m_source.l_linear(sine_waves))
+
+
 class HiFTInference:
     def __init__(self, 
                  ckpt_path: Union[str, pathlib.Path], 
                  device: Union[str, torch.device] = 'cuda',
-                 load_only_nsf: bool = False):
+                 load_only_nsf: bool = False,
+                 serving_path: Optional[Union[str, pathlib.Path]] = None):
         """
         Wrapper class for HiFTGenerator inference.
+        With `serving_path`, the frozen TorchScript serving build (see `export_serving`)
+        is loaded instead of the training-form checkpoint.
         """
         if isinstance(ckpt_path, str):
             ckpt_path = pathlib.Path(ckpt_path)
         
         self.device = device
         self.sample_rate = 24000
-        
+        self.upsample_scale = HIFT_UPSAMPLE_SCALE
+        self.runtime = None
+
+        if serving_path is not None:
+            self.model = None
+            self.runtime = torch.jit.load(str(serving_path), map_location=device)
+            return
+
         self.model = self._build_model()
         
         self._load_weights(ckpt_path, load_only_nsf)
@@ -60,7 +134,7 @@ class HiFTInference:
             upsample_kernel_sizes=[16, 11, 7],
             istft_params={
                 "n_fft": 16,
-                "hop_len": 4
+                "hop_len": 4  # HIFT_UPSAMPLE_SCALE = prod(upsample_rates) * hop_len
             },
             resblock_kernel_sizes=[3, 7, 11],
             resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
@@ -106,9 +180,70 @@ class HiFTInference:
         """
         mel = mel.to(self.device)
         with torch.no_grad():
+            if self.runtime is not None:
+                return self.runtime(mel)
             audio, _ = self.model.inference(mel)
         return audio
 
+    def vocode_batch(self, mels: List[torch.Tensor], max_batch_size: int = 8) -> List[torch.Tensor]:
+        """
+        Vocodes mels (1, C, T_i) of different lengths in padded batches of up to
+        `max_batch_size`; returns (1, T_i * upsample_scale) waveforms in input order.
+        """
+        return vocode_in_batches(self, mels, self.upsample_scale, max_batch_size)
+
+    # Stages of `HiFTGenerator.inference`, used by HiFTStreamingSession
+    def predict_f0(self, mel: torch.Tensor) -> torch.Tensor:
+        if self.runtime is not None:
+            return self.runtime.predict_f0(mel)
+        return self.model.f0_predictor(mel)
+
+    def decode(self, mel: torch.Tensor, source: torch.Tensor) -> torch.Tensor:
+        if self.runtime is not None:
+            return self.runtime.decode(mel, source)
+        return self.model.decode(x=mel, s=source)
+
+    def merge_source(self, sine_waves: torch.Tensor) -> torch.Tensor:
+        """Merges the harmonics (B, T, harmonics) into the NSF excitation (B, T, 1)."""
+        if self.runtime is not None:
+            return self.runtime.merge_source(sine_waves)
+        return self.model.m_source.l_tanh(self.model.m_source.l_linear(sine_waves))
+
+    def fold_for_serving(self):
+        """Folds weight norm and Snake constants of the loaded model in place."""
+        fold_for_serving(self.model)
+
+    def export_serving(self, path: Union[str, pathlib.Path]) -> torch.jit.ScriptModule:
+        """
+        Traces a folded copy of the model (all stages used by __call__ and the streaming
+        session), freezes it and saves it to `path`. The training-form model is kept.
+        The generator creates its noise, harmonic factors and STFT window from its
+        inputs (rand_like, .to(tensor)), so the graph holds no device constants and the
+        build loads on any device with `map_location`.
+        """
+        # A fresh copy: deepcopy shares the parametrized classes, and folding one would break the other
+        generator = self._build_model()
+        generator.load_state_dict(self.model.state_dict())
+        module = HiFTServingModule(fold_for_serving(generator)).eval()
+        mel = torch.randn(1, 80, 64, device=self.device)
+        source = torch.randn(1, 1, 64 * self.upsample_scale, device=self.device)
+        sine_waves = torch.randn(1, 64 * self.upsample_scale, module.generator.m_source.l_linear.in_features,
+                                 device=self.device)
+        with torch.no_grad():
+            traced = torch.jit.trace_module(module, {
+                "forward": mel,
+                "predict_f0": mel,
+                "decode": (mel, source),
+                "merge_source": sine_waves,
+            }, check_trace=False)
+            frozen = torch.jit.freeze(traced, preserved_attrs=["predict_f0", "decode", "merge_source"])
+        frozen.save(str(path))
+        return frozen
+
+    def stream_session(self, fade_samples: int = 0) -> "HiFTStreamingSession":
+        """Start vocoding one utterance chunk by chunk (see HiFTStreamingSession)."""
+        return HiFTStreamingSession(self, fade_samples=fade_samples)
+
     @staticmethod
     def extract_mel(wav: torch.Tensor) -> torch.Tensor:
         """
@@ -126,9 +261,145 @@ class HiFTInference:
             center=False
         )
 
-def load_hift(device: str = "cuda", load_only_nsf: bool = False) -> HiFTInference:
-    """Factory function to load HiFT model."""
+class HiFTStreamingSession:
+    """
+    Stateful HiFT vocoding of one utterance whose mel arrives in chunks.
+
+    `HiFTInference.__call__` has to be given the whole mel so far, re-vocoding every
+    earlier frame on each chunk. Here each `step` only vocodes the new frames. Between
+    calls the session keeps
+    - the last `context_frames` mel frames and their harmonic source samples, which are
+      fed in front of the new frames so the convolutions and the iSTFT overlap see the
+      same left context as offline vocoding (the stored source is reused, not regenerated),
+    - the per-harmonic phase of the sine source, so the excitation continues without a
+      phase jump at the chunk boundary,
+    - the last `fade_samples` output samples, held back and cross-faded with their
+      recomputation on the next call.
+
+    Given the same mel and source, the output equals one `HiFTGenerator.decode` over the
+    whole utterance except near chunk boundaries, where samples were computed with
+    provisional look-ahead frames (and cross-faded).
+    """
+
+    # Receptive field of decode / f0 predictor is about 10 mel frames on either side
+    context_frames = 16
+
+    # NSF sine source settings of HiFTInference._build_model
+    harmonic_num = 8
+    sine_amp = 0.1
+    noise_std = 0.003
+    voiced_threshold = 10
+
+    def __init__(self, vocoder: HiFTInference, fade_samples: int = 0):
+        self.vocoder = vocoder
+        self.device = vocoder.device
+        self.sample_rate = vocoder.sample_rate
+        self.upsample_scale = vocoder.upsample_scale
+        self.fade_samples = min(fade_samples, self.context_frames * self.upsample_scale)
+        # Final mel frames vocoded so far
+        self.frames_done = 0
+        self.mel_context: Optional[torch.Tensor] = None
+        self.source_context: Optional[torch.Tensor] = None
+        # Sine phase (B, harmonics) at the last final frame
+        self.phase: Optional[torch.Tensor] = None
+        self.tail: Optional[torch.Tensor] = None
+
+    def _source(self, f0: torch.Tensor, num_final: int) -> torch.Tensor:
+        """
+        Harmonic source (B, 1, T * upsample_scale) for per-frame `f0` (B, T), as
+        SourceModuleHnNSF2 computes it but continuing the phase of the previous call.
+        """
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=f0.dtype)
+        rad = (f0[:, :, None] * harmonics / self.sample_rate) % 1
+        if self.phase is None:
+            # Random initial phase of the overtones, none for the fundamental
+            self.phase = torch.rand(f0.shape[0], harmonics.shape[0], device=f0.device) * 2 * np.pi
+            self.phase[:, 0] = 0
+            previous = None
+        else:
+            previous = self.phase[:, None]
+        phase = self.phase[:, None] + torch.cumsum(rad, dim=1) * 2 * np.pi * self.upsample_scale
+        # Interpolate from the previous frame's phase (offline: clamp at the first frame)
+        padded = torch.cat([phase[:, :1] if previous is None else previous, phase], dim=1)
+        phase_samples = torch.nn.functional.interpolate(
+            padded.transpose(1, 2), scale_factor=self.upsample_scale, mode="linear"
+        ).transpose(1, 2)[:, self.upsample_scale:]
+        if num_final > 0:
+            self.phase = phase[:, num_final - 1] % (2 * np.pi)
+
+        f0_samples = f0.repeat_interleave(self.upsample_scale, dim=1)[:, :, None]
+        uv = (f0_samples > self.voiced_threshold).float()
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        sine_waves = torch.sin(phase_samples) * self.sine_amp * uv + noise_amp * torch.randn_like(phase_samples)
+        return self.vocoder.merge_source(sine_waves).transpose(1, 2)
+
+    @torch.inference_mode()
+    def step(self, mel: torch.Tensor, num_final: Optional[int] = None) -> torch.Tensor:
+        """
+        Args:
+            mel: Mel frames after the ones already vocoded, (B, C, T). Frames past
+                `num_final` are look-ahead context and are vocoded again next call.
+            num_final: Leading frames of `mel` that will not change; None marks the
+                last chunk (all frames final, held samples flushed).
+
+        Returns:
+            torch.Tensor: New audio samples (B, N).
+        """
+        mel = mel.to(self.device)
+        is_last = num_final is None
+        num_final = mel.shape[-1] if is_last else max(0, min(num_final, mel.shape[-1]))
+        if num_final == 0 and not is_last:
+            return mel.new_zeros(mel.shape[0], 0)
+        right = mel.shape[-1] if is_last else min(mel.shape[-1], num_final + self.context_frames)
+        mel = mel[:, :, :right]
+
+        left = 0 if self.mel_context is None else self.mel_context.shape[-1]
+        if left > 0:
+            mel = torch.cat([self.mel_context, mel], dim=-1)
+        f0 = self.vocoder.predict_f0(mel)
+        source = self._source(f0[:, left:], num_final)
+        if left > 0:
+            source = torch.cat([self.source_context, source], dim=-1)
+        wav = self.vocoder.decode(mel, source)
+
+        # Keep the left context of the next call
+        final_end = left + num_final
+        self.mel_context = mel[:, :, :final_end][:, :, -self.context_frames:]
+        self.source_context = source[:, :, :final_end * self.upsample_scale][:, :, -self.context_frames * self.upsample_scale:]
+        self.frames_done += num_final
+
+        start, end = left * self.upsample_scale, final_end * self.upsample_scale
+        if self.tail is not None:
+            # Cross-fade the held samples with their recomputation
+            start -= self.tail.shape[-1]
+            wav = wav.clone()
+            fade_in = torch.linspace(0, 1, self.tail.shape[-1], device=wav.device)
+            wav[:, start:start + self.tail.shape[-1]] = (
+                self.tail * (1 - fade_in) + wav[:, start:start + self.tail.shape[-1]] * fade_in
+            )
+        out = wav[:, start:end]
+        if is_last or self.fade_samples == 0:
+            self.tail = None
+            return out
+        hold = min(self.fade_samples, out.shape[-1])
+        self.tail = out[:, out.shape[-1] - hold:]
+        return out[:, :out.shape[-1] - hold]
+
+
+def load_hift(device: str = "cuda", load_only_nsf: bool = False, serving: bool = False) -> HiFTInference:
+    """
+    Factory function to load HiFT model.
+    With `serving`, the build from tools/build_serving_vocoder.py is loaded; if it has not
+    been built yet, the training-form model is folded in memory instead.
+    """
     # Update this path to your actual relative path for the open source release
     ckpt_path = 'ckpt/hift/hift.pt'
+    if serving and pathlib.Path(HIFT_SERVING_PATH).exists():
+        print(f"Loading HiFT serving build from {HIFT_SERVING_PATH} on {device}...")
+        return HiFTInference(ckpt_path, device=device, serving_path=HIFT_SERVING_PATH)
     print(f"Loading HiFT model from {ckpt_path} on {device}...")
-    return HiFTInference(ckpt_path, device=device, load_only_nsf=load_only_nsf)
\ No newline at end of file
+    hift = HiFTInference(ckpt_path, device=device, load_only_nsf=load_only_nsf)
+    if serving:
+        print(f"{HIFT_SERVING_PATH} not found, folding the HiFT model in memory...")
+        hift.fold_for_serving()
+    return hift
\ No newline at end of file
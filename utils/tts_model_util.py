@@ -15,10 +15,12 @@ import torch
 import numpy as np
 from typing import List, Tuple, Generator, Optional, Union
 from utils.vocos_util import load_vocos_jit
-from utils.hift_util import load_hift
+from utils.hift_util import HiFTInference, load_hift
+from flow.streaming import FlowStepCache, FlowStreamingSession
 
 class Token2Wav:
-    def __init__(self, flow, sample_rate: int = 24000, device: str = "cuda"):
+    def __init__(self, flow, sample_rate: int = 24000, device: str = "cuda", serving_vocoder: bool = False):
+        """`serving_vocoder` loads the folded/frozen vocoder build (tools/build_serving_vocoder.py)."""
         self.device = device
         self.flow = flow
         self.input_frame_rate = flow.input_frame_rate
@@ -28,13 +30,15 @@ class Token2Wav:
         if sample_rate == 32000:
             self.hop_size = 640
             self.sample_rate = 32000
-            self.vocoder = load_vocos_jit(device)
+            self.vocoder = load_vocos_jit(device, serving=serving_vocoder)
         elif sample_rate == 24000:
             self.hop_size = 480
             self.sample_rate = 24000
-            self.vocoder = load_hift(device)
+            self.vocoder = load_hift(device, serving=serving_vocoder)
         else:
             raise ValueError(f"Unsupported sample_rate: {sample_rate}")
+        # Optional VocoderBatcher shared by concurrent callers (see utils/vocoder_batch.py)
+        self.vocode_batcher = None
     
     def token2wav_stream(self,
                      syn_token: List[int],
@@ -44,8 +48,20 @@ class Token2Wav:
                      embedding: Optional[torch.Tensor] = None,
                      prompt_token_list: Optional[torch.Tensor] = None,
                      prompt_feat_td: Optional[torch.Tensor] = None,
+                     incremental: bool = True,
+                     guidance: Optional[str] = None,
                      ) -> Tuple[torch.Tensor, List[float], List[float], List[np.ndarray]]:
-        
+        """
+        Streaming synthesis simulated over chunks of `syn_token`.
+
+        With `incremental`, committed frames are frozen in a FlowStreamingSession and each
+        chunk only computes the new frames, so per-chunk flow cost stays roughly constant;
+        a HiFT vocoder then also streams (HiFTStreamingSession), vocoding only the newly
+        committed frames and cross-fading `fade_sec` at chunk boundaries.
+        Otherwise every chunk re-runs the flow over all tokens so far with the step cache,
+        and the vocoder re-runs over the whole mel.
+        `guidance` is a CFG schedule string (see flow/guidance.py).
+        """
         if not isinstance(syn_token, list):
             raise TypeError("syn_token must be a list.")
         assert len(block_sizes) == len(look_future_sizes), "block_sizes and look_future_sizes must have the same length."
@@ -53,6 +69,27 @@ class Token2Wav:
              raise ValueError("prompt_token_list cannot be empty.")
 
         diff_cache = None
+        session = None
+        block_pattern = [len(prompt_token_list)] + block_sizes
+        if incremental:
+            session = FlowStreamingSession(
+                self.flow,
+                prompt_token=prompt_token_list.to(self.device),
+                prompt_feat=prompt_feat_td.to(self.device),
+                embedding=embedding.to(self.device),
+                block_pattern=block_pattern,
+                guidance=guidance
+            )
+        else:
+            # Step states sized for the whole utterance, reused by every chunk
+            total_tokens = prompt_token_list.shape[-1] + len(syn_token)
+            diff_cache = FlowStepCache(
+                max_frames=int(total_tokens / self.input_frame_rate * self.flow.mel_framerate)
+            )
+        vocoder_session = None
+        if incremental and isinstance(self.vocoder, HiFTInference):
+            vocoder_session = self.vocoder.stream_session(fade_samples=int(fade_sec * self.sample_rate))
+        commit_len = 0
         result_wav_list = []
         wav_len_pointer = 0
         last_fade_out_array = None
@@ -68,38 +105,58 @@ class Token2Wav:
             # Inference with cache (Flow matching / Diffusion)
             # block_pattern guides the transformer attention mask creation
             # Note: prompt_token length is added to the beginning as we introduced prompt tokens
-            mel_bdt, diff_cache = self.flow.inference_with_cache(
-                token=torch.LongTensor(all_patch_token)[None].to(self.device),
-                prompt_token=prompt_token_list.to(self.device),
-                prompt_feat=prompt_feat_td.to(self.device),
-                embedding=embedding.to(self.device),
-                last_step_cache=diff_cache,
-                is_causal=True,
-                block_pattern=[len(prompt_token_list)] + block_sizes
-            )
+            if session is not None:
+                # Frames committed after the previous chunk are frozen, only the rest is computed
+                mel_bdt = session.step(torch.LongTensor(all_patch_token)[None].to(self.device), commit_len)
+            else:
+                mel_bdt, diff_cache = self.flow.inference_with_cache(
+                    token=torch.LongTensor(all_patch_token)[None].to(self.device),
+                    prompt_token=prompt_token_list.to(self.device),
+                    prompt_feat=prompt_feat_td.to(self.device),
+                    embedding=embedding.to(self.device),
+                    last_step_cache=diff_cache,
+                    is_causal=True,
+                    block_pattern=block_pattern,
+                    guidance=guidance
+                )
 
-            # [Modification] Replace with Vocos inference, return wav tensor directly
-            wav_bt = self.vocoder(mel_bdt)
-            
             mel_list.append(mel_bdt)
-            wav_npy = wav_bt.squeeze().detach().cpu().numpy()
+            if vocoder_session is None:
+                # [Modification] Replace with Vocos inference, return wav tensor directly
+                wav_bt = self.vocoder(mel_bdt)
+                wav_npy = wav_bt.squeeze().detach().cpu().numpy()
 
             # Subsequent logic relies mainly on self.sample_rate calculation, no major changes needed
             min_index = min(len(look_future_sizes) - 1, i)
             look_future_sec = look_future_sizes[min_index] / self.input_frame_rate
 
-            # Total WAV length calculation
-            total_sec = len(wav_npy) / self.sample_rate
+            # Total WAV length calculation (HiFT outputs hop_size samples per mel frame)
+            if vocoder_session is None:
+                total_sec = len(wav_npy) / self.sample_rate
+            else:
+                total_sec = mel_bdt.shape[-1] * self.hop_size / self.sample_rate
             
             # "Total length - look_future" is the length we need to override/update in the next inference
             override_sec = total_sec - look_future_sec
             override_mel_len = int(override_sec * self.sample_rate / self.hop_size)
             
             # Update cache for the next step
-            diff_cache['override_len'] = override_mel_len + 1
+            commit_len = override_mel_len + 1
             if prompt_feat_td is not None:
-                prompt_mel_len = prompt_feat_td.shape[0]
-                diff_cache['override_len'] = prompt_mel_len + override_mel_len + 1
+                prompt_mel_len = prompt_feat_td.shape[-2]
+                commit_len = prompt_mel_len + override_mel_len + 1
+            if diff_cache is not None:
+                diff_cache.trim(commit_len)
+
+            if vocoder_session is not None:
+                # Vocode only the frames committed since the previous chunk; the rest is look-ahead
+                is_last = i == len(chunked_list) - 1
+                wav_bt = vocoder_session.step(
+                    mel_bdt[:, :, vocoder_session.frames_done:],
+                    None if is_last else override_mel_len + 1 - vocoder_session.frames_done
+                )
+                result_wav_list.append(wav_bt.squeeze(0).detach().cpu().numpy())
+                continue
 
             # Calculate overlap and look-back lengths
             overlap_sec = look_future_sec + fade_sec
@@ -201,7 +258,11 @@ class Token2Wav:
                              prompt_token: torch.Tensor = torch.zeros(1, 0, dtype=torch.int32),
                              prompt_feat: torch.Tensor = torch.zeros(1, 0, 80),
                              embedding: torch.Tensor = torch.zeros(1, 192),
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+                             solver: str = "euler",
+                             guidance: Optional[str] = None,
+                             vocode: bool = True,
+    ) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+        """With `vocode=False` only the mel is computed (wav is None), e.g. to vocode segments together later."""
         if isinstance(token_bt, (list, np.ndarray)):
             token_bt = torch.tensor(token_bt, dtype=torch.long)[None]
         elif not isinstance(token_bt, torch.Tensor):
@@ -214,12 +275,73 @@ class Token2Wav:
             prompt_feat=prompt_feat.to(self.device),
             embedding=embedding.to(self.device),
             n_timesteps=n_timesteps,
+            solver=solver,
+            guidance=guidance,
         )
-        
-        wav = self.vocoder(mel)
+        if not vocode:
+            return None, mel
+
+        if self.vocode_batcher is not None:
+            wav = self.vocode_batcher.vocode_batch([mel])[0]
+        else:
+            wav = self.vocoder(mel)
 
         return wav, mel
 
+    def vocode_batch(self, mels: List[torch.Tensor], max_batch_size: int = 8) -> List[torch.Tensor]:
+        """
+        Vocodes mels (1, C, T_i) in padded batches, through the attached batcher if any.
+        Waveforms are cropped to `T_i * hop_size` samples and returned in input order.
+        """
+        if self.vocode_batcher is not None:
+            return self.vocode_batcher.vocode_batch(mels)
+        return self.vocoder.vocode_batch(mels, max_batch_size=max_batch_size)
+
+    def token2wav_batch(self,
+                        token_list: List[Union[List[int], np.ndarray, torch.Tensor]],
+                        prompt_token: List[torch.Tensor],
+                        prompt_feat: List[torch.Tensor],
+                        embedding: List[torch.Tensor],
+                        n_timesteps: int = 10,
+                        solver: str = "euler",
+                        max_batch_size: int = 8,
+                        guidance: Optional[str] = None,
+                        vocoder_batch_size: Optional[int] = None,
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """
+        Batched `token2wav_with_cache` over several segments, each with its own prompt and
+        speaker embedding. Segments are grouped by length into flow batches of at most
+        `max_batch_size`, and all mels are then vocoded in batches of `vocoder_batch_size`
+        (default: `max_batch_size`); results are returned in input order.
+        """
+        tokens = []
+        for token_bt in token_list:
+            if isinstance(token_bt, (list, np.ndarray)):
+                token_bt = torch.tensor(token_bt, dtype=torch.long)[None]
+            elif not isinstance(token_bt, torch.Tensor):
+                raise ValueError(f"Unsupported token_bt type: {type(token_bt)}")
+            tokens.append(token_bt.to(self.device))
+
+        mels = [None] * len(tokens)
+        # Similar lengths in the same batch keep padding small
+        order = sorted(range(len(tokens)), key=lambda i: tokens[i].shape[1] + prompt_token[i].shape[1])
+        for start in range(0, len(order), max_batch_size):
+            group = order[start:start + max_batch_size]
+            group_mels = self.flow.inference_batch(
+                tokens=[tokens[i] for i in group],
+                prompt_tokens=[prompt_token[i].to(self.device) for i in group],
+                prompt_feats=[prompt_feat[i].to(self.device) for i in group],
+                embeddings=[embedding[i].to(self.device) for i in group],
+                n_timesteps=n_timesteps,
+                solver=solver,
+                guidance=guidance,
+            )
+            for i, mel in zip(group, group_mels):
+                mels[i] = mel
+
+        wavs = self.vocode_batch(mels, max_batch_size=vocoder_batch_size or max_batch_size)
+        return wavs, mels
+
     def calc_ratio(self, small_out: torch.Tensor, big_out: torch.Tensor) -> float:
         # Ensure dimensions match before operation to avoid runtime errors
         min_len = min(small_out.shape[-1], big_out.shape[-1])
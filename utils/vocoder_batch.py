@@ -0,0 +1,197 @@
+# Copyright (c) 2025 Zhipu AI Inc (authors: CogAudio Group Members)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Batched vocoding of mels with different lengths.
+
+`vocode_in_batches` sorts the mels by length, right-pads each group of up to
+`max_batch_size` to its longest mel, runs one vocoder forward per group and crops
+every waveform to exactly `frames * hop_size` samples. Padding repeats the last
+frame: both vocoders are non-causal, so the last few frames of a shorter mel see
+the padding instead of the signal end and differ slightly from a batch-1 call
+(HiFT: about 10 frames of receptive field); everything before is unchanged.
+
+`VocoderBatcher` coalesces vocoding calls from concurrent requests: callers hand
+in their mels and block, a background thread collects everything queued within
+`max_wait_ms` and vocodes it together.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def vocode_in_batches(vocoder: Callable[[torch.Tensor], torch.Tensor],
+                      mels: List[torch.Tensor],
+                      hop_size: int,
+                      max_batch_size: int = 8) -> List[torch.Tensor]:
+    """
+    Args:
+        vocoder: Batch vocoder, (B, C, T) mel -> (B, samples) or (B, 1, samples).
+        mels: Mels (1, C, T_i) of different lengths.
+        hop_size: Output samples per mel frame.
+        max_batch_size: Mels per vocoder forward.
+
+    Returns:
+        List[torch.Tensor]: Waveforms with `T_i * hop_size` samples, in input order
+        (an empty (1, 0) waveform for a mel without frames).
+    """
+    wavs: List[Optional[torch.Tensor]] = [None] * len(mels)
+    # Empty mels never enter a batch: replicate padding needs at least one frame
+    empty = [i for i, mel in enumerate(mels) if mel.shape[-1] == 0]
+    # Similar lengths in the same batch keep padding small
+    order = sorted((i for i in range(len(mels)) if mels[i].shape[-1] > 0), key=lambda i: mels[i].shape[-1])
+    for start in range(0, len(order), max_batch_size):
+        group = order[start:start + max_batch_size]
+        max_len = max(mels[i].shape[-1] for i in group)
+        batch = torch.cat([
+            F.pad(mels[i], (0, max_len - mels[i].shape[-1]), mode="replicate") if mels[i].shape[-1] < max_len
+            else mels[i]
+            for i in group
+        ])
+        wav = vocoder(batch)
+        for row, i in enumerate(group):
+            wavs[i] = wav[row:row + 1, ..., :mels[i].shape[-1] * hop_size]
+    if empty:
+        # Same layout as the vocoder's output, (1, 0) if there is none to follow
+        ndim = wavs[order[0]].dim() if order else 2
+        for i in empty:
+            wavs[i] = mels[i].new_zeros((1,) * (ndim - 1) + (0,))
+    return wavs
+
+
+class VocoderBatcher:
+    """
+    Background thread vocoding the mels of concurrent callers together.
+
+    `vocode_batch` has the same signature as the vocoders' own, so a batcher can be
+    attached to `Token2Wav.vocode_batcher` to route all of its vocoding through it.
+    """
+
+    def __init__(self, vocoder, max_batch_size: int = 8, max_wait_ms: float = 5.0):
+        """
+        Args:
+            vocoder: `HiFTInference` or `Vocos2DInference` (anything with `vocode_batch`).
+            max_batch_size: Mels per vocoder forward.
+            max_wait_ms: How long the first queued mel waits for others to join its batch.
+        """
+        self.vocoder = vocoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.pending: List[Tuple[torch.Tensor, Future]] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+        self.stats: Dict[str, float] = {
+            "batches": 0,
+            "mels": 0,
+            "frames": 0,
+            "padded_frames": 0,
+            "busy_time": 0.0,
+        }
+
+    def start(self) -> "VocoderBatcher":
+        """Start the background vocoding thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="glmtts-vocoder-batcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self) -> None:
+        """Stop the background thread and fail all queued mels."""
+        with self._cond:
+            self._stopped = True
+            pending, self.pending = self.pending, []
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for _, future in pending:
+            future.set_exception(RuntimeError("VocoderBatcher has been shut down."))
+
+    def vocode_batch(self, mels: List[torch.Tensor], max_batch_size: Optional[int] = None) -> List[torch.Tensor]:
+        """
+        Blocking: queues `mels` (1, C, T_i) and returns their waveforms in order.
+        `max_batch_size` is ignored, the batcher's own limit applies.
+        """
+        futures = [Future() for _ in mels]
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("VocoderBatcher has been shut down.")
+            self.pending.extend(zip(mels, futures))
+            self._cond.notify_all()
+        return [future.result() for future in futures]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            queued = len(self.pending)
+        batches, frames = self.stats["batches"], self.stats["frames"]
+        return {
+            "queued": queued,
+            "max_batch_size": self.max_batch_size,
+            "batches": batches,
+            "mels": self.stats["mels"],
+            "mean_batch_size": round(self.stats["mels"] / batches, 2) if batches else 0.0,
+            # Share of vocoded frames that were padding
+            "padding_ratio": round(self.stats["padded_frames"] / (frames + self.stats["padded_frames"]), 4)
+            if frames else 0.0,
+            "busy_time": round(self.stats["busy_time"], 3),
+        }
+
+    def _take_batch(self) -> Optional[List[Tuple[torch.Tensor, Future]]]:
+        with self._cond:
+            while not self._stopped and not self.pending:
+                self._cond.wait()
+            deadline = time.time() + self.max_wait
+            while not self._stopped and len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+            if self._stopped:
+                return None
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+            return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            mels = [mel for mel, _ in batch]
+            start = time.time()
+            try:
+                wavs = self.vocoder.vocode_batch(mels, max_batch_size=self.max_batch_size)
+            except Exception as e:
+                logging.exception(f"[VocoderBatcher] vocoding failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            # Empty mels are answered without vocoding (see vocode_in_batches)
+            lengths = [mel.shape[-1] for mel in mels if mel.shape[-1] > 0] or [0]
+            self.stats["batches"] += 1
+            self.stats["mels"] += len(mels)
+            self.stats["frames"] += sum(lengths)
+            self.stats["padded_frames"] += max(lengths) * len(lengths) - sum(lengths)
+            self.stats["busy_time"] += time.time() - start
+            for (_, future), wav in zip(batch, wavs):
+                future.set_result(wav)
@@ -14,18 +14,29 @@
 import torch
 import torch.jit
 import pathlib
-from typing import Union
+from typing import List, Union
+from utils.vocoder_batch import vocode_in_batches
 
 FS32K = 32000
+# Output samples per mel frame (50 Hz at 32k)
+VOCOS_HOP_SIZE = 640
 MEL_LOGDIFF = -7.847762537473608
+VOCOS_SERVING_PATH = 'ckpt/vocos2d/generator_serving.jit'
+# Members used by stft_mel, kept when freezing
+VOCOS_PRESERVED_ATTRS = ["_stft", "fbs", "spec_min"]
 
 class Vocos2DInference:
     def __init__(self, in_ckpt_path: Union[str, pathlib.Path], device: Union[str, torch.device] = 'cpu'):
+        """
+        `in_ckpt_path` is the TorchScript generator, either as trained or the frozen
+        serving build written by `export_serving`.
+        """
         # Ensure path is a Path object
         if isinstance(in_ckpt_path, str):
             in_ckpt_path = pathlib.Path(in_ckpt_path)
         
         self.device = device
+        self.hop_size = VOCOS_HOP_SIZE
         # Load JIT model
         self.gen_model: torch.jit.RecursiveScriptModule = torch.jit.load(in_ckpt_path, map_location=device)
         _ = self.gen_model.eval()
@@ -43,6 +54,13 @@ class Vocos2DInference:
         xs:     torch.Tensor = self.gen_model(xs_mel)   # (batch_size, sample_count)
         return xs
     
+    def vocode_batch(self, mels: List[torch.Tensor], max_batch_size: int = 8) -> List[torch.Tensor]:
+        """
+        Vocodes mels (1, C, T_i) of different lengths in padded batches of up to
+        `max_batch_size`; returns (1, T_i * hop_size) waveforms in input order.
+        """
+        return vocode_in_batches(self, mels, self.hop_size, max_batch_size)
+
     def stft_mel(self, xs: torch.Tensor) -> torch.Tensor:
         # Helper function to reverse Mel from audio (contained in Notebook)
         # Not strictly needed for inference but kept for completeness
@@ -53,8 +71,35 @@ class Vocos2DInference:
         xs_mel_tr: torch.Tensor = xs_mel.transpose(-1, -2) - MEL_LOGDIFF
         return xs_mel_tr
 
-def load_vocos_jit(device: str = "cuda") -> Vocos2DInference:
-    """Factory function to load Vocos model"""
+    def freeze(self):
+        """
+        Freezes the TorchScript generator in place: parameters become constants, so
+        weight-norm reparametrisations and other weight-only expressions are folded.
+        """
+        preserved = [attr for attr in VOCOS_PRESERVED_ATTRS if hasattr(self.gen_model, attr)]
+        self.gen_model = torch.jit.freeze(self.gen_model, preserved_attrs=preserved)
+
+    def export_serving(self, path: Union[str, pathlib.Path]) -> torch.jit.ScriptModule:
+        """Saves a frozen copy of the generator to `path`; the loaded generator is kept."""
+        gen_model = self.gen_model
+        self.freeze()
+        frozen, self.gen_model = self.gen_model, gen_model
+        frozen.save(str(path))
+        return frozen
+
+def load_vocos_jit(device: str = "cuda", serving: bool = False) -> Vocos2DInference:
+    """
+    Factory function to load Vocos model.
+    With `serving`, the build from tools/build_serving_vocoder.py is loaded; if it has not
+    been built yet, the generator is frozen in memory instead.
+    """
     ckpt_path = 'ckpt/vocos2d/generator_jit.ckpt'
+    if serving and pathlib.Path(VOCOS_SERVING_PATH).exists():
+        print(f"Loading Vocos serving build from {VOCOS_SERVING_PATH} on {device}...")
+        return Vocos2DInference(VOCOS_SERVING_PATH, device=device)
     print(f"Loading Vocos JIT model from {ckpt_path} on {device}...")
-    return Vocos2DInference(ckpt_path, device=device)
\ No newline at end of file
+    vocos = Vocos2DInference(ckpt_path, device=device)
+    if serving:
+        print(f"{VOCOS_SERVING_PATH} not found, freezing the Vocos generator in memory...")
+        vocos.freeze()
+    return vocos
\ No newline at end of file